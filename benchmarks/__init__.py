@@ -0,0 +1,11 @@
+"""
+Benchmarks of the scan, index, listing, grouping and preview paths.
+
+    python -m benchmarks run --out before.json
+    python -m benchmarks run --depth 4 --fanout 5 --files 100 --out after.json
+    python -m benchmarks compare before.json after.json
+
+Every run generates a synthetic asset library (see synthetic.py), times each
+path a few times and writes the timings with the parameters, commit and
+machine to JSON.
+"""
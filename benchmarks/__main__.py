@@ -0,0 +1,299 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from frankenstein import query, scanner, schema, search, sequences, snapshot
+from frankenstein.walker import Walker, DEFAULT_WORKERS
+
+from . import synthetic
+
+# Slower than this compared to the old run is reported as a regression
+REGRESSION = 1.10
+
+PREVIEW_IMAGES = 4
+PREVIEW_IMAGE_SIZE = 4096
+
+SIMILAR_QUERIES = 20
+
+
+class Bench:
+    """Collects timings of named benchmarks"""
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = {}
+
+    def time(self, name, run, items=None, setup=None, repeat=None):
+        """
+        Times run() repeat times, setup() runs untimed before every run.
+
+        items is the number of things one run handles, used for the rate.
+        """
+        runs = []
+        for _ in range(repeat or self.repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            result = run()
+            runs.append(time.perf_counter() - start)
+        if items is None and isinstance(result, int):
+            items = result
+        median = statistics.median(runs)
+        self.results[name] = {'runs': runs, 'min': min(runs), 'median': median, 'mean': statistics.mean(runs),
+                              'items': items, 'per_second': items / median if items and median else None}
+        print(f'{name:<28} {median * 1000:10.2f} ms' + (f'  {items / median:14.0f} /s' if items and median else ''))
+        return result
+
+    def skip(self, name, reason):
+        self.results[name] = {'skipped': reason}
+        print(f'{name:<28} skipped, {reason}')
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _machine():
+    return {'python': sys.version.split()[0], 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'sqlite': sqlite3.sqlite_version}
+
+
+def _count(iterable):
+    return sum(1 for _ in iterable)
+
+
+def bench_index(bench, top, work, workers):
+    """Scan, insert, listing, filtering and grouping of the synthetic library"""
+    db_path = os.path.join(work, 'bench.db')
+
+    def fresh_db():
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        db = schema.connect(db_path)
+        scanner.ensure_tables(db, top)
+        return db
+
+    # Listing every file on disk, what every full scan starts with
+    bench.time('walk', lambda: _count(Walker(workers).files(top)))
+
+    db = fresh_db()
+    batches = bench.time('scan.diff', lambda: list(scanner.scan_changes(db, top, incremental=False,
+                                                                        workers=workers)))
+    inserts = sum(len(change.inserts) for batch in batches for change in batch.dirs)
+
+    def insert():
+        for batch in batches:
+            scanner.apply_batch(state['db'], batch)
+
+    state = {}
+    bench.time('db.insert', insert, items=inserts, setup=lambda: state.update(db=fresh_db()))
+
+    # What the watchlist scan buttons run, in the background thread
+    bench.time('scan.full', lambda: scanner.scan_root(state['db'], top, False, workers).dirs_listed,
+               setup=lambda: state.update(db=fresh_db()))
+    db = state['db']
+    bench.time('scan.incremental', lambda: scanner.scan_root(db, top, True, workers).dirs_skipped)
+    seeds = iter(range(1, 1000))
+    # [files added, files the rescan inserted] of every run
+    changes = []
+
+    def touch():
+        changes.append([synthetic.touch_some(top, 0.01, next(seeds))])
+
+    def rescan():
+        changes[-1].append(scanner.scan_root(db, top, True, workers).inserted)
+        return changes[-1][-1]
+
+    bench.time('scan.incremental_changed', rescan, setup=touch)
+    bench.results['scan.incremental_changed']['changes'] = changes
+    # A rescan that finds nothing times the same as scan.incremental
+    if any(added != inserted for added, inserted in changes):
+        raise RuntimeError(f'scan.incremental_changed inserted other than the files added, [added, inserted]: '
+                           f'{changes}')
+
+    # _table_to_list and the first page of the files list
+    paths = bench.time('list.paths', lambda: query.FileQuery(top).paths(db))
+    bench.time('list.first_page', lambda: len(next(query.FileQuery(top).pages(db), [])))
+    bench.time('list.last_page', lambda: len(list(query.FileQuery(top, order='size').pages(db))[-1]))
+
+    images = ['exr', 'png', 'jpg', 'tif']
+    bench.time('filter.extension', lambda: len(query.FileQuery(top, extensions=images).paths(db)))
+    # Filtering and sorting a listing that's already loaded, without a str per file
+    bench.time('pathlist.filter', lambda: len(paths.with_extensions(images)), items=len(paths))
+    bench.time('pathlist.sort', lambda: len(paths.sorted('name')), items=len(paths))
+    bench.time('filter.count', lambda: query.FileQuery(top, extensions=images, min_size=10 << 20).count(db))
+    bench.time('search', lambda: len(search.search(db, 'brick wall', limit=500)))
+
+    # sortImageSequence.combinedPaths and the grouped listing from the index
+    bench.time('group.combined', lambda: len(sequences.combined(paths)), items=len(paths))
+    bench.time('group.indexed', lambda: len(sequences.indexed(db, top)))
+
+    # What the file server exports and a workstation opens, queries or imports instead of scanning
+    snapshot_path = os.path.join(work, 'bench.snap')
+    bench.time('snapshot.export', lambda: snapshot.export(db, snapshot_path) and len(paths), items=len(paths))
+    bench.time('snapshot.open', lambda: snapshot.Snapshot(snapshot_path).close())
+    with snapshot.Snapshot(snapshot_path) as opened:
+        bench.time('snapshot.filter',
+                   lambda: len(opened.select(query.FileQuery(top, extensions=images, min_size=10 << 20))))
+    import_path = os.path.join(work, 'import.db')
+
+    def fresh_import():
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(import_path + suffix):
+                os.remove(import_path + suffix)
+        state.update(imported=schema.connect(import_path))
+
+    bench.time('snapshot.import', lambda: snapshot.apply(state['imported'], snapshot_path).inserted,
+               setup=fresh_import)
+    state['imported'].conn.close()
+    db.conn.close()
+
+
+def bench_preview(bench, work):
+    """Full decode against the reduced size decode of the image viewer, needs Qt"""
+    try:
+        from PySide2.QtGui import QImage, QPainter, QLinearGradient, QColor
+        from PySide2.QtCore import Qt
+        from PySide2.QtWidgets import QApplication
+        import preview
+    except ImportError as e:
+        bench.skip('preview', f'Qt not available ({e})')
+        return
+    app = QApplication.instance() or QApplication(['benchmarks'])
+
+    paths = []
+    for index in range(PREVIEW_IMAGES):
+        image = QImage(PREVIEW_IMAGE_SIZE, PREVIEW_IMAGE_SIZE, QImage.Format_RGB32)
+        gradient = QLinearGradient(0, 0, PREVIEW_IMAGE_SIZE, PREVIEW_IMAGE_SIZE)
+        gradient.setColorAt(0, QColor(40 * index, 80, 160))
+        gradient.setColorAt(1, QColor(220, 200 - 30 * index, 40))
+        painter = QPainter(image)
+        painter.fillRect(image.rect(), gradient)
+        painter.setPen(QColor(0, 0, 0))
+        for line in range(0, PREVIEW_IMAGE_SIZE, 16):
+            painter.drawLine(0, line, PREVIEW_IMAGE_SIZE, PREVIEW_IMAGE_SIZE - line)
+        painter.end()
+        for ext in ('jpg', 'png'):
+            path = os.path.join(work, f'preview_{index}.{ext}')
+            image.save(path)
+            paths.append(path)
+
+    for ext in ('jpg', 'png'):
+        files = [x for x in paths if x.endswith(ext)]
+        bench.time(f'preview.full.{ext}',
+                   lambda: _count(QImage(x).scaled(500, 500, Qt.KeepAspectRatio) for x in files), repeat=2)
+        bench.time(f'preview.reduced.{ext}', lambda: _count(preview.decode_preview(x) for x in files), repeat=2)
+
+
+def bench_similar(bench, hashes):
+    """Nearest image hashes among random ones, half of the queries close to a stored hash"""
+    import numpy as np
+    from frankenstein import similar
+
+    random = np.random.default_rng(0)
+    values = random.integers(0, 2 ** 64, hashes, dtype=np.uint64)
+    index = similar.SimilarityIndex(np.arange(hashes), values)
+    queries = [int(values[x]) ^ (1 << int(random.integers(64))) for x in random.integers(0, hashes, SIMILAR_QUERIES // 2)]
+    queries += [int(x) for x in random.integers(0, 2 ** 64, SIMILAR_QUERIES - len(queries), dtype=np.uint64)]
+    # The multi-index is built on the first query of a large index, outside the timing
+    index.nearest(queries[0])
+    bench.time('similar.nearest', lambda: _count(index.nearest(x) for x in queries), items=SIMILAR_QUERIES)
+
+
+def cmd_run(args):
+    work = tempfile.mkdtemp(prefix='frankenstein_bench_')
+    top = args.tree or os.path.join(work, 'library')
+    try:
+        params = {'depth': args.depth, 'fanout': args.fanout, 'files': args.files,
+                  'sequence_share': args.sequences, 'seed': args.seed, 'workers': args.workers,
+                  'repeat': args.repeat, 'similar': args.similar}
+        if args.tree and os.path.isdir(args.tree):
+            print(f'Using the tree at {top}')
+            summary = None
+        else:
+            started = time.perf_counter()
+            summary = synthetic.generate(top, args.depth, args.fanout, args.files, args.sequences, args.seed)
+            print(f'Generated {summary["files"]} files in {summary["directories"]} directories, '
+                  f'{summary["sequences"]} sequences in {time.perf_counter() - started:.1f} sec')
+
+        bench = Bench(args.repeat)
+        bench_index(bench, top, work, args.workers)
+        if args.similar:
+            bench_similar(bench, args.similar)
+        if not args.no_preview:
+            bench_preview(bench, work)
+
+        report = {'commit': _commit(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'machine': _machine(),
+                  'params': params, 'tree': summary, 'results': bench.results}
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Wrote {args.out}')
+    finally:
+        # A tree given with --tree is kept
+        shutil.rmtree(work, ignore_errors=True)
+    return 0
+
+
+def cmd_compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if old.get('params') != new.get('params'):
+        print('Runs used different parameters, the numbers are not comparable', file=sys.stderr)
+    regressions = 0
+    print(f'{"":<28} {"old ms":>10} {"new ms":>10} {"ratio":>7}')
+    for name, result in new['results'].items():
+        before = old['results'].get(name, {})
+        if 'median' not in result or 'median' not in before:
+            continue
+        ratio = result['median'] / before['median'] if before['median'] else float('inf')
+        flag = '  slower' if ratio > REGRESSION else ''
+        regressions += bool(flag)
+        print(f'{name:<28} {before["median"] * 1000:10.2f} {result["median"] * 1000:10.2f} {ratio:7.2f}{flag}')
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='benchmarks', description='Benchmarks on a synthetic asset library.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='generate a library and time everything')
+    run.add_argument('--out', default='bench.json', help='JSON file with the results (default bench.json)')
+    run.add_argument('--depth', type=int, default=3, help='levels of folders below the root')
+    run.add_argument('--fanout', type=int, default=4, help='subfolders per folder')
+    run.add_argument('--files', type=int, default=50, help='files per folder')
+    run.add_argument('--sequences', type=float, default=0.3, help='share of files in image sequences')
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='directories listed at the same time')
+    run.add_argument('--repeat', type=int, default=3, help='runs of every benchmark, the median is reported')
+    run.add_argument('--tree', help='use (or generate and keep) the library here, eg on a NAS share. '
+                                      'A few files are added to it while benchmarking rescans')
+    run.add_argument('--no-preview', action='store_true', help='skip the image decode benchmarks')
+    run.add_argument('--similar', type=int, default=1_000_000,
+                     help='image hashes to search for similar images in, 0 to skip')
+    run.set_defaults(run=cmd_run)
+
+    compare = commands.add_parser('compare', help='compare two result files, exits 1 on regressions')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.set_defaults(run=cmd_compare)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+sys.exit(main())
@@ -0,0 +1,122 @@
+"""
+Synthetic asset libraries for the benchmarks.
+
+Builds a directory tree that looks like an asset library: folders of textures,
+models, sound fx and footage with a share of the files in image sequences
+(render.1001.exr, ...). The same parameters and seed always give the same tree.
+Files are sparse (os.truncate) so a tree of a million files with realistic sizes
+costs next to nothing on disk, mtimes are spread over the three years before EPOCH.
+
+    summary = generate('/tmp/library', depth=3, fanout=4, files=50, sequence_share=0.3)
+"""
+import os
+import random
+import time
+
+# Extension and how common it is among the single files
+EXTENSIONS = [('png', 20), ('jpg', 20), ('exr', 10), ('tif', 8), ('tga', 4), ('hdr', 2), ('wav', 10), ('mp3', 3),
+              ('mp4', 4), ('mov', 3), ('fbx', 4), ('obj', 4), ('blend', 2), ('ma', 2), ('txt', 2), ('pdf', 2)]
+SEQUENCE_EXTENSIONS = ['exr', 'png', 'dpx', 'tif', 'jpg']
+
+_WORDS = ['brick', 'wall', 'wood', 'oak', 'floor', 'metal', 'rust', 'concrete', 'stone', 'moss', 'leaves',
+          'grass', 'rain', 'loop', 'impact', 'whoosh', 'door', 'car', 'engine', 'explosion', 'smoke', 'fire',
+          'water', 'splash', 'tree', 'rock', 'cliff', 'sand', 'snow', 'ice', 'fabric', 'leather', 'plastic',
+          'glass', 'tile', 'roof', 'window', 'street', 'city', 'forest', 'sky', 'cloud', 'hdri', 'studio']
+_MAPS = ['diffuse', 'albedo', 'normal', 'roughness', 'height', 'ao', 'spec', 'mask']
+
+# Bytes of the files of every extension, (smallest, largest)
+_SIZES = {'exr': (2 << 20, 80 << 20), 'tif': (1 << 20, 120 << 20), 'hdr': (8 << 20, 200 << 20),
+          'mp4': (10 << 20, 2 << 30), 'mov': (50 << 20, 4 << 30), 'wav': (100 << 10, 50 << 20),
+          'dpx': (8 << 20, 50 << 20)}
+_DEFAULT_SIZE = (10 << 10, 20 << 20)
+
+_THREE_YEARS = 3 * 365 * 24 * 3600
+
+# Fixed so mtimes are the same every time a tree is generated
+EPOCH = 1700000000
+
+
+def _name(rng):
+    return '_'.join(rng.sample(_WORDS, rng.randint(1, 3)))
+
+
+def _write(path, size, mtime):
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    os.utime(path, (mtime, mtime))
+
+
+def _fill(rng, folder, files, sequence_share, now, summary):
+    """Writes files entries into folder, about sequence_share of them frames of sequences"""
+    sequence_files = int(files * sequence_share)
+    written = 0
+    while written < sequence_files:
+        ext = rng.choice(SEQUENCE_EXTENSIONS)
+        frames = min(rng.randint(10, 120), sequence_files - written)
+        if frames < 2:
+            break
+        prefix = f'{_name(rng)}_v{rng.randint(1, 9):02d}' + rng.choice(['.', '_'])
+        start = rng.choice([0, 1, 1001])
+        padding = rng.choice([4, 4, 4, 3, 5])
+        low, high = _SIZES.get(ext, _DEFAULT_SIZE)
+        mtime = now - rng.random() * _THREE_YEARS
+        frame = start
+        for _ in range(frames):
+            # An occasional dropped frame
+            if rng.random() < 0.02:
+                frame += 1
+            size = rng.randint(low, high)
+            _write(os.path.join(folder, f'{prefix}{str(frame).zfill(padding)}.{ext}'), size, mtime + frame)
+            summary['bytes'] += size
+            frame += 1
+        written += frames
+        summary['sequences'] += 1
+    extensions = [x for x, weight in EXTENSIONS]
+    weights = [weight for x, weight in EXTENSIONS]
+    names = set()
+    for _ in range(files - written):
+        ext = rng.choices(extensions, weights)[0]
+        name = f'{_name(rng)}_{rng.choice(_MAPS)}_{rng.randint(1, 99)}.{ext}'
+        if name in names:
+            continue
+        names.add(name)
+        low, high = _SIZES.get(ext, _DEFAULT_SIZE)
+        size = rng.randint(low, high)
+        _write(os.path.join(folder, name), size, now - rng.random() * _THREE_YEARS)
+        summary['bytes'] += size
+    summary['files'] += written + len(names)
+
+
+def generate(top, depth=3, fanout=4, files=50, sequence_share=0.3, seed=0) -> dict:
+    """
+    Builds a tree below top and returns a summary of what was made.
+
+    Every directory down to depth levels has fanout subdirectories and files
+    files. sequence_share is the part of those that are frames of image sequences.
+    """
+    rng = random.Random(seed)
+    now = EPOCH
+    summary = {'directories': 0, 'files': 0, 'sequences': 0, 'bytes': 0}
+    os.makedirs(top, exist_ok=True)
+    folders = [(top, 0)]
+    while folders:
+        folder, level = folders.pop()
+        summary['directories'] += 1
+        _fill(rng, folder, files, sequence_share, now, summary)
+        if level < depth:
+            for index in range(fanout):
+                child = os.path.join(folder, f'{_name(rng)}_{index}')
+                os.mkdir(child)
+                folders.append((child, level + 1))
+    return summary
+
+
+def touch_some(top, share=0.01, seed=1) -> int:
+    """Adds a file to share of the directories below top and at least one, returns how many were added"""
+    rng = random.Random(seed)
+    folders = sorted(folder for folder, dirs, names in os.walk(top))
+    chosen = rng.sample(folders, min(len(folders), max(1, round(share * len(folders)))))
+    for added, folder in enumerate(chosen):
+        # The seed keeps the names of different calls apart
+        _write(os.path.join(folder, f'new_{_name(rng)}_{seed}_{added}.png'), 1024, time.time())
+    return len(chosen)
@@ -0,0 +1,142 @@
+"""
+Duplicates panel, files with identical content and the space their copies take.
+
+Find duplicates runs hashing.update in a background thread (only new and
+changed files are read) and lists the result, the sets with the most
+reclaimable space first. The sets are read through a LocalIndex or
+RemoteIndex (see frankenstein/service.py). Without an index file of its own
+(the GUI uses a service) nothing is hashed here, the panel lists what the
+service machine hashed (python -m frankenstein dupes).
+"""
+import threading
+
+from PySide2.QtCore import QThread, Signal
+from PySide2.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QTreeWidget, QTreeWidgetItem, QPushButton, \
+    QProgressBar, QLabel, QHeaderView
+
+from frankenstein import hashing
+from frankenstein import schema
+from frankenstein.blom import format_bytes, get_logger, timer
+from frankenstein.service import ServiceError
+
+l = get_logger('frankenstein.duplicatespanel')
+
+
+class HashJob(QThread):
+    """Runs hashing.update on every watched folder"""
+    # step ('sample' or 'full'), files done, files to do
+    progress = Signal(str, int, int)
+
+    def __init__(self, db_path, readers=hashing.DEFAULT_READERS, parent=None):
+        QThread.__init__(self, parent)
+        self.db_path = db_path
+        self.readers = readers
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def run(self):
+        db = schema.connect(self.db_path)
+        try:
+            hashing.update(db, readers=self.readers, cancel=self._cancel, progress=self.progress.emit)
+        except Exception:
+            l.exception('Hashing failed')
+        finally:
+            db.conn.close()
+
+
+class DuplicatesPanel(QDialog):
+    def __init__(self, index, db_path=None, parent=None):
+        """db_path is the index file Find duplicates hashes into, None when it's a service"""
+        QDialog.__init__(self, parent)
+        self.setWindowTitle('Duplicates')
+        self.resize(900, 600)
+        self.index = index
+        self.db_path = db_path
+        self.readers = hashing.DEFAULT_READERS
+        self._job = None
+
+        self.find_button = QPushButton('Find duplicates')
+        self.find_button.clicked.connect(self.find)
+        if db_path is None:
+            self.find_button.setEnabled(False)
+            self.find_button.setToolTip('Files are hashed on the machine of the index service')
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel)
+        self.progress = QProgressBar()
+        self.progress.setFormat('%p% %v/%m')
+        self.summary = QLabel()
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.find_button)
+        buttons.addWidget(self.cancel_button)
+        buttons.addWidget(self.progress, 1)
+
+        self.tree = QTreeWidget()
+        self.tree.setHeaderLabels(['File', 'Size', 'Copies', 'Reclaimable'])
+        self.tree.header().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.tree.setUniformRowHeights(True)
+
+        layout = QVBoxLayout(self)
+        layout.addLayout(buttons)
+        layout.addWidget(self.summary)
+        layout.addWidget(self.tree)
+
+    def showEvent(self, event):
+        if self._job is None:
+            self.refresh()
+        QDialog.showEvent(self, event)
+
+    def refresh(self):
+        """Shows what is hashed so far, nothing is read from disk"""
+        timer_refresh = timer()
+        try:
+            groups = self.index.duplicates()
+        except ServiceError as e:
+            self.summary.setText(str(e))
+            return
+        self.tree.clear()
+        items = []
+        for group in groups:
+            item = QTreeWidgetItem([group.paths[0], format_bytes(group.size), str(group.copies),
+                                    format_bytes(group.reclaimable)])
+            item.addChildren([QTreeWidgetItem([path]) for path in group.paths])
+            items.append(item)
+        self.tree.addTopLevelItems(items)
+        self.summary.setText(f'{len(groups)} sets of copies, '
+                             f'{format_bytes(sum(x.reclaimable for x in groups))} reclaimable')
+        l.info(f'Listed {len(groups)} sets of copies in {timer_refresh}')
+
+    def find(self):
+        if self._job is not None or self.db_path is None:
+            return
+        self._job = HashJob(self.db_path, self.readers, parent=self)
+        self._job.progress.connect(self._progress)
+        self._job.finished.connect(self._job_finished)
+        self.find_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self._job.start()
+
+    def _progress(self, step, done, total):
+        self.progress.setMaximum(max(total, 1))
+        self.progress.setValue(done)
+        self.summary.setText('Reading samples of files with the same size' if step == 'sample'
+                             else 'Reading files with the same samples completely')
+
+    def _job_finished(self):
+        self._job.deleteLater()
+        self._job = None
+        self.find_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        self.refresh()
+
+    def cancel(self):
+        if self._job is not None:
+            self._job.cancel()
+
+    def shutdown(self):
+        if self._job is not None:
+            self._job.cancel()
+            self._job.wait()
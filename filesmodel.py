@@ -0,0 +1,72 @@
+"""
+List model of the files list.
+
+Rows come from an iterator of pages (lists of paths) like query.FileQuery.pages,
+sequences.indexed_pages or search.pages. Only the first page is read when a
+listing is shown, the view asks for the next one with fetchMore when it's
+scrolled near the end, so showing a root with a million files costs the same as
+showing one with a thousand. The loaded rows are kept in a PathList, scrolling
+to the end of a few million files doesn't keep a str per row.
+
+    model.set_pages(FileQuery(root).pages(db), total=FileQuery(root).count(db))
+"""
+from PySide2.QtCore import QAbstractListModel, QModelIndex, Qt
+
+from frankenstein.blom import get_logger
+from frankenstein.pathlist import PathList
+
+l = get_logger('frankenstein.filesmodel')
+
+
+class FilesModel(QAbstractListModel):
+    def __init__(self, parent=None):
+        QAbstractListModel.__init__(self, parent)
+        self._paths = PathList()
+        self._pages = None
+        # Number of rows the whole listing has when known
+        self.total = None
+
+    def set_pages(self, pages, total=None):
+        """Replaces the listing and loads its first page"""
+        self.beginResetModel()
+        self._paths = PathList()
+        self._pages = iter(pages)
+        self.total = total
+        self.endResetModel()
+        if self.canFetchMore(QModelIndex()):
+            self.fetchMore(QModelIndex())
+
+    def clear(self):
+        self.set_pages(())
+
+    def path(self, row):
+        """Path shown in row, None outside of the loaded rows"""
+        if 0 <= row < len(self._paths):
+            return self._paths[row]
+        return None
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._paths)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role not in (Qt.DisplayRole, Qt.ToolTipRole):
+            return None
+        return self._paths[index.row()]
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self._pages is not None
+
+    def fetchMore(self, parent):
+        if parent.isValid() or self._pages is None:
+            return
+        page = next(self._pages, None)
+        if not page:
+            self._pages = None
+            return
+        start = len(self._paths)
+        self.beginInsertRows(QModelIndex(), start, start + len(page) - 1)
+        self._paths.extend(page)
+        self.endInsertRows()
+        l.debug(f'Fetched rows {start} to {len(self._paths)}')
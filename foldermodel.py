@@ -0,0 +1,177 @@
+"""
+Tree model of the folders of a watched folder, with their number of files and size.
+
+Nothing is counted here: every folder carries the totals the scanner keeps in
+the index (see frankenstein/tree.py), and the subfolders of a folder are read
+with one query when it's expanded for the first time. They are read through a
+LocalIndex or RemoteIndex (see frankenstein/service.py):
+
+    model.set_root(service.LocalIndex(db), root)
+    model.folder(index).path
+"""
+from PySide2.QtCore import QAbstractItemModel, QModelIndex, Qt
+
+from frankenstein.blom import format_bytes, get_logger
+from frankenstein.service import ServiceError
+
+l = get_logger('frankenstein.foldermodel')
+
+COLUMNS = ('Folder', 'Files', 'Size')
+
+
+class _Node:
+    __slots__ = ('folder', 'parent', 'children', 'row')
+
+    def __init__(self, folder, parent, row):
+        self.folder = folder
+        self.parent = parent
+        # None until the folder is expanded
+        self.children = None
+        self.row = row
+
+
+class FolderModel(QAbstractItemModel):
+    def __init__(self, parent=None):
+        QAbstractItemModel.__init__(self, parent)
+        # LocalIndex or RemoteIndex the folders are read from
+        self.source = None
+        self._top = None
+
+    def _read(self, method, *args):
+        """Answer of a method of source, None when the service didn't answer"""
+        try:
+            return method(*args)
+        except ServiceError as e:
+            l.warning(f'Could not read folders: {e}')
+            return None
+
+    def set_root(self, source, root):
+        """Shows the folders of a watched folder read from source, nothing when it wasn't scanned yet"""
+        self.beginResetModel()
+        self.source = source
+        top = self._read(self.source.tree_top, root) if root is not None else None
+        self._top = _Node(top, None, 0) if top is not None else None
+        self.endResetModel()
+        # The first level is shown right away
+        if self.canFetchMore(self.index(0, 0)):
+            self.fetchMore(self.index(0, 0))
+
+    def clear(self):
+        self.set_root(None, None)
+
+    def refresh(self):
+        """Reads the totals of every loaded folder again, after a scan changed them"""
+        if self._top is None:
+            return
+        top = self._read(self.source.tree_folder, self._top.folder.id)
+        if top is None:
+            self.clear()
+            return
+        self._top.folder = top
+        self._refresh_children(self._top)
+        index = self.index(0, 0)
+        self.dataChanged.emit(index, self.index(0, len(COLUMNS) - 1))
+
+    def _refresh_children(self, node):
+        if node.children is None:
+            return
+        index = self._index(node)
+        folders = self._read(self.source.tree_children, node.folder.id)
+        if folders is None:
+            return
+        if [x.id for x in folders] != [x.folder.id for x in node.children]:
+            # Folders were added or removed, read them again when they're expanded
+            if node.children:
+                self.beginRemoveRows(index, 0, len(node.children) - 1)
+                node.children = []
+                self.endRemoveRows()
+            node.children = None
+            if self.canFetchMore(index):
+                self.fetchMore(index)
+            return
+        for child, folder in zip(node.children, folders):
+            child.folder = folder
+            self._refresh_children(child)
+        if node.children:
+            self.dataChanged.emit(self.index(0, 0, index),
+                                  self.index(len(node.children) - 1, len(COLUMNS) - 1, index))
+
+    def folder(self, index):
+        """tree.Folder of an index, None for an invalid one"""
+        node = self._node(index)
+        return None if node is None else node.folder
+
+    def _node(self, index):
+        if not index.isValid():
+            return None
+        return index.internalPointer()
+
+    def _index(self, node):
+        return self.createIndex(node.row, 0, node)
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row, column, self._top)
+        node = self._node(parent)
+        return self.createIndex(row, column, node.children[row])
+
+    def parent(self, index):
+        node = self._node(index)
+        if node is None or node.parent is None:
+            return QModelIndex()
+        return self._index(node.parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return 1 if self._top is not None else 0
+        if parent.column() > 0:
+            return 0
+        node = self._node(parent)
+        return len(node.children) if node.children is not None else 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(COLUMNS)
+
+    def hasChildren(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return self._top is not None
+        if parent.column() > 0:
+            return False
+        node = self._node(parent)
+        return node.children is None and node.folder.folders > 0 or bool(node.children)
+
+    def canFetchMore(self, parent):
+        node = self._node(parent)
+        return node is not None and node.children is None and node.folder.folders > 0
+
+    def fetchMore(self, parent):
+        node = self._node(parent)
+        if node is None or node.children is not None:
+            return
+        folders = self._read(self.source.tree_children, node.folder.id)
+        if folders is None:
+            return
+        if not folders:
+            node.children = []
+            return
+        self.beginInsertRows(parent, 0, len(folders) - 1)
+        node.children = [_Node(x, node, row) for row, x in enumerate(folders)]
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        node = self._node(index)
+        if node is None:
+            return None
+        folder = node.folder
+        if role == Qt.DisplayRole:
+            return (folder.name, f'{folder.files:,}', format_bytes(folder.bytes))[index.column()]
+        if role == Qt.ToolTipRole:
+            return folder.path
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return COLUMNS[section]
+        return None
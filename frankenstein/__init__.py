@@ -0,0 +1,29 @@
+"""
+The index behind Frankenstein, without any Qt.
+
+    schema      tables of the index and connections to it
+    walker      parallel directory walker
+    scanner     incremental scans of watched folders
+    query       filtering and sorting of indexed files
+    search      substring search over file names and folders
+    sequences   image sequence detection
+    pathlist    compact list of paths for big listings
+    tree        folder tree with the number of files and size of every folder
+    hashing     content hashes and duplicate files
+    imagemeta   image dimensions, channels and bit depth from file headers
+    waveform    waveform peaks, duration and sample rate of sound files
+    videoframes poster frames and scrub strips of video clips, through ffmpeg
+    modelmeta   vertex and triangle counts, bounds and textures of 3D models
+    similar     perceptual image hashes and nearest neighbour search over them
+    snapshot    compact read-only snapshots of the index and deltas between them
+    service     index service over HTTP or a Unix socket, one writer and a pool of readers
+    iosched     I/O scheduler shared by scans, background reads and previews
+    workers     process pool for the steps that read file contents
+    fswatch     inotify file system notifications
+    cli         the command line, python -m frankenstein
+
+The GUI (main.py) and the Qt threads around it import from here, nothing in
+here imports Qt or anything else slow to load. numpy is only imported by
+waveform, modelmeta, similar and snapshot, which the command line loads when
+it's needed.
+"""
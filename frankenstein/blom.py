@@ -0,0 +1,340 @@
+# Blom Version 0.002
+
+import functools
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+
+class timer:
+    """
+    Returns min elapsed since created.
+
+    format='s','sec','min','m'
+
+    Print using str(timer), timer.elapsed is the unrounded seconds
+    """
+
+    def __init__(self, format='s', rounder=3):
+        self.start = time.perf_counter()
+        self.rounder = rounder
+
+        if format == 'min' or format == 'm':
+            self._divider = 60
+            self._format_text = 'min'
+        elif format == 'sec' or format == 's':
+            self._divider = 1
+            self._format_text = 'sec'
+        else:
+            raise TypeError
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def __str__(self):
+        self.end = time.perf_counter()
+
+        self.duration = round((self.end - self.start) / self._divider, self.rounder)
+
+        return str(self.duration) + ' ' + self._format_text
+
+
+def init_logger(name, lvlstream=logging.INFO, lvlfile=logging.DEBUG):
+    filename = name + ".log"
+
+    logger = logging.getLogger(name)
+
+    # Add two handlers, one for screen, one for file
+    handler_stream = logging.StreamHandler(sys.stdout)
+    handler_file = logging.FileHandler(filename)
+
+    # Set format
+    formatter = logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler_stream.setFormatter(formatter)
+    handler_file.setFormatter(formatter)
+
+    # Setting level of logging
+    logger.setLevel(logging.DEBUG)
+    handler_stream.setLevel(lvlstream)
+    handler_file.setLevel(lvlfile)
+
+    # Adding handlers to logger
+    logger.addHandler(handler_stream)
+    logger.addHandler(handler_file)
+
+    return logger
+
+
+def get_logger(name):
+    logger = logging.getLogger(name)
+    return logger
+
+
+def format_bytes(size, rounder=1):
+    """Returns size in bytes as a human readable string, eg 1.5 GB"""
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if abs(size) < 1024 or unit == 'TB':
+            break
+        size /= 1024
+    return str(round(size, rounder)) + ' ' + unit
+
+
+# Tracing
+#
+# Spans time a block or a function on perf_counter_ns and nest per thread, every
+# finished span also goes into the latency histogram of its name. Counters count
+# anything else. All of it is off until enable() is called, a disabled span costs
+# a flag check.
+#
+#     blom.enable()
+#     with blom.span('scan', root=root) as s:
+#         ...
+#         s.set(files=n)
+#     blom.count('scan.files', n)
+#
+#     @blom.span('preview.decode')
+#     def decode_preview(path): ...
+#
+#     blom.export_chrome_trace('trace.json')   # chrome://tracing or ui.perfetto.dev
+
+# Finished spans kept for the trace, the oldest are dropped first
+MAX_SPANS = 200000
+
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+_ids = itertools.count(1)
+_spans = deque(maxlen=MAX_SPANS)
+_threads = {}
+_counters = {}
+_histograms = {}
+_started = time.perf_counter_ns()
+
+
+def enable(on=True):
+    """Turns tracing on or off, what was recorded is kept"""
+    global _enabled
+    _enabled = bool(on)
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    """Forgets every span, counter and histogram"""
+    global _started
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _histograms.clear()
+        _started = time.perf_counter_ns()
+
+
+def _bucket(ns):
+    """Every power of two split in four buckets, so a percentile is off by 25% at most"""
+    bits = ns.bit_length()
+    if bits < 3:
+        return ns
+    return 4 * (bits - 2) + ((ns >> (bits - 3)) & 3)
+
+
+def _bucket_top(index):
+    if index < 4:
+        return index
+    bits, part = divmod(index, 4)
+    return ((5 + part) << bits - 1) - 1
+
+
+class Histogram:
+    """Latencies in log scale nanosecond buckets, percentiles are the upper bound of their bucket"""
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+        self.buckets = {}
+
+    def add(self, ns):
+        self.count += 1
+        self.total += ns
+        self.min = ns if self.min is None or ns < self.min else self.min
+        self.max = ns if ns > self.max else self.max
+        index = _bucket(ns)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def percentile(self, q):
+        """Nanoseconds q (0-1) of the values are below"""
+        if not self.count:
+            return 0
+        wanted = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= wanted:
+                return max(min(_bucket_top(index), self.max), self.min)
+        return self.max
+
+    def summary(self):
+        """Milliseconds, rounded for reading"""
+        ms = lambda ns: round(ns / 1e6, 3)
+        return {'count': self.count, 'total_ms': ms(self.total), 'mean_ms': ms(self.total / self.count if self.count else 0),
+                'min_ms': ms(self.min or 0), 'p50_ms': ms(self.percentile(0.5)), 'p95_ms': ms(self.percentile(0.95)),
+                'p99_ms': ms(self.percentile(0.99)), 'max_ms': ms(self.max)}
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+def observe(name, ns):
+    """Adds a latency in nanoseconds to the histogram of name"""
+    if not _enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(ns)
+
+
+def count(name, n=1):
+    """Adds n to the counter name"""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+class span:
+    """
+    Times a with block, or every call when used as a decorator.
+
+    Keyword arguments end up in the trace, set() adds more while the span runs.
+    """
+    __slots__ = ('name', 'args', 'id', 'parent', 'start')
+
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+        self.start = 0
+
+    def set(self, **args):
+        self.args.update(args)
+        return self
+
+    def __enter__(self):
+        if _enabled:
+            stack = _stack()
+            self.parent = stack[-1] if stack else 0
+            self.id = next(_ids)
+            stack.append(self.id)
+            self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self.start:
+            return False
+        end = time.perf_counter_ns()
+        stack = _stack()
+        if stack and stack[-1] == self.id:
+            stack.pop()
+        duration = end - self.start
+        thread = threading.get_ident()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        with _lock:
+            if thread not in _threads:
+                _threads[thread] = threading.current_thread().name
+            _spans.append((self.name, self.id, self.parent, thread, self.start, duration, self.args or None))
+            histogram = _histograms.get(self.name)
+            if histogram is None:
+                histogram = _histograms[self.name] = Histogram()
+            histogram.add(duration)
+        self.start = 0
+        return False
+
+    def __call__(self, function):
+        name = self.name
+        args = self.args
+
+        @functools.wraps(function)
+        def traced(*a, **kw):
+            if not _enabled:
+                return function(*a, **kw)
+            with span(name, **args):
+                return function(*a, **kw)
+        return traced
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def histograms():
+    """Summary of the latencies of every span name, see Histogram.summary"""
+    with _lock:
+        return {name: histogram.summary() for name, histogram in sorted(_histograms.items())}
+
+
+def span_tree():
+    """Recorded spans nested by parent, spans whose parent was dropped are roots"""
+    with _lock:
+        spans = list(_spans)
+    nodes = {}
+    roots = []
+    for name, span_id, parent, thread, start, duration, args in spans:
+        nodes[span_id] = {'name': name, 'thread': _threads.get(thread, thread),
+                          'start_ms': round((start - _started) / 1e6, 3), 'duration_ms': round(duration / 1e6, 3),
+                          'args': args, 'children': []}
+    # A parent finishes after its children so it's recorded later, link once all are known
+    for name, span_id, parent, thread, start, duration, args in spans:
+        if parent in nodes:
+            nodes[parent]['children'].append(nodes[span_id])
+        else:
+            roots.append(nodes[span_id])
+    for node in nodes.values():
+        node['children'].sort(key=lambda x: x['start_ms'])
+    roots.sort(key=lambda x: x['start_ms'])
+    return roots
+
+
+def export_json(path):
+    """Writes counters, histograms and the span tree to path"""
+    with open(path, 'w') as f:
+        json.dump({'counters': counters(), 'histograms': histograms(), 'spans': span_tree()}, f, indent=1,
+                  default=str)
+
+
+def export_chrome_trace(path):
+    """Writes the spans in the Chrome trace event format, open in chrome://tracing or ui.perfetto.dev"""
+    pid = os.getpid()
+    with _lock:
+        spans = list(_spans)
+        threads = dict(_threads)
+        totals = dict(_counters)
+    events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread, 'args': {'name': name}}
+              for thread, name in threads.items()]
+    for name, span_id, parent, thread, start, duration, args in spans:
+        event = {'name': name, 'ph': 'X', 'pid': pid, 'tid': thread, 'ts': (start - _started) / 1000,
+                 'dur': duration / 1000}
+        if args:
+            event['args'] = args
+        events.append(event)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'counters': totals}}, f,
+                  default=str)
@@ -0,0 +1,579 @@
+"""
+Command line interface, runs without Qt so scans can run from cron on the file server.
+
+    python -m frankenstein index /mnt/assets/textures
+    python -m frankenstein scan
+    python -m frankenstein query brick --ext png jpg --limit 20
+    python -m frankenstein query --root /mnt/assets/textures --order size --desc
+    python -m frankenstein query --ext exr --min-width 3840 --order resolution --desc
+    python -m frankenstein query --ext wav --max-duration 2 --order duration
+    python -m frankenstein query --ext obj ply --max-tris 50k --order triangles
+    python -m frankenstein model /mnt/assets/models/chair.obj
+    python -m frankenstein similar /mnt/assets/textures/brick_01.jpg
+    python -m frankenstein tree /mnt/assets/textures --depth 2 --ext
+    python -m frankenstein stats
+    python -m frankenstein dupes --root /mnt/assets/hdri
+    python -m frankenstein --trace scan.json scan --full
+    python -m frankenstein export /mnt/share/index/today.snap --base yesterday.snap --delta today.delta
+    python -m frankenstein import /mnt/share/index/today.delta
+    python -m frankenstein query --snapshot /mnt/share/index/today.snap --ext exr --min-width 3840
+    python -m frankenstein serve --port 8765
+
+Modules are imported by the command that needs them so query stays fast to start.
+"""
+import argparse
+import logging
+import os
+import sys
+from datetime import datetime
+
+from . import blom
+from . import schema
+from .blom import format_bytes, timer
+
+DATABASE_PATH = 'database.db'
+
+# Changed rows committed per transaction while scanning
+BATCH_SIZE = 5000
+
+_SIZE_UNITS = {'': 1, 'b': 1, 'k': 1024, 'kb': 1024, 'm': 1024 ** 2, 'mb': 1024 ** 2, 'g': 1024 ** 3,
+               'gb': 1024 ** 3, 't': 1024 ** 4, 'tb': 1024 ** 4}
+
+
+def parse_size(text: str) -> int:
+    """Bytes of sizes like 2048, 500kb or 1.5G"""
+    text = text.strip().lower()
+    number = text.rstrip('kmgtb')
+    unit = text[len(number):]
+    if unit not in _SIZE_UNITS:
+        raise argparse.ArgumentTypeError(f'Unknown size {text}')
+    try:
+        return int(float(number) * _SIZE_UNITS[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Unknown size {text}')
+
+
+def parse_count(text: str) -> int:
+    """Counts like 50000, 50k or 1.5m"""
+    from . import query
+
+    try:
+        return query.parse_count(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Unknown count {text}')
+
+
+def parse_time(text: str) -> float:
+    """Unix timestamp of an ISO date like 2021-06-01 or 2021-06-01T12:00"""
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Unknown date {text}, use YYYY-MM-DD')
+
+
+def _root(db, path):
+    """The watched folder as stored in the index, a path given on the command line may differ in form"""
+    if schema.root_id(db, path) is not None:
+        return path
+    absolute = os.path.abspath(path)
+    if schema.root_id(db, absolute) is not None:
+        return absolute
+    return None
+
+
+def _open(args, create=False):
+    if not create and not os.path.exists(args.db):
+        print(f'No index at {args.db}, add a folder with: python -m frankenstein index PATH', file=sys.stderr)
+        return None
+    db = schema.connect(args.db)
+    schema.ensure_schema(db)
+    return db
+
+
+def _scan(db, roots, incremental, workers, meta=True):
+    from . import imagemeta
+    from . import modelmeta
+    from . import scanner
+    from . import videoframes
+    from . import waveform
+    from .walker import DEFAULT_WORKERS
+
+    # What is read from the contents of new and changed files after a scan
+    stages = [(imagemeta.update, 'read {} image headers'), (waveform.update, 'computed {} waveforms'),
+              (videoframes.update, 'extracted frames of {} video clips'), (modelmeta.update, 'read {} 3D models')]
+    workers = workers or DEFAULT_WORKERS
+    for root in roots:
+        timer_scan = timer()
+        stats = scanner.scan_root(db, root, incremental, workers, BATCH_SIZE)
+        print(f'{root}: {stats.inserted} new, {stats.updated} changed, {stats.deleted} removed, '
+              f'{stats.dirs_listed} directories listed in {timer_scan}')
+        if meta:
+            for update, message in stages:
+                timer_stage = timer()
+                read = update(db, root)
+                if read:
+                    print(f'{root}: {message.format(read)} in {timer_stage}')
+
+
+def _hash(db, root, readers):
+    from . import hashing
+
+    timer_hash = timer()
+    stats = hashing.update(db, root, readers or hashing.DEFAULT_READERS)
+    print(f'Hashed {stats.sampled} samples and {stats.hashed} whole files, read {format_bytes(stats.bytes_read)} '
+          f'in {timer_hash}' + (f', {stats.errors} could not be read' if stats.errors else ''))
+
+
+def cmd_index(args):
+    from . import scanner
+
+    db = _open(args, create=True)
+    roots = []
+    for path in args.roots:
+        if not os.path.isdir(path):
+            print(f'{path} is not a directory', file=sys.stderr)
+            return 1
+        root = _root(db, path) or os.path.abspath(path)
+        scanner.ensure_tables(db, root)
+        roots.append(root)
+    _scan(db, roots, incremental=False, workers=args.workers, meta=not args.no_meta)
+    if args.hash:
+        _hash(db, None, args.readers)
+    return 0
+
+
+def cmd_scan(args):
+    db = _open(args)
+    if db is None:
+        return 1
+    if args.roots:
+        roots = []
+        for path in args.roots:
+            root = _root(db, path)
+            if root is None:
+                print(f'{path} is not a watched folder, add it with index', file=sys.stderr)
+                return 1
+            roots.append(root)
+    else:
+        roots = schema.get_roots(db)
+    _scan(db, roots, incremental=not args.full, workers=args.workers, meta=not args.no_meta)
+    if args.hash:
+        _hash(db, None, args.readers)
+    return 0
+
+
+def cmd_query(args):
+    from . import query
+
+    if args.snapshot:
+        return _query_snapshot(args)
+    db = _open(args)
+    if db is None:
+        return 1
+    root = None
+    if args.root is not None:
+        root = _root(db, args.root)
+        if root is None:
+            print(f'{args.root} is not a watched folder', file=sys.stderr)
+            return 1
+    extensions = query.parse_extensions(' '.join(args.ext or ()))
+    text = ' '.join(args.text)
+    meta_filters = _meta_filters(args)
+
+    if text or args.group:
+        if any(x is not None for x in (args.min_size, args.max_size, args.after, args.before,
+                                       *meta_filters.values())):
+            print('Size, date, image, sound and model filters only work without search text and --group', file=sys.stderr)
+            return 1
+
+    if text:
+        from . import search
+
+        if args.count:
+            print(search.count(db, text, root, extensions))
+            return 0
+        pages = search.pages(db, text, root, extensions)
+        if args.group:
+            from . import sequences
+
+            pages = [sequences.combined([x for page in pages for x in page])]
+    elif args.group:
+        from . import sequences
+
+        if root is None:
+            print('--group needs --root', file=sys.stderr)
+            return 1
+        if args.count:
+            print(sequences.indexed_count(db, root, extensions))
+            return 0
+        pages = sequences.indexed_pages(db, root, extensions)
+    else:
+        files = query.FileQuery(root, extensions, args.min_size, args.max_size, args.after, args.before,
+                                order=args.order, descending=args.desc, **meta_filters)
+        if args.count:
+            print(files.count(db))
+            return 0
+        pages = files.pages(db)
+
+    _print_pages(pages, args.limit)
+    return 0
+
+
+def _meta_filters(args):
+    return {'min_width': args.min_width, 'min_height': args.min_height, 'channels': args.channels,
+            'bits': args.bits, 'min_duration': args.min_duration, 'max_duration': args.max_duration,
+            'min_triangles': args.min_tris, 'max_triangles': args.max_tris}
+
+
+def _print_pages(pages, limit):
+    shown = 0
+    out = sys.stdout
+    for page in pages:
+        if limit is not None:
+            page = page[:limit - shown]
+        out.write('\n'.join(page) + '\n' if page else '')
+        shown += len(page)
+        if limit is not None and shown >= limit:
+            break
+
+
+def _query_snapshot(args):
+    """query straight on a snapshot file, without an index"""
+    from . import query
+    from . import snapshot
+
+    if args.text or args.group:
+        print('Search text and --group only work on the index, import the snapshot first', file=sys.stderr)
+        return 1
+    try:
+        opened = snapshot.Snapshot(args.snapshot)
+    except (OSError, snapshot.SnapshotError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    with opened:
+        root = None
+        if args.root is not None:
+            root = args.root if args.root in opened.roots else os.path.abspath(args.root)
+            if root not in opened.roots:
+                print(f'{args.root} is not in {args.snapshot}', file=sys.stderr)
+                return 1
+        files = query.FileQuery(root, query.parse_extensions(' '.join(args.ext or ())), args.min_size,
+                                args.max_size, args.after, args.before, order=args.order, descending=args.desc,
+                                **_meta_filters(args))
+        positions = opened.select(files)
+        if args.count:
+            print(len(positions))
+            return 0
+        if args.limit is not None:
+            positions = positions[:args.limit]
+        _print_pages((opened.paths(positions[x:x + query.PAGE_SIZE])
+                      for x in range(0, len(positions), query.PAGE_SIZE)), None)
+    return 0
+
+
+def cmd_stats(args):
+    db = _open(args)
+    if db is None:
+        return 1
+    total = schema.RootStats('total', 0, 0, 0, 0)
+    for stats in schema.root_stats(db):
+        print(f'{stats.path}\n    {stats.files} files, {stats.directories} directories, '
+              f'{format_bytes(stats.bytes)}, {stats.sequences} image sequences')
+        total = schema.RootStats('total', *(a + b for a, b in zip(total[1:], stats[1:])))
+    print(f'{total.files} files in {format_bytes(total.bytes)}, index is {format_bytes(os.path.getsize(args.db))}')
+    return 0
+
+
+def cmd_model(args):
+    from . import modelmeta
+
+    db = _open(args)
+    if db is None:
+        return 1
+    missing = 0
+    for path in args.paths:
+        info = modelmeta.model(db, os.path.abspath(path))
+        if info is None:
+            print(f'{path}: no model data, not scanned yet or not a model that could be read', file=sys.stderr)
+            missing += 1
+            continue
+        print(f'{path}\n    {info.vertices} vertices, {info.triangles if info.triangles is not None else "?"} '
+              f'triangles, {info.polygons} polygons')
+        if info.bounds is not None:
+            low, high = info.bounds[:3], info.bounds[3:]
+            print(f'    bounds {" ".join(f"{x:g}" for x in low)} to {" ".join(f"{x:g}" for x in high)}, '
+                  f'size {" x ".join(f"{b - a:g}" for a, b in zip(low, high))}')
+        for texture in info.textures:
+            print(f'    texture {texture}' + ('' if os.path.exists(texture) else ' (missing)'))
+    return 1 if missing else 0
+
+
+def cmd_similar(args):
+    from . import similar
+
+    db = _open(args)
+    if db is None:
+        return 1
+    path = os.path.abspath(args.path)
+    file_id = similar.file_id(db, path)
+    value = similar.file_hash(db, file_id) if file_id is not None else None
+    if value is None:
+        print(f'{args.path}: no image hash, its thumbnail has not been made yet', file=sys.stderr)
+        return 1
+    found = similar.SimilarityIndex.load(db).nearest(value, args.limit, args.max_distance, exclude=file_id)
+    for (file_id, distance), other in zip(found, similar.paths(db, [x for x, distance in found])):
+        print(f'{distance:3} {other}')
+    return 0
+
+
+def cmd_tree(args):
+    from . import tree
+
+    db = _open(args)
+    if db is None:
+        return 1
+    roots = [args.path] if args.path else schema.get_roots(db)
+    tops = []
+    for path in roots:
+        top = tree.folder_at(db, os.path.abspath(path))
+        if top is None:
+            print(f'{path}: not an indexed folder', file=sys.stderr)
+            return 1
+        tops.append(top)
+
+    def show(folder, depth):
+        print(f'{"    " * depth}{folder.name if depth else folder.path}  {folder.files} files, '
+              f'{format_bytes(folder.bytes)}')
+        if depth < args.depth:
+            for child in tree.children(db, folder.id):
+                show(child, depth + 1)
+
+    for top in tops:
+        show(top, 0)
+        if args.ext:
+            for ext, files, size in tree.extensions(db, top.id):
+                print(f'    .{ext or "(none)"}  {files} files, {format_bytes(size)}')
+    return 0
+
+
+def cmd_export(args):
+    from . import snapshot
+
+    db = _open(args)
+    if db is None:
+        return 1
+    if bool(args.base) != bool(args.delta):
+        print('--base and --delta go together', file=sys.stderr)
+        return 1
+    roots = []
+    for path in args.roots or ():
+        root = _root(db, path)
+        if root is None:
+            print(f'{path} is not a watched folder', file=sys.stderr)
+            return 1
+        roots.append(root)
+    try:
+        base = snapshot.Snapshot(args.base) if args.base else None
+    except (OSError, snapshot.SnapshotError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    snapshot.export(db, args.out, roots or None)
+    print(f'{args.out}: {format_bytes(os.path.getsize(args.out))}')
+    if base is not None:
+        with base, snapshot.Snapshot(args.out) as new:
+            try:
+                changes = snapshot.export_delta(base, new, args.delta)
+            except snapshot.SnapshotError as e:
+                print(e, file=sys.stderr)
+                return 1
+        print(f'{args.delta}: {changes} changed files since {args.base}, {format_bytes(os.path.getsize(args.delta))}')
+    return 0
+
+
+def cmd_import(args):
+    from . import snapshot
+
+    db = _open(args, create=True)
+    for path in args.snapshots:
+        timer_import = timer()
+        try:
+            stats = snapshot.apply(db, path)
+        except (OSError, snapshot.SnapshotError) as e:
+            print(e, file=sys.stderr)
+            return 1
+        print(f'{path}: {stats.inserted} new, {stats.updated} changed, {stats.deleted} removed, '
+              f'{stats.dirs_listed - stats.dirs_skipped} directories changed in {timer_import}')
+    return 0
+
+
+def cmd_serve(args):
+    from . import imagemeta
+    from . import modelmeta
+    from . import service
+    from . import videoframes
+    from . import waveform
+
+    _open(args, create=True)
+    stages = [] if args.no_meta else [imagemeta.update, waveform.update, videoframes.update, modelmeta.update]
+    index = service.IndexService(args.db, args.readers, stages)
+    try:
+        address = index.listen(args.host, args.port, args.socket)
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(f'Serving {args.db} on ' + (f'unix:{address}' if args.socket else f'http://{address[0]}:{address[1]}'))
+    try:
+        index.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def _print_latencies():
+    """Latency summary of every span to stderr"""
+    print(f'{"span":<24} {"count":>8} {"total ms":>10} {"p50 ms":>9} {"p95 ms":>9} {"max ms":>9}', file=sys.stderr)
+    for name, summary in blom.histograms().items():
+        print(f'{name:<24} {summary["count"]:8} {summary["total_ms"]:10.1f} {summary["p50_ms"]:9.3f} '
+              f'{summary["p95_ms"]:9.3f} {summary["max_ms"]:9.3f}', file=sys.stderr)
+    for name, value in sorted(blom.counters().items()):
+        print(f'{name:<24} {value:8}', file=sys.stderr)
+
+
+def cmd_dupes(args):
+    from . import hashing
+
+    db = _open(args)
+    if db is None:
+        return 1
+    root = None
+    if args.root is not None:
+        root = _root(db, args.root)
+        if root is None:
+            print(f'{args.root} is not a watched folder', file=sys.stderr)
+            return 1
+    if not args.no_hash:
+        _hash(db, root, args.readers)
+    groups = hashing.duplicates(db, root)
+    for group in groups[:args.limit]:
+        print(f'{group.copies} copies of {format_bytes(group.size)}, {format_bytes(group.reclaimable)} reclaimable')
+        for path in group.paths:
+            print(f'    {path}')
+    print(f'{len(groups)} sets of copies, {format_bytes(sum(x.reclaimable for x in groups))} reclaimable')
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='frankenstein', description='Index and search asset folders.')
+    parser.add_argument('--db', default=DATABASE_PATH, help=f'index file (default {DATABASE_PATH})')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log what is going on to stderr')
+    parser.add_argument('--trace', metavar='FILE', help='write a Chrome trace of the command to FILE and print '
+                                                        'latencies to stderr')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    index = commands.add_parser('index', help='add folders to the watched folders and scan them')
+    index.add_argument('roots', nargs='+', metavar='ROOT')
+    index.add_argument('--workers', type=int, help='directories listed at the same time')
+    index.add_argument('--hash', action='store_true', help='hash files that may be copies, see dupes')
+    index.add_argument('--no-meta', action='store_true', help="don't read the contents of new files after scanning")
+    index.add_argument('--readers', type=int, help='files read at the same time while hashing')
+    index.set_defaults(run=cmd_index)
+
+    scan = commands.add_parser('scan', help='rescan watched folders, all of them by default')
+    scan.add_argument('roots', nargs='*', metavar='ROOT')
+    scan.add_argument('--full', action='store_true', help='list every directory, also unchanged ones')
+    scan.add_argument('--workers', type=int, help='directories listed at the same time')
+    scan.add_argument('--hash', action='store_true', help='hash files that may be copies, see dupes')
+    scan.add_argument('--no-meta', action='store_true', help="don't read the contents of new files after scanning")
+    scan.add_argument('--readers', type=int, help='files read at the same time while hashing')
+    scan.set_defaults(run=cmd_scan)
+
+    query = commands.add_parser('query', help='list or search indexed files')
+    query.add_argument('text', nargs='*', help='words to search for in file names and folders')
+    query.add_argument('--root', help='only this watched folder')
+    query.add_argument('--ext', nargs='+', help='file types, eg png jpg exr')
+    query.add_argument('--min-size', type=parse_size, help='eg 10mb')
+    query.add_argument('--max-size', type=parse_size)
+    query.add_argument('--after', type=parse_time, help='modified after, YYYY-MM-DD')
+    query.add_argument('--before', type=parse_time, help='modified before, YYYY-MM-DD')
+    query.add_argument('--min-width', type=int, help='images at least this many pixels wide, eg 3840')
+    query.add_argument('--min-height', type=int)
+    query.add_argument('--channels', type=int, help='images with this many channels, eg 4 for RGBA')
+    query.add_argument('--bits', type=int, help='images with this bit depth per channel, eg 16')
+    query.add_argument('--min-duration', type=float, help='sounds and clips at least this many seconds long')
+    query.add_argument('--max-duration', type=float, help='sounds and clips at most this many seconds long, eg 2')
+    query.add_argument('--min-tris', type=parse_count, help='models with at least this many triangles')
+    query.add_argument('--max-tris', type=parse_count, help='models with at most this many triangles, eg 50k')
+    query.add_argument('--order', choices=['path', 'name', 'size', 'mtime', 'resolution', 'duration', 'triangles'])
+    query.add_argument('--desc', action='store_true', help='reverse the order')
+    query.add_argument('--group', action='store_true', help='show image sequences as one entry')
+    query.add_argument('--limit', type=int)
+    query.add_argument('--count', action='store_true', help='only print the number of files')
+    query.add_argument('--snapshot', metavar='FILE', help='query a snapshot file instead of the index')
+    query.set_defaults(run=cmd_query)
+
+    stats = commands.add_parser('stats', help='what is indexed')
+    stats.set_defaults(run=cmd_stats)
+
+    dupes = commands.add_parser('dupes', help='files with identical content and the space they take')
+    dupes.add_argument('--root', help='only copies of files in this watched folder')
+    dupes.add_argument('--limit', type=int, help='show the first LIMIT files with the most reclaimable space')
+    dupes.add_argument('--no-hash', action='store_true', help='only report what was hashed before')
+    dupes.add_argument('--readers', type=int, help='files read at the same time')
+    dupes.set_defaults(run=cmd_dupes)
+
+    model = commands.add_parser('model', help='vertices, triangles, bounds and textures of indexed 3D models')
+    model.add_argument('paths', nargs='+', metavar='PATH')
+    model.set_defaults(run=cmd_model)
+
+    similar = commands.add_parser('similar', help='images that look like an indexed image, nearest first')
+    similar.add_argument('path', metavar='PATH')
+    similar.add_argument('--limit', type=int, default=20)
+    similar.add_argument('--max-distance', type=int, default=12,
+                         help='bits the image hashes may differ in, 0 to 64 (default 12)')
+    similar.set_defaults(run=cmd_similar)
+
+    folders = commands.add_parser('tree', help='indexed folders with their number of files and size')
+    folders.add_argument('path', nargs='?', metavar='PATH', help='watched folder or a folder below it, '
+                                                                  'every watched folder by default')
+    folders.add_argument('--depth', type=int, default=1, help='levels of subfolders to show (default 1)')
+    folders.add_argument('--ext', action='store_true', help='files and size per extension')
+    folders.set_defaults(run=cmd_tree)
+
+    export = commands.add_parser('export', help='write a compact read-only snapshot of the index for workstations')
+    export.add_argument('out', metavar='OUT')
+    export.add_argument('--root', dest='roots', nargs='+', metavar='ROOT',
+                        help='only these watched folders, all of them by default')
+    export.add_argument('--base', metavar='SNAPSHOT', help='earlier snapshot to write the changes since to --delta')
+    export.add_argument('--delta', metavar='FILE')
+    export.set_defaults(run=cmd_export)
+
+    load = commands.add_parser('import', help='bring the index up to date with snapshots or deltas, in order')
+    load.add_argument('snapshots', nargs='+', metavar='SNAPSHOT')
+    load.set_defaults(run=cmd_import)
+
+    serve = commands.add_parser('serve', help='answer queries and run scans for other machines and the GUI')
+    serve.add_argument('--host', default='127.0.0.1', help='address to listen on (default 127.0.0.1)')
+    serve.add_argument('--port', type=int, default=8765)
+    serve.add_argument('--socket', metavar='PATH', help='listen on a Unix socket instead')
+    serve.add_argument('--readers', type=int, default=8, help='queries answered at the same time (default 8)')
+    serve.add_argument('--no-meta', action='store_true', help="don't read the contents of new files after scanning")
+    serve.set_defaults(run=cmd_serve)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.verbose:
+        logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+                            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if args.trace:
+        blom.enable()
+    try:
+        return args.run(args)
+    except BrokenPipeError:
+        # Output piped into head and the like
+        return 0
+    finally:
+        if args.trace:
+            blom.export_chrome_trace(args.trace)
+            _print_latencies()
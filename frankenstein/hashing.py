@@ -0,0 +1,235 @@
+"""
+Content hashes of indexed files to find copies of the same asset.
+
+Reading every file of a library over the network to hash it would take days, so
+hashing narrows things down in steps:
+
+    1. only files whose size is shared with another indexed file can be copies
+    2. of those a sample (head, middle and tail) is hashed
+    3. files whose size and sample match another file are hashed completely
+
+Files up to three samples long are hashed completely in step 2. Hashes are
+stored in the hashes table and stay valid until the file's size or mtime
+changes, so running update again only reads new and changed files.
+
+Reading happens in a pool of worker processes (see workers.py), each reads one
+file at a time so readers is the number of files read from the NAS at once.
+
+    hashing.update(db)
+    for group in hashing.duplicates(db):
+        print(group.paths, format_bytes(group.reclaimable))
+"""
+import hashlib
+import os
+from collections import namedtuple
+
+from . import schema
+from . import workers
+from .blom import count, get_logger, span, timer
+
+l = get_logger('frankenstein.hashing')
+
+# Files read at the same time
+DEFAULT_READERS = 4
+
+# Bytes hashed at the start, middle and end of a file for its sample
+SAMPLE_BYTES = 64 * 1024
+# Bytes per read while hashing whole files
+CHUNK_BYTES = 1024 * 1024
+
+# Empty files are all the same, don't report them
+MIN_SIZE = 1
+
+# Files per task while sampling, whole files are one task each
+SAMPLE_BATCH = 64
+
+# Hashes written per transaction
+WRITE_BATCH = 500
+
+HashStats = namedtuple('HashStats', 'sampled hashed bytes_read errors')
+
+
+class DuplicateGroup(namedtuple('DuplicateGroup', 'size digest paths')):
+    """Files with the same content, paths sorted"""
+    __slots__ = ()
+
+    @property
+    def copies(self) -> int:
+        return len(self.paths)
+
+    @property
+    def reclaimable(self) -> int:
+        """Bytes freed by keeping a single copy"""
+        return self.size * (len(self.paths) - 1)
+
+
+def _new_hash(size, digest_size=32):
+    # blake2b hashes faster than the network delivers, the size is part of every hash
+    return hashlib.blake2b(size.to_bytes(8, 'little'), digest_size=digest_size)
+
+
+def full_hash(path, size):
+    """Hash of the whole file and the bytes read"""
+    digest = _new_hash(size)
+    read = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_BYTES)
+            if not chunk:
+                break
+            digest.update(chunk)
+            read += len(chunk)
+    return digest.digest(), read
+
+
+def sample_hash(path, size):
+    """
+    Returns (sample, full, bytes read) of a file.
+
+    full is only set for files small enough to be read completely, then sample is the same hash.
+    """
+    if size <= 3 * SAMPLE_BYTES:
+        digest, read = full_hash(path, size)
+        return digest, digest, read
+    digest = _new_hash(size, 16)
+    with open(path, 'rb') as f:
+        for offset in (0, (size - SAMPLE_BYTES) // 2, size - SAMPLE_BYTES):
+            f.seek(offset)
+            digest.update(f.read(SAMPLE_BYTES))
+    return digest.digest(), None, 3 * SAMPLE_BYTES
+
+
+def _sample_many(items):
+    """Runs in the worker processes, unreadable files come back with sample None"""
+    results = []
+    for file_id, path, size, mtime in items:
+        try:
+            results.append((file_id, size, mtime) + sample_hash(path, size))
+        except OSError:
+            results.append((file_id, size, mtime, None, None, 0))
+    return results
+
+
+def _full_many(items):
+    results = []
+    for file_id, path, size, mtime in items:
+        try:
+            results.append((file_id, size, mtime) + full_hash(path, size))
+        except OSError:
+            results.append((file_id, size, mtime, None, 0))
+    return results
+
+
+def _in_root(db, root, column):
+    """HAVING condition keeping groups with a file in root, groups are kept whole"""
+    if root is None:
+        return '', []
+    return f'AND sum({column} = ?) > 0', [schema.root_id(db, root)]
+
+
+def _sample_candidates(db, root=None):
+    """(file id, path, size, mtime) of files sharing their size with another file and not sampled yet"""
+    having, params = _in_root(db, root, 'root_id')
+    join = os.path.join
+    return [(file_id, join(folder, name), size, mtime) for file_id, folder, name, size, mtime in db.execute(
+        f'SELECT f.id, d.path, f.name, f.size, f.mtime FROM {schema.FILES} f '
+        f'JOIN {schema.DIRECTORIES} d ON d.id = f.dir_id '
+        f'WHERE f.size IN (SELECT size FROM {schema.FILES} WHERE size >= ? '
+        f'GROUP BY size HAVING count(*) > 1 {having}) '
+        f'AND NOT EXISTS (SELECT 1 FROM {schema.HASHES} h WHERE h.file_id = f.id) '
+        f'ORDER BY f.dir_id', [MIN_SIZE] + params)]
+
+
+def _full_candidates(db, root=None):
+    """Files whose size and sample match another file and that aren't hashed completely yet"""
+    having, params = _in_root(db, root, 'g.root_id')
+    join = os.path.join
+    return [(file_id, join(folder, name), size, mtime) for file_id, folder, name, size, mtime in db.execute(
+        f'SELECT f.id, d.path, f.name, f.size, f.mtime FROM {schema.HASHES} h '
+        f'JOIN {schema.FILES} f ON f.id = h.file_id JOIN {schema.DIRECTORIES} d ON d.id = f.dir_id '
+        f'WHERE h.full IS NULL AND (h.size, h.sample) IN '
+        f'(SELECT s.size, s.sample FROM {schema.HASHES} s JOIN {schema.FILES} g ON g.id = s.file_id '
+        f'WHERE s.sample IS NOT NULL GROUP BY s.size, s.sample HAVING count(*) > 1 {having}) '
+        f'ORDER BY f.dir_id', params)]
+
+
+def _write_samples(db, results):
+    # Only stored when the file still has the size and mtime it had when it was read
+    with db.conn:
+        db.conn.executemany(f'INSERT OR REPLACE INTO {schema.HASHES} (file_id, size, sample, full) '
+                            f'SELECT id, size, ?, ? FROM {schema.FILES} WHERE id = ? AND size = ? AND mtime IS ?',
+                            [(sample, full, file_id, size, mtime)
+                             for file_id, size, mtime, sample, full, read in results if sample is not None])
+
+
+def _write_full(db, results):
+    with db.conn:
+        db.conn.executemany(f'UPDATE {schema.HASHES} SET full = ? WHERE file_id = ? AND EXISTS '
+                            f'(SELECT 1 FROM {schema.FILES} WHERE id = ? AND size = ? AND mtime IS ?)',
+                            [(full, file_id, file_id, size, mtime)
+                             for file_id, size, mtime, full, read in results if full is not None])
+
+
+def update(db, root=None, readers=DEFAULT_READERS, cancel=None, progress=None) -> HashStats:
+    """
+    Hashes what's needed to find the copies among the indexed files.
+
+    root limits hashing to files that may be copies of a file in that watched
+    folder, wherever they are. progress(step, done, total) is called with step
+    'sample' and 'full', hashing stops when cancel (a threading.Event) is set.
+    """
+    timer_hash = timer()
+    stats = {'sampled': 0, 'hashed': 0, 'bytes_read': 0, 'errors': 0}
+    with workers.process_pool(readers) as pool:
+        for step, candidates, work, write, batch in (('sample', _sample_candidates, _sample_many, _write_samples,
+                                                      SAMPLE_BATCH),
+                                                     ('full', _full_candidates, _full_many, _write_full, 1)):
+            if cancel is not None and cancel.is_set():
+                break
+            with span(f'hash.{step}') as step_span:
+                items = candidates(db, root)
+                step_span.set(files=len(items))
+                l.info(f'Hashing {len(items)} files ({step})')
+                pending = []
+
+                def collect(results):
+                    pending.extend(results)
+                    stats['sampled' if step == 'sample' else 'hashed'] += len(results)
+                    stats['errors'] += sum(1 for x in results if x[3] is None)
+                    stats['bytes_read'] += sum(x[-1] for x in results)
+                    if len(pending) >= WRITE_BATCH:
+                        write(db, pending)
+                        pending.clear()
+
+                workers.run(pool, work, workers.batches(items, batch), readers, collect, cancel,
+                            None if progress is None else lambda done: progress(step, done, len(items)), root,
+                            None if step == 'sample' else workers.item_bytes)
+                write(db, pending)
+    count('hash.bytes_read', stats['bytes_read'])
+    l.info(f'Sampled {stats["sampled"]} and hashed {stats["hashed"]} files, read '
+           f'{stats["bytes_read"] / 1024 ** 2:.1f} MB in {timer_hash}')
+    return HashStats(**stats)
+
+
+def duplicates(db, root=None) -> list:
+    """DuplicateGroup of every set of identical files, most reclaimable space first"""
+    join = os.path.join
+    groups = {}
+    sizes = {}
+    # With a root, groups that have at least one file in it, with their files elsewhere
+    having, params = _in_root(db, root, 'g.root_id')
+    for digest, size, folder, name in db.execute(
+            f'SELECT h.full, h.size, d.path, f.name FROM {schema.HASHES} h '
+            f'JOIN {schema.FILES} f ON f.id = h.file_id JOIN {schema.DIRECTORIES} d ON d.id = f.dir_id '
+            f'WHERE h.full IN (SELECT s.full FROM {schema.HASHES} s JOIN {schema.FILES} g ON g.id = s.file_id '
+            f'WHERE s.full IS NOT NULL GROUP BY s.full HAVING count(*) > 1 {having})', params):
+        groups.setdefault(digest, []).append(join(folder, name))
+        sizes[digest] = size
+    found = [DuplicateGroup(sizes[digest], digest, sorted(paths)) for digest, paths in groups.items()]
+    found.sort(key=lambda x: (-x.reclaimable, x.paths[0]))
+    return found
+
+
+def reclaimable(db, root=None) -> int:
+    """Bytes freed by keeping one copy of every duplicated file"""
+    return sum(x.reclaimable for x in duplicates(db, root))
@@ -0,0 +1,279 @@
+"""
+Image dimensions, channels and bit depth read from file headers.
+
+Only the first bytes of a file are read, no pixels are decoded:
+
+    PNG   IHDR chunk
+    JPEG  SOF segment, after skipping the APP segments in front of it
+    TIFF  first IFD (classic and BigTIFF)
+    EXR   dataWindow and channels header attributes
+    HDR   Radiance resolution line
+
+The format is taken from the magic bytes, not the extension. update stores
+the result in the width, height, channels and bits columns of the files table
+for new and changed files, a pool of worker processes reads the headers (see
+workers.py). files.meta is NULL until a file was read, 1 when its header was
+understood and 0 when not. A file whose size or mtime changes is read again.
+
+    imagemeta.update(db)
+    FileQuery(extensions=['exr'], min_width=3840).paths(db)
+"""
+import os
+import struct
+from collections import namedtuple
+
+from . import schema
+from . import workers
+from .blom import count, get_logger, span, timer
+
+l = get_logger('frankenstein.imagemeta')
+
+ImageInfo = namedtuple('ImageInfo', 'width height channels bits')
+
+# Extensions whose headers are read, others are never opened
+EXTENSIONS = ['png', 'jpg', 'jpeg', 'tif', 'tiff', 'exr', 'hdr', 'pic']
+
+DEFAULT_PROCESSES = 4
+
+# Files per task
+BATCH = 64
+
+# Headers written per transaction
+WRITE_BATCH = 1000
+
+# Header bytes read at most, EXR headers with many channels or big attributes are the longest
+MAX_HEADER = 1024 * 1024
+
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+# Start of frame markers, the others in C0-CF are DHT, JPG and DAC
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# EXR pixel types UINT, HALF and FLOAT
+_EXR_BITS = {0: 32, 1: 16, 2: 32}
+
+
+def _png(f, head):
+    if head[12:16] != b'IHDR':
+        return None
+    width, height, bits, color_type = struct.unpack('>IIBB', head[16:26])
+    # Palette images are indices into 8 bit RGB
+    return ImageInfo(width, height, _PNG_CHANNELS.get(color_type), 8 if color_type == 3 else bits)
+
+
+def _jpeg(f, head):
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b'\xff':
+            continue
+        marker = f.read(1)
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker in _JPEG_SOF:
+            length, bits, height, width, channels = struct.unpack('>HBHHB', f.read(8))
+            return ImageInfo(width, height, channels, bits)
+        if marker in (0xD9, 0xDA):
+            # End of image or start of the scan before any frame header
+            return None
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            continue
+        length = struct.unpack('>H', f.read(2))[0]
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def _tiff(f, head):
+    order = '<' if head[:2] == b'II' else '>'
+    version = struct.unpack(order + 'H', head[2:4])[0]
+    if version == 42:
+        offset = struct.unpack(order + 'I', head[4:8])[0]
+        count_format, entry_format, entry_size = 'H', 'HHI4s', 12
+    elif version == 43:
+        offset = struct.unpack(order + 'Q', head[8:16])[0]
+        count_format, entry_format, entry_size = 'Q', 'HHQ8s', 20
+    else:
+        return None
+    f.seek(offset)
+    size = struct.calcsize(order + count_format)
+    entries = struct.unpack(order + count_format, f.read(size))[0]
+    data = f.read(entries * entry_size)
+    tags = {}
+    for index in range(min(entries, len(data) // entry_size)):
+        tag, kind, values, value = struct.unpack(order + entry_format,
+                                                 data[index * entry_size:(index + 1) * entry_size])
+        if tag not in (256, 257, 258, 277):
+            continue
+        # SHORT, LONG or LONG8, only the first value is needed
+        value_format = {3: 'H', 4: 'I', 16: 'Q'}.get(kind)
+        if value_format is None:
+            continue
+        value_size = struct.calcsize(value_format)
+        if values * value_size > len(value):
+            # Doesn't fit in the entry, the field is an offset to the values
+            position = f.tell()
+            f.seek(struct.unpack(order + ('I' if entry_size == 12 else 'Q'), value)[0])
+            value = f.read(value_size)
+            f.seek(position)
+        tags[tag] = struct.unpack(order + value_format, value[:value_size])[0]
+    if 256 not in tags or 257 not in tags:
+        return None
+    return ImageInfo(tags[256], tags[257], tags.get(277, 1), tags.get(258, 1))
+
+
+def _exr(f, head):
+    f.seek(8)
+    header = f.read(64 * 1024)
+    position = 0
+    width = height = None
+    channels = []
+
+    def until_null():
+        nonlocal header, position
+        end = header.find(b'\0', position)
+        while end < 0 and len(header) < MAX_HEADER:
+            more = f.read(64 * 1024)
+            if not more:
+                raise ValueError('Truncated EXR header')
+            header += more
+            end = header.find(b'\0', position)
+        if end < 0:
+            raise ValueError('EXR header too long')
+        text = header[position:end]
+        position = end + 1
+        return text
+
+    while True:
+        name = until_null()
+        if not name:
+            break
+        kind = until_null()
+        size = struct.unpack('<i', header[position:position + 4])[0]
+        position += 4
+        while len(header) < position + size and len(header) < MAX_HEADER:
+            more = f.read(64 * 1024)
+            if not more:
+                raise ValueError('Truncated EXR header')
+            header += more
+        value = header[position:position + size]
+        position += size
+        if name == b'dataWindow' and kind == b'box2i':
+            x_min, y_min, x_max, y_max = struct.unpack('<iiii', value[:16])
+            width, height = x_max - x_min + 1, y_max - y_min + 1
+        elif name == b'channels' and kind == b'chlist':
+            # name, pixel type, pLinear, 3 reserved, x and y sampling, until an empty name
+            at = 0
+            while at < len(value) and value[at] != 0:
+                end = value.index(b'\0', at)
+                channels.append(struct.unpack('<i', value[end + 1:end + 5])[0])
+                at = end + 17
+    if width is None:
+        return None
+    return ImageInfo(width, height, len(channels) or None, max((_EXR_BITS.get(x, 32) for x in channels),
+                                                                default=None))
+
+
+def _hdr(f, head):
+    f.seek(0)
+    header = f.read(64 * 1024)
+    end = header.find(b'\n\n')
+    if end < 0:
+        return None
+    line = header[end + 2:header.find(b'\n', end + 2)].split()
+    # eg -Y 1024 +X 2048, rotated images have X first
+    if len(line) != 4:
+        return None
+    sizes = {line[0][1:2]: int(line[1]), line[2][1:2]: int(line[3])}
+    if b'X' not in sizes or b'Y' not in sizes:
+        return None
+    # RGBE, 8 bit mantissas sharing an exponent hold 32 bit floats
+    return ImageInfo(sizes[b'X'], sizes[b'Y'], 3, 32)
+
+
+def read_info(path):
+    """ImageInfo from the header of path, None when the format isn't known or the header can't be read"""
+    with open(path, 'rb') as f:
+        head = f.read(32)
+        if head.startswith(b'\x89PNG\r\n\x1a\n'):
+            parse = _png
+        elif head.startswith(b'\xff\xd8'):
+            parse = _jpeg
+        elif head[:4] in (b'II*\0', b'MM\0*', b'II+\0', b'MM\0+'):
+            parse = _tiff
+        elif head.startswith(b'\x76\x2f\x31\x01'):
+            parse = _exr
+        elif head.startswith(b'#?'):
+            parse = _hdr
+        else:
+            return None
+        try:
+            return parse(f, head)
+        except (struct.error, ValueError, IndexError):
+            return None
+
+
+def _read_many(items):
+    """Runs in the worker processes, files that can't be opened come back as False to try them later"""
+    results = []
+    for file_id, path, size, mtime in items:
+        try:
+            info = read_info(path)
+        except OSError:
+            info = False
+        results.append((file_id, size, mtime, info))
+    return results
+
+
+def _candidates(db, root=None):
+    """(file id, path, size, mtime) of images whose header wasn't read since they last changed"""
+    clause = 'AND f.root_id = ?' if root is not None else ''
+    params = [schema.root_id(db, root)] if root is not None else []
+    join = os.path.join
+    return [(file_id, join(folder, name), size, mtime) for file_id, folder, name, size, mtime in db.execute(
+        f'SELECT f.id, d.path, f.name, f.size, f.mtime FROM {schema.FILES} f '
+        f'JOIN {schema.DIRECTORIES} d ON d.id = f.dir_id '
+        f'WHERE f.ext IN ({", ".join("?" * len(EXTENSIONS))}) AND f.meta IS NULL {clause} ORDER BY f.dir_id',
+        EXTENSIONS + params)]
+
+
+def _write(db, results):
+    # Only stored when the file still has the size and mtime it had when it was read
+    with db.conn:
+        db.conn.executemany(f'UPDATE {schema.FILES} SET width = ?, height = ?, channels = ?, bits = ?, meta = ? '
+                            f'WHERE id = ? AND size IS ? AND mtime IS ?',
+                            [(info.width, info.height, info.channels, info.bits, 1, file_id, size, mtime)
+                             if info is not None else (None, None, None, None, 0, file_id, size, mtime)
+                             for file_id, size, mtime, info in results if info is not False])
+
+
+def update(db, root=None, processes=DEFAULT_PROCESSES, cancel=None, progress=None) -> int:
+    """
+    Reads the headers of new and changed images and returns how many were read.
+
+    root limits it to one watched folder. progress(done, total) is called as
+    headers are written, reading stops when cancel (a threading.Event) is set.
+    """
+    timer_meta = timer()
+    items = _candidates(db, root)
+    if not items:
+        return 0
+    pending = []
+    unknown = 0
+
+    def collect(results):
+        nonlocal unknown
+        pending.extend(results)
+        unknown += sum(1 for x in results if x[3] is None)
+        if len(pending) >= WRITE_BATCH:
+            _write(db, pending)
+            pending.clear()
+
+    with span('meta.update', files=len(items)), workers.process_pool(processes) as pool:
+        done = workers.run(pool, _read_many, workers.batches(items, BATCH), processes, collect, cancel,
+                           None if progress is None else lambda done: progress(done, len(items)), root)
+        _write(db, pending)
+    count('meta.headers', done)
+    l.info(f'Read {done} image headers ({unknown} not understood) in {timer_meta}')
+    return done
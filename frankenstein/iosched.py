@@ -0,0 +1,239 @@
+"""
+I/O scheduler shared by everything that reads the watched folders.
+
+Scans, the steps that read file contents and the image viewer all go to the
+same NAS. Every directory listing and every batch of files read asks for a slot
+first, so a scan of everything can't make the preview of the clicked file wait:
+
+    with iosched.slot(root, iosched.BACKGROUND, cost=bytes_to_read):
+        ...
+
+There are three classes. INTERACTIVE is what the user waits for, the previews
+of the image viewer, and never waits for a slot. VISIBLE is background work of
+the watched folder that is selected (see focus), BACKGROUND everything else.
+Waiting requests get their slot by class, then in the order they asked, and the
+class of a waiting request changes as soon as another watched folder is
+selected. The limits are off until configure sets them (the command line runs
+alone and doesn't need them):
+
+    slots           non-interactive reads at the same time
+    busy_slots      the same while previews are being read and quiet seconds after
+    root_slots      non-interactive reads of one watched folder at the same time
+    root_bandwidth  bytes per second read from one watched folder, previews not limited but counted
+
+Slots are only counted in this process. The worker processes don't ask, the
+thread handing them their tasks does (see workers.run).
+"""
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from .blom import count, get_logger, span
+
+l = get_logger('frankenstein.iosched')
+
+INTERACTIVE = 0
+VISIBLE = 1
+BACKGROUND = 2
+CLASSES = ('interactive', 'visible', 'background')
+
+# Seconds non-interactive reads stay at busy_slots after the last preview was read
+DEFAULT_QUIET = 0.5
+# Seconds between two looks at the cancel event of a waiting request
+_CANCEL_POLL = 0.1
+
+
+class _Request:
+    __slots__ = ('root', 'priority', 'cost', 'order', 'granted')
+
+    def __init__(self, root, priority, cost, order):
+        self.root = root
+        self.priority = priority
+        self.cost = cost
+        self.order = order
+        self.granted = False
+
+
+class IOScheduler:
+    """Slots and bandwidth of the reads of one process, see the module docstring"""
+
+    def __init__(self, slots=None, busy_slots=None, root_slots=None, root_bandwidth=None, quiet=DEFAULT_QUIET):
+        self.slots = slots
+        self.busy_slots = busy_slots
+        self.root_slots = root_slots
+        self.root_bandwidth = root_bandwidth
+        self.quiet = quiet
+        self._condition = threading.Condition()
+        self._order = itertools.count()
+        self._waiting = []
+        # Non-interactive reads running, in total and per watched folder
+        self._running = 0
+        self._root_running = {}
+        self._interactive = 0
+        self._last_interactive = float('-inf')
+        self._focus = None
+        # root: [bytes that may be read, time they were counted]
+        self._buckets = {}
+        # Seconds until a waiting request may get its slot without another one finishing
+        self._retry = None
+
+    def configure(self, **limits):
+        """Sets slots, busy_slots, root_slots, root_bandwidth or quiet, None is no limit"""
+        with self._condition:
+            for name, value in limits.items():
+                if name not in ('slots', 'busy_slots', 'root_slots', 'root_bandwidth', 'quiet'):
+                    raise TypeError(f'Unknown limit {name}')
+                setattr(self, name, value)
+            self._dispatch()
+
+    def focus(self, root):
+        """Background reads of root are VISIBLE from now on, None when no watched folder is selected"""
+        with self._condition:
+            if root == self._focus:
+                return
+            self._focus = root
+            self._dispatch()
+        l.debug(f'Focus on {root}')
+
+    def _class(self, request):
+        if request.priority == BACKGROUND and request.root is not None and request.root == self._focus:
+            return VISIBLE
+        return request.priority
+
+    def _bucket(self, root, now):
+        """Bytes root may read now, negative when it read ahead"""
+        bucket = self._buckets.get(root)
+        if bucket is None:
+            bucket = self._buckets[root] = [self.root_bandwidth, now]
+        # At most a second of bandwidth saved up
+        bucket[0] = min(self.root_bandwidth, bucket[0] + (now - bucket[1]) * self.root_bandwidth)
+        bucket[1] = now
+        return bucket
+
+    def _dispatch(self):
+        """Hands out the slots that are free, call with the condition held"""
+        now = time.monotonic()
+        self._retry = None
+        limit = self.slots
+        idle = now - self._last_interactive
+        if self.busy_slots is not None and (self._interactive or idle < self.quiet):
+            limit = self.busy_slots if limit is None else min(limit, self.busy_slots)
+            if not self._interactive:
+                self._retry = self.quiet - idle
+        granted = False
+        for request in sorted(self._waiting, key=lambda x: (self._class(x), x.order)):
+            if limit is not None and self._running >= limit:
+                break
+            if self.root_slots is not None and self._root_running.get(request.root, 0) >= self.root_slots:
+                continue
+            if self.root_bandwidth:
+                bucket = self._bucket(request.root, now)
+                if bucket[0] <= 0:
+                    refill = -bucket[0] / self.root_bandwidth
+                    self._retry = refill if self._retry is None else min(self._retry, refill)
+                    continue
+                bucket[0] -= request.cost
+            self._waiting.remove(request)
+            request.granted = True
+            self._running += 1
+            self._root_running[request.root] = self._root_running.get(request.root, 0) + 1
+            granted = True
+        if granted:
+            self._condition.notify_all()
+
+    def acquire(self, root, priority=BACKGROUND, cost=0, cancel=None):
+        """
+        Waits for a slot to read cost bytes of root, returns what release takes.
+
+        Returns None without a slot when cancel (a threading.Event) is set while waiting.
+        """
+        with self._condition:
+            request = _Request(root, priority, cost, next(self._order))
+            if priority == INTERACTIVE:
+                self._interactive += 1
+                self._last_interactive = time.monotonic()
+                if self.root_bandwidth and root is not None:
+                    self._bucket(root, self._last_interactive)[0] -= cost
+                request.granted = True
+                count('io.interactive')
+                return request
+            self._waiting.append(request)
+            self._dispatch()
+            if request.granted:
+                count('io.granted')
+                return request
+            with span('io.wait', priority=CLASSES[priority]):
+                while not request.granted:
+                    if cancel is not None and cancel.is_set():
+                        self._waiting.remove(request)
+                        return None
+                    timeout = self._retry
+                    if cancel is not None:
+                        timeout = _CANCEL_POLL if timeout is None else min(timeout, _CANCEL_POLL)
+                    self._condition.wait(timeout)
+                    if not request.granted:
+                        self._dispatch()
+            count('io.granted')
+            count('io.waited')
+            return request
+
+    def release(self, request):
+        """Gives back the slot of acquire, a None request is ignored"""
+        if request is None:
+            return
+        with self._condition:
+            if request.priority == INTERACTIVE:
+                self._interactive -= 1
+                self._last_interactive = time.monotonic()
+            else:
+                self._running -= 1
+                self._root_running[request.root] -= 1
+                if not self._root_running[request.root]:
+                    del self._root_running[request.root]
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, root, priority=BACKGROUND, cost=0):
+        request = self.acquire(root, priority, cost)
+        try:
+            yield
+        finally:
+            self.release(request)
+
+    def status(self) -> dict:
+        """What is running and waiting, for the stats panel"""
+        with self._condition:
+            waiting = [0, 0, 0]
+            for request in self._waiting:
+                waiting[self._class(request)] += 1
+            return {'interactive': self._interactive, 'running': self._running, 'focus': self._focus,
+                    'waiting': dict(zip(CLASSES, waiting))}
+
+
+# Every reader of the process shares one
+_scheduler = IOScheduler()
+
+
+def scheduler() -> IOScheduler:
+    return _scheduler
+
+
+def configure(**limits):
+    _scheduler.configure(**limits)
+
+
+def focus(root):
+    _scheduler.focus(root)
+
+
+def acquire(root, priority=BACKGROUND, cost=0, cancel=None):
+    return _scheduler.acquire(root, priority, cost, cancel)
+
+
+def release(request):
+    _scheduler.release(request)
+
+
+def slot(root, priority=BACKGROUND, cost=0):
+    return _scheduler.slot(root, priority, cost)
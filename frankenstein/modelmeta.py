@@ -0,0 +1,401 @@
+"""
+Vertex and triangle counts, bounding boxes and textures of 3D models, without loading the meshes.
+
+    STL   triangle count from the binary header, vertex data memory mapped for the bounds
+    PLY   element counts from the header, vertex data memory mapped (binary) or read as columns (ASCII)
+    glTF  accessor counts and min/max of the JSON (.gltf) or the JSON chunk (.glb), buffers aren't read
+    OBJ   one buffered pass over the memory mapped file, textures from the map_ lines of its .mtl files
+
+update stores vertices and triangles in the files table, where they can be
+filtered and sorted on, and polygons, the bounding box and the referenced
+textures (absolute paths) in the models table. Like imagemeta.py it handles
+new and changed files in a pool of worker processes and sets files.meta.
+
+    modelmeta.update(db)
+    FileQuery(extensions=['obj', 'ply'], max_triangles=50000).paths(db)
+"""
+import json
+import mmap
+import os
+import re
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+from . import schema
+from . import workers
+from .blom import count, get_logger, span, timer
+
+l = get_logger('frankenstein.modelmeta')
+
+# polygons are faces as stored, triangles what they become split into triangles, bounds (min x, y, z, max x, y, z)
+ModelInfo = namedtuple('ModelInfo', 'vertices triangles polygons bounds textures')
+
+EXTENSIONS = ['stl', 'ply', 'obj', 'gltf', 'glb']
+
+DEFAULT_PROCESSES = 4
+BATCH = 8
+WRITE_BATCH = 500
+
+# Bytes of an OBJ or ASCII STL parsed at a time, split at a line end
+CHUNK = 16 * 1024 * 1024
+MAX_HEADER = 64 * 1024
+
+_OBJ_VERTEX = re.compile(rb'^v[ \t]+([^\r\n]*)', re.M)
+_OBJ_FACE = re.compile(rb'^f[ \t]+([^\r\n]*)', re.M)
+_XYZ = re.compile(rb'(\S+)[ \t]+(\S+)[ \t]+(\S+)')
+_OBJ_MTLLIB = re.compile(rb'^mtllib[ \t]+([^\r\n]+)', re.M)
+_MTL_MAP = re.compile(rb'^[ \t]*(?:map_\w+|bump|disp|decal|norm|refl)[ \t]+([^\r\n]+)', re.M | re.I)
+_STL_VERTEX = re.compile(rb'^[ \t]*vertex[ \t]+(\S+)[ \t]+(\S+)[ \t]+(\S+)', re.M)
+_STL_FACET = re.compile(rb'^[ \t]*facet\b', re.M)
+
+_PLY_TYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1', 'short': 'i2', 'int16': 'i2',
+              'ushort': 'u2', 'uint16': 'u2', 'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+              'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+# Vertices per element of the glTF primitive modes, triangles are counted for modes 4 to 6
+_GLTF_TRIANGLES = {4: lambda n: n // 3, 5: lambda n: max(0, n - 2), 6: lambda n: max(0, n - 2)}
+
+
+def _bounds(points):
+    """(min x, y, z, max x, y, z) of an (n, 3) array, None when it's empty"""
+    if not len(points):
+        return None
+    low, high = points.min(axis=0), points.max(axis=0)
+    return tuple(float(x) for x in low) + tuple(float(x) for x in high)
+
+
+def _merge(a, b):
+    if a is None or b is None:
+        return a or b
+    return tuple(min(x, y) for x, y in zip(a[:3], b[:3])) + tuple(max(x, y) for x, y in zip(a[3:], b[3:]))
+
+
+def _chunks(data):
+    """Slices of a buffer of about CHUNK bytes that end at a line end"""
+    position = 0
+    while position < len(data):
+        end = min(position + CHUNK, len(data))
+        if end < len(data):
+            newline = data.rfind(b'\n', position, end)
+            end = newline + 1 if newline >= 0 else end
+        yield data[position:end]
+        position = end
+
+
+def _mapped(f):
+    size = os.fstat(f.fileno()).st_size
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+
+def _points(matches):
+    return np.array(matches).astype(np.float64) if matches else np.zeros((0, 3))
+
+
+def _texture_path(folder, reference):
+    reference = reference.strip().strip('"').replace('\\', '/')
+    return os.path.normpath(os.path.join(folder, reference))
+
+
+def _mtl_textures(path):
+    textures = []
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return textures
+    folder = os.path.dirname(path)
+    for value in _MTL_MAP.findall(data):
+        # Options like -bm 0.5 come before the file name, which is last
+        words = value.decode('utf-8', 'replace').split()
+        if words:
+            textures.append(_texture_path(folder, words[-1]))
+    return textures
+
+
+def _obj_points(lines):
+    """(n, 3) positions of the v lines of an OBJ"""
+    if not lines:
+        return np.zeros((0, 3))
+    # All numbers at once, unless some vertices have a w or colors after x y z
+    numbers = np.fromstring(b' '.join(lines), sep=' ')
+    if len(numbers) == 3 * len(lines):
+        return numbers.reshape(-1, 3)
+    return _points([_XYZ.match(x).groups() for x in lines if _XYZ.match(x)])
+
+
+def _obj(path):
+    vertices = polygons = triangles = 0
+    bounds = None
+    libraries = []
+    with open(path, 'rb') as f:
+        data = _mapped(f)
+        try:
+            for chunk in _chunks(data):
+                points = _obj_points(_OBJ_VERTEX.findall(chunk))
+                vertices += len(points)
+                bounds = _merge(bounds, _bounds(points))
+                faces = _OBJ_FACE.findall(chunk)
+                # Every corner of a face is one word, a polygon of n corners is n - 2 triangles
+                polygons += len(faces)
+                triangles += len(b' '.join(faces).split()) - 2 * len(faces)
+                libraries.extend(x.decode('utf-8', 'replace').strip() for x in _OBJ_MTLLIB.findall(chunk))
+        finally:
+            if data:
+                data.close()
+    folder = os.path.dirname(path)
+    textures = []
+    for library in libraries:
+        textures.extend(x for x in _mtl_textures(_texture_path(folder, library)) if x not in textures)
+    return ModelInfo(vertices, triangles, polygons, bounds, textures)
+
+
+def _stl(path):
+    with open(path, 'rb') as f:
+        head = f.read(84)
+        size = os.fstat(f.fileno()).st_size
+        if len(head) == 84:
+            triangles = struct.unpack('<I', head[80:84])[0]
+            if size == 84 + 50 * triangles:
+                if not triangles:
+                    return ModelInfo(0, 0, 0, None, [])
+                # normal, 3 vertices and an attribute word per triangle
+                records = np.memmap(path, np.dtype([('normal', '<f4', 3), ('vertices', '<f4', (3, 3)),
+                                                    ('attribute', '<u2')]), 'r', 84, (triangles,))
+                return ModelInfo(3 * triangles, triangles, triangles, _bounds(records['vertices'].reshape(-1, 3)), [])
+        if not head.startswith(b'solid'):
+            return None
+        # ASCII STL
+        data = _mapped(f)
+        try:
+            vertices = triangles = 0
+            bounds = None
+            for chunk in _chunks(data):
+                points = _points(_STL_VERTEX.findall(chunk))
+                vertices += len(points)
+                bounds = _merge(bounds, _bounds(points))
+                triangles += len(_STL_FACET.findall(chunk))
+        finally:
+            if data:
+                data.close()
+        return ModelInfo(vertices, triangles, triangles, bounds, [])
+
+
+def _ply_header(f):
+    """(format, [(element, count, properties)], comments, data offset)"""
+    header = f.read(MAX_HEADER)
+    end = header.find(b'end_header')
+    if not header.startswith(b'ply') or end < 0:
+        return None
+    offset = header.index(b'\n', end) + 1
+    form, elements, comments = None, [], []
+    for line in header[:end].decode('ascii', 'replace').splitlines()[1:]:
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == 'format':
+            form = words[1]
+        elif words[0] == 'element':
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == 'property' and elements:
+            # A scalar is (type, name), a list (list, count type, item type, name)
+            elements[-1][2].append(tuple(words[1:]))
+        elif words[0] in ('comment', 'obj_info'):
+            comments.append(line.split(None, 1)[1] if len(words) > 1 else '')
+    return form, elements, comments, offset
+
+
+def _ply_dtype(properties, order):
+    """Numpy dtype of an element with only scalar properties, None when it has lists"""
+    if any(x[0] == 'list' for x in properties):
+        return None
+    return np.dtype([(name, order + _PLY_TYPES[kind]) for kind, name in properties])
+
+
+def _ply(path):
+    with open(path, 'rb') as f:
+        header = _ply_header(f)
+        size = os.fstat(f.fileno()).st_size
+    if header is None:
+        return None
+    form, elements, comments, offset = header
+    counts = {name: number for name, number, properties in elements}
+    vertices, polygons = counts.get('vertex', 0), counts.get('face', 0)
+    folder = os.path.dirname(path)
+    # TextureFile comments are written by photogrammetry tools and MeshLab
+    textures = [_texture_path(folder, x.split(None, 1)[1]) for x in comments
+                if x.lower().startswith('texturefile') and len(x.split(None, 1)) > 1]
+    bounds = triangles = None
+    if form == 'ascii':
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for name, number, properties in elements:
+                names = [x[-1] for x in properties]
+                if name == 'vertex' and number and all(x in names for x in 'xyz'):
+                    points = np.loadtxt(f, max_rows=number, usecols=[names.index(x) for x in 'xyz'], ndmin=2)
+                    bounds = _bounds(points)
+                elif name == 'face' and number and properties and properties[0][0] == 'list':
+                    # The first number of a face line is its number of corners
+                    corners = np.loadtxt(f, max_rows=number, usecols=[0], ndmin=1, dtype=np.int64)
+                    triangles = int(np.maximum(corners - 2, 0).sum())
+                else:
+                    # Elements before the ones read are skipped a line at a time
+                    for _ in range(number):
+                        f.readline()
+    elif form in ('binary_little_endian', 'binary_big_endian'):
+        order = '<' if form == 'binary_little_endian' else '>'
+        position = offset
+        for index, (name, number, properties) in enumerate(elements):
+            dtype = _ply_dtype(properties, order)
+            if name == 'vertex' and dtype is not None and number and all(x in dtype.names for x in 'xyz'):
+                data = np.memmap(path, dtype, 'r', position, (number,))
+                bounds = _bounds(np.stack([data['x'], data['y'], data['z']], axis=1))
+            elif name == 'face' and len(properties) == 1 and index == len(elements) - 1 and number:
+                # Faces of a list with a fixed number of corners fill the rest of the file exactly
+                kind, count_type, item_type = properties[0][:3]
+                count_size, item_size = int(_PLY_TYPES[count_type][1]), int(_PLY_TYPES[item_type][1])
+                for corners in (3, 4):
+                    if size - position == number * (count_size + corners * item_size):
+                        triangles = number * (corners - 2)
+            if dtype is None:
+                # Elements after one with lists can't be located without reading it
+                break
+            position += dtype.itemsize * number
+    else:
+        return None
+    return ModelInfo(vertices, triangles, polygons, bounds, textures)
+
+
+def _gltf_json(path):
+    with open(path, 'rb') as f:
+        head = f.read(20)
+        if head[:4] == b'glTF':
+            # 12 byte header, then the JSON chunk with its length and type
+            length, kind = struct.unpack('<I4s', head[12:20])
+            if kind != b'JSON':
+                return None
+            return json.loads(f.read(length))
+        f.seek(0)
+        return json.load(f)
+
+
+def _gltf(path):
+    document = _gltf_json(path)
+    if not isinstance(document, dict):
+        return None
+    accessors = document.get('accessors', [])
+    vertices = triangles = 0
+    bounds = None
+    for mesh in document.get('meshes', []):
+        for primitive in mesh.get('primitives', []):
+            position = primitive.get('attributes', {}).get('POSITION')
+            if position is None:
+                continue
+            accessor = accessors[position]
+            vertices += accessor.get('count', 0)
+            if 'min' in accessor and 'max' in accessor:
+                bounds = _merge(bounds, tuple(float(x) for x in accessor['min'][:3] + accessor['max'][:3]))
+            corners = accessors[primitive['indices']].get('count', 0) if 'indices' in primitive \
+                else accessor.get('count', 0)
+            triangles += _GLTF_TRIANGLES.get(primitive.get('mode', 4), lambda n: 0)(corners)
+    folder = os.path.dirname(path)
+    textures = [_texture_path(folder, x['uri']) for x in document.get('images', [])
+                if 'uri' in x and not x['uri'].startswith('data:')]
+    return ModelInfo(vertices, triangles, triangles, bounds, textures)
+
+
+_READERS = {'obj': _obj, 'stl': _stl, 'ply': _ply, 'gltf': _gltf, 'glb': _gltf}
+
+
+def read_info(path):
+    """ModelInfo of a model file, None when its format isn't known or it can't be parsed"""
+    read = _READERS.get(schema.extension(path))
+    if read is None:
+        return None
+    try:
+        return read(path)
+    except (struct.error, ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def _read_many(items):
+    """Runs in the worker processes, files that can't be opened come back as False to try them later"""
+    results = []
+    for file_id, path, size, mtime in items:
+        try:
+            info = read_info(path)
+        except OSError:
+            info = False
+        results.append((file_id, size, mtime, info))
+    return results
+
+
+def _candidates(db, root=None):
+    """(file id, path, size, mtime) of models that weren't read since they last changed"""
+    clause = 'AND f.root_id = ?' if root is not None else ''
+    params = [schema.root_id(db, root)] if root is not None else []
+    join = os.path.join
+    return [(file_id, join(folder, name), size, mtime) for file_id, folder, name, size, mtime in db.execute(
+        f'SELECT f.id, d.path, f.name, f.size, f.mtime FROM {schema.FILES} f '
+        f'JOIN {schema.DIRECTORIES} d ON d.id = f.dir_id '
+        f'WHERE f.ext IN ({", ".join("?" * len(EXTENSIONS))}) AND f.meta IS NULL {clause} ORDER BY f.dir_id',
+        EXTENSIONS + params)]
+
+
+def _write(db, results):
+    results = [x for x in results if x[3] is not False]
+    # Only stored when the file still has the size and mtime it had when it was read
+    with db.conn:
+        db.conn.executemany(f'UPDATE {schema.FILES} SET vertices = ?, triangles = ?, meta = ? '
+                            f'WHERE id = ? AND size IS ? AND mtime IS ?',
+                            [(info.vertices, info.triangles, 1, file_id, size, mtime) if info is not None
+                             else (None, None, 0, file_id, size, mtime) for file_id, size, mtime, info in results])
+        db.conn.executemany(f'INSERT OR REPLACE INTO {schema.MODELS} (file_id, polygons, min_x, min_y, min_z, '
+                            f'max_x, max_y, max_z, textures) SELECT ?, ?, ?, ?, ?, ?, ?, ?, ? FROM {schema.FILES} '
+                            f'WHERE id = ? AND size IS ? AND mtime IS ?',
+                            [(file_id, info.polygons, *(info.bounds or (None,) * 6), '\n'.join(info.textures),
+                              file_id, size, mtime) for file_id, size, mtime, info in results if info is not None])
+
+
+def model(db, path):
+    """ModelInfo of an indexed model as it was read, None when it wasn't read or isn't a model"""
+    row = db.execute(f'SELECT f.vertices, f.triangles, m.polygons, m.min_x, m.min_y, m.min_z, m.max_x, m.max_y, '
+                     f'm.max_z, m.textures FROM {schema.FILES} f JOIN {schema.DIRECTORIES} d ON d.id = f.dir_id '
+                     f'JOIN {schema.MODELS} m ON m.file_id = f.id WHERE d.path = ? AND f.name = ?',
+                     [os.path.dirname(path), os.path.basename(path)]).fetchone()
+    if row is None:
+        return None
+    bounds = tuple(row[3:9]) if row[3] is not None else None
+    return ModelInfo(row[0], row[1], row[2], bounds, row[9].split('\n') if row[9] else [])
+
+
+def update(db, root=None, processes=DEFAULT_PROCESSES, cancel=None, progress=None) -> int:
+    """
+    Reads new and changed models and returns how many were read.
+
+    root limits it to one watched folder. progress(done, total) is called as
+    models are written, reading stops when cancel (a threading.Event) is set.
+    """
+    timer_models = timer()
+    items = _candidates(db, root)
+    if not items:
+        return 0
+    pending = []
+    unknown = 0
+
+    def collect(results):
+        nonlocal unknown
+        pending.extend(results)
+        unknown += sum(1 for x in results if x[3] is None)
+        if len(pending) >= WRITE_BATCH:
+            _write(db, pending)
+            pending.clear()
+
+    with span('models.update', files=len(items)), workers.process_pool(processes) as pool:
+        done = workers.run(pool, _read_many, workers.batches(items, BATCH), processes, collect, cancel,
+                           None if progress is None else lambda done: progress(done, len(items)), root,
+                           workers.item_bytes)
+        _write(db, pending)
+    count('models.read', done)
+    l.info(f'Read {done} models ({unknown} not understood) in {timer_models}')
+    return done
@@ -0,0 +1,245 @@
+"""
+List of paths that doesn't keep a str per path.
+
+A listing of 5 million files as strs is gigabytes, most of it the same folders
+over and over. PathList keeps every folder once and per file a folder id, an
+extension id and its name front coded against the name before it (a sequence
+frame shares all but a few bytes with the previous one), about 10 bytes per
+file plus what its name doesn't share. A path is only made when it's asked for:
+
+    paths = FileQuery(root).paths(db)
+    paths[10], paths[-1], len(paths)
+    for path in paths.with_extensions(['exr'])[:100]:
+        ...
+    by_name = paths.sorted('name', reverse=True)
+
+Slicing, sorting and filtering return lists that share the folders and names
+and only have their own row numbers, 4 bytes per file.
+"""
+import os
+from array import array
+
+from . import query
+from . import schema
+
+# Names decoded from scratch every this many, the ones in between share a prefix with the one before
+RESTART = 16
+ORDERS = ('path', 'name', 'ext')
+
+
+def _shared(a: bytes, b: bytes) -> int:
+    """Bytes at the start of a and b that are the same, at most 255"""
+    limit = min(len(a), len(b), 255)
+    # The leading zero bytes of a ^ b
+    different = int.from_bytes(a[:limit], 'big') ^ int.from_bytes(b[:limit], 'big')
+    return limit - (different.bit_length() + 7) // 8
+
+
+class _Store:
+    """The folders, extensions and front coded names of every path added, only ever grows"""
+
+    def __init__(self):
+        self.folders = []
+        self.folder_ids = {}
+        self.extensions = []
+        self.extension_ids = {}
+        # Per path
+        self.folder = array('I')
+        self.extension = array('H')
+        self.shared = array('B')
+        self.length = array('H')
+        # Start in data of every RESTART-th name
+        self.starts = array('Q')
+        self.data = bytearray()
+        self._last = b''
+        # Decoded names of the block read last
+        self._block = -1
+        self._names = None
+
+    def __len__(self):
+        return len(self.folder)
+
+    def _id(self, ids, values, value):
+        found = ids.get(value)
+        if found is None:
+            found = ids[value] = len(values)
+            values.append(value)
+        return found
+
+    def add(self, folder: str, name: str) -> int:
+        """Adds a path as the folder with its trailing separator and the name, returns its row"""
+        row = len(self.folder)
+        self.folder.append(self._id(self.folder_ids, self.folders, folder))
+        ext = schema.extension(name)
+        if len(self.extensions) >= 0xFFFF and ext not in self.extension_ids:
+            ext = ''
+        self.extension.append(self._id(self.extension_ids, self.extensions, ext))
+        encoded = name.encode('utf-8', 'surrogateescape')
+        if row % RESTART == 0:
+            self.starts.append(len(self.data))
+            shared = 0
+        else:
+            shared = _shared(self._last, encoded)
+        self.shared.append(shared)
+        self.length.append(len(encoded) - shared)
+        self.data += encoded[shared:]
+        self._last = encoded
+        return row
+
+    def _decode(self, block):
+        names = []
+        position = self.starts[block]
+        name = b''
+        for row in range(block * RESTART, min(len(self.folder), (block + 1) * RESTART)):
+            end = position + self.length[row]
+            name = name[:self.shared[row]] + bytes(self.data[position:end])
+            names.append(name)
+            position = end
+        return names
+
+    def name(self, row) -> bytes:
+        block = row // RESTART
+        # The last block is decoded again when names were added to it since
+        if block != self._block or row - block * RESTART >= len(self._names):
+            self._names = self._decode(block)
+            self._block = block
+        return self._names[row - block * RESTART]
+
+    def path(self, row) -> str:
+        return self.folders[self.folder[row]] + self.name(row).decode('utf-8', 'surrogateescape')
+
+
+class PathList:
+    """Sequence of paths in the order they were added, see the module docstring"""
+
+    def __init__(self, paths=()):
+        self._store = _Store()
+        # Rows of the store in this list, None when it's the first len of them in order
+        self._rows = None
+        self._length = 0
+        self.extend(paths)
+
+    @classmethod
+    def _view(cls, store, rows):
+        paths = cls.__new__(cls)
+        paths._store = store
+        paths._rows = rows
+        paths._length = len(rows)
+        return paths
+
+    def _added(self, row):
+        if self._rows is None and row == self._length:
+            self._length += 1
+            return
+        # Another list of the same store added paths since, this one keeps its rows from now on
+        if self._rows is None:
+            self._rows = array('I', range(self._length))
+        self._rows.append(row)
+        self._length += 1
+
+    def add(self, folder: str, name: str):
+        """Adds the file name in folder, for rows of the index that come split already"""
+        self._added(self._store.add(os.path.join(folder, ''), name))
+
+    def append(self, path: str):
+        folder, separator, name = path.rpartition(os.sep)
+        self._added(self._store.add(folder + separator, name))
+
+    def extend(self, paths):
+        for path in paths:
+            self.append(path)
+
+    def __len__(self):
+        return self._length
+
+    def _row(self, index):
+        return index if self._rows is None else self._rows[index]
+
+    def _all_rows(self):
+        return range(self._length) if self._rows is None else self._rows
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            rows = self._all_rows()[index]
+            return self._view(self._store, rows if isinstance(rows, array) else array('I', rows))
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('PathList index out of range')
+        return self._store.path(self._row(index))
+
+    def __iter__(self):
+        path = self._store.path
+        for row in self._all_rows():
+            yield path(row)
+
+    def __eq__(self, other):
+        if isinstance(other, (PathList, list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return f'<PathList of {self._length} paths>'
+
+    def folder(self, index) -> str:
+        """Folder of a path with its trailing separator"""
+        return self._store.folders[self._store.folder[self._row(index)]]
+
+    def name(self, index) -> str:
+        return self._store.name(self._row(index)).decode('utf-8', 'surrogateescape')
+
+    def extension(self, index) -> str:
+        """Lowercase extension without the dot, like schema.extension"""
+        return self._store.extensions[self._store.extension[self._row(index)]]
+
+    def with_extensions(self, extensions) -> 'PathList':
+        """The paths with one of the extensions ('exr', '.EXR' and '*.exr' are the same), in the same order"""
+        store = self._store
+        wanted = {store.extension_ids[x] for x in map(query.normalize_extension, extensions)
+                  if x in store.extension_ids}
+        found = store.extension
+        return self._view(store, array('I', (row for row in self._all_rows() if found[row] in wanted)))
+
+    def sorted(self, order='path', reverse=False) -> 'PathList':
+        """
+        The paths by folder then name like FileQuery's path order, by name or by extension.
+
+        Names of one folder are compared at a time when sorting by path, by name
+        every name is decoded while it sorts.
+        """
+        if order not in ORDERS:
+            raise ValueError(f'Unknown order {order}, one of {", ".join(ORDERS)}')
+        store = self._store
+        rows = self._all_rows()
+        if order == 'name':
+            ordered = sorted(rows, key=store.name, reverse=reverse)
+            return self._view(store, array('I', ordered))
+        if order == 'ext':
+            # Stable, the paths of one extension stay in their order
+            groups, values = store.extension, store.extensions
+        else:
+            groups = store.folder
+            # Without the trailing separator, like the paths of the directories table compare
+            values = [x[:-1] if x.endswith(os.sep) and len(x) > 1 else x for x in store.folders]
+        buckets = {}
+        for row in rows:
+            bucket = buckets.get(groups[row])
+            if bucket is None:
+                bucket = buckets[groups[row]] = array('I')
+            bucket.append(row)
+        ordered = array('I')
+        for group in sorted(buckets, key=values.__getitem__, reverse=reverse):
+            if order == 'path':
+                ordered.extend(sorted(buckets.pop(group), key=store.name, reverse=reverse))
+            else:
+                bucket = buckets.pop(group)
+                ordered.extend(reversed(bucket) if reverse else bucket)
+        return self._view(store, ordered)
+
+    def nbytes(self) -> int:
+        """Rough bytes held by the store and the rows of this list"""
+        store = self._store
+        held = (len(store.data) + sum(x.itemsize * len(x) for x in (store.folder, store.extension, store.shared,
+                                                                    store.length, store.starts))
+                + sum(len(x) + 49 for x in store.folders))
+        return held + (0 if self._rows is None else self._rows.itemsize * len(self._rows))
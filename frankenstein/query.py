@@ -0,0 +1,327 @@
+"""
+Query layer on top of the index.
+
+Filtering happens in SQLite against the indexed columns of the files table so
+only matching rows come back to Python:
+
+    FileQuery(root, extensions=['exr', 'tif']).paths(db)
+    FileQuery(extensions=['wav'], min_size=10 * 1024 ** 2).count(db)
+    FileQuery(extensions=['exr'], min_width=3840, order='resolution').paths(db)
+    FileQuery(extensions=['wav'], max_duration=2, order='duration').paths(db)
+    FileQuery(extensions=['obj', 'ply'], max_triangles=50000, order='triangles').paths(db)
+    FileQuery(root, folder='/mnt/assets/textures/bricks', order='size').pages(db)
+
+Big listings are read a page at a time with FileQuery.pages, which continues
+after the last row of the previous page instead of using OFFSET.
+"""
+import os
+
+from . import schema
+from .blom import get_logger, span, timer
+
+l = get_logger('frankenstein.query')
+
+# Sort columns of every order, f.id last so the key of a row is unique
+ORDERS = {
+    None: (),
+    'path': ('d.path', 'f.name', 'f.id'),
+    'name': ('f.name', 'f.id'),
+    'size': ('f.size', 'f.id'),
+    'mtime': ('f.mtime', 'f.id'),
+    # Files without a known resolution count as 0 pixels
+    'resolution': ('coalesce(f.width * f.height, 0)', 'f.id'),
+    'duration': ('coalesce(f.duration, 0)', 'f.id'),
+    'triangles': ('coalesce(f.triangles, 0)', 'f.id'),
+}
+
+# Rows per page of FileQuery.pages
+PAGE_SIZE = 1000
+
+
+def normalize_extension(ext: str) -> str:
+    """'*.EXR', '.exr' and 'exr' all become 'exr'"""
+    return ext.strip().lstrip('*').lstrip('.').lower()
+
+
+# Minimum width of the resolution words of the filter input
+RESOLUTIONS = {'2k': 2048, '4k': 3840, '8k': 7680}
+
+# Image filters of the filter input as name:number and the FileQuery argument they set
+_IMAGE_FILTERS = {'width': 'min_width', 'height': 'min_height', 'channels': 'channels', 'bits': 'bits'}
+
+# Sound filters of the filter input as name:seconds
+_AUDIO_FILTERS = {'longer': 'min_duration', 'shorter': 'max_duration'}
+
+# Model filters of the filter input as name:count
+_MODEL_FILTERS = {'mintris': 'min_triangles', 'maxtris': 'max_triangles'}
+
+_COUNT_UNITS = {'': 1, 'k': 1000, 'm': 1000 ** 2}
+
+
+def parse_count(text: str) -> int:
+    """Counts like 50000, 50k or 1.5m"""
+    text = text.strip().lower()
+    number = text.rstrip('km')
+    unit = text[len(number):]
+    if unit not in _COUNT_UNITS:
+        raise ValueError(f'Unknown count {text}')
+    return int(float(number) * _COUNT_UNITS[unit])
+
+
+def parse_filter(text: str) -> dict:
+    """
+    FileQuery arguments from the filter input.
+
+    Words are extensions, except 2k/4k/8k (that wide or wider) and width:N,
+    height:N (at least N pixels), channels:N and bits:N, eg 'exr tif 4k bits:16',
+    and longer:S or shorter:S (sounds of at least or at most S seconds), eg 'wav shorter:2',
+    and mintris:N or maxtris:N (models of at least or at most N triangles), eg 'obj maxtris:50k'.
+    """
+    arguments = {'extensions': []}
+    for word in text.replace(',', ' ').lower().split():
+        name, _, value = word.partition(':')
+        if word in RESOLUTIONS:
+            arguments['min_width'] = RESOLUTIONS[word]
+        elif name in _IMAGE_FILTERS:
+            # Half typed filters are left out
+            if value.isdigit():
+                arguments[_IMAGE_FILTERS[name]] = int(value)
+        elif name in _AUDIO_FILTERS:
+            try:
+                arguments[_AUDIO_FILTERS[name]] = float(value)
+            except ValueError:
+                pass
+        elif name in _MODEL_FILTERS:
+            try:
+                arguments[_MODEL_FILTERS[name]] = parse_count(value)
+            except ValueError:
+                pass
+        elif normalize_extension(word):
+            arguments['extensions'].append(normalize_extension(word))
+    return arguments
+
+
+def folder_clause(folder, root_id=None, column='f.dir_id'):
+    """
+    SQL of column being the directory folder or one below it, and its parameters.
+
+    The directories are found through the (root_id, path) index, when root_id
+    isn't known in every root (there are only a few).
+    """
+    folder = os.path.normpath(str(folder))
+    in_root = 'root_id = ?' if root_id is not None else f'root_id IN (SELECT id FROM {schema.ROOTS})'
+    root_params = [root_id] if root_id is not None else []
+    return (f'{column} IN (SELECT id FROM {schema.DIRECTORIES} WHERE {in_root} AND path = ? UNION ALL '
+            f'SELECT id FROM {schema.DIRECTORIES} WHERE {in_root} AND path >= ? AND path < ?)',
+            root_params + [folder] + root_params + [folder + os.sep, folder + chr(ord(os.sep) + 1)])
+
+
+def parse_extensions(text: str) -> list:
+    """Extensions from the filter input, separated by spaces or commas, see parse_filter"""
+    return parse_filter(text)['extensions']
+
+
+class FileQuery:
+    """
+    Filter on the files of one watched folder, or all of them when root is None.
+
+    Sizes are in bytes and times are unix timestamps, None means no limit.
+    descending reverses the order. The image filters (min_width, min_height,
+    channels and bits) only match files whose header was read, see imagemeta.py,
+    min_duration and max_duration (seconds) sounds and clips, and min_triangles
+    and max_triangles models read by modelmeta.py. folder limits it to the files
+    in that directory and below.
+    """
+
+    def __init__(self, root=None, extensions=None, min_size=None, max_size=None,
+                 modified_after=None, modified_before=None, order=None, descending=False,
+                 min_width=None, min_height=None, channels=None, bits=None, min_duration=None,
+                 max_duration=None, min_triangles=None, max_triangles=None, folder=None):
+        self.root = root
+        self.folder = folder
+        self.extensions = sorted({normalize_extension(x) for x in extensions or ()} - {''})
+        self.min_size = min_size
+        self.max_size = max_size
+        self.modified_after = modified_after
+        self.modified_before = modified_before
+        if order not in ORDERS:
+            raise ValueError(f'Unknown order {order}, use one of {list(ORDERS)}')
+        self.order = order
+        self.descending = descending
+        self.min_width = min_width
+        self.min_height = min_height
+        self.channels = channels
+        self.bits = bits
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.min_triangles = min_triangles
+        self.max_triangles = max_triangles
+
+    def where(self, db):
+        """Returns the WHERE clause and its parameters, None when root isn't indexed"""
+        clauses = []
+        params = []
+        rid = None
+        if self.root is not None:
+            rid = schema.root_id(db, self.root)
+            if rid is None:
+                return None
+            if self.folder is None:
+                clauses.append('f.root_id = ?')
+                params.append(rid)
+        if self.folder is not None:
+            # The files of the folder are looked up by dir_id instead of going through the whole root
+            clause, folder_params = folder_clause(self.folder, rid)
+            clauses.append(clause)
+            params.extend(folder_params)
+        # + keeps SQLite from going through every file of the type when it's limited to a folder
+        filters, filter_params = self._filters(ext_index=self.folder is None)
+        clauses.extend(filters)
+        params.extend(filter_params)
+        return ('WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def _filters(self, ext_index):
+        """Clauses and parameters of the filters on columns of files, ext_index False keeps the ext index out"""
+        clauses = []
+        params = []
+        if self.extensions:
+            column = 'f.ext' if ext_index else '+f.ext'
+            clauses.append(f'{column} IN ({", ".join("?" * len(self.extensions))})')
+            params.extend(self.extensions)
+        for column, op, value in (('size', '>=', self.min_size), ('size', '<=', self.max_size),
+                                  ('mtime', '>=', self.modified_after), ('mtime', '<=', self.modified_before),
+                                  ('width', '>=', self.min_width), ('height', '>=', self.min_height),
+                                  ('channels', '=', self.channels), ('bits', '=', self.bits),
+                                  ('duration', '>=', self.min_duration), ('duration', '<=', self.max_duration),
+                                  ('triangles', '>=', self.min_triangles), ('triangles', '<=', self.max_triangles)):
+            if value is not None:
+                clauses.append(f'f.{column} {op} ?')
+                params.append(value)
+        return clauses, params
+
+    def order_by(self, order=None) -> str:
+        columns = ORDERS[order if order is not None else self.order]
+        if not columns:
+            return ''
+        direction = ' DESC' if self.descending else ''
+        return 'ORDER BY ' + ', '.join(x + direction for x in columns)
+
+    def rows(self, db, columns='d.path, f.name', limit=None, offset=0):
+        """Cursor over the selected columns of matching files, f is files and d directories"""
+        where = self.where(db)
+        if where is None:
+            return iter(())
+        where, params = where
+        sql = (f'SELECT {columns} FROM {schema.FILES} f JOIN {schema.DIRECTORIES} d ON d.id = f.dir_id '
+               f'{where} {self.order_by()}')
+        if limit is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            params = params + [limit, offset]
+        return db.execute(sql, params)
+
+    @span('filter.paths')
+    def paths(self, db, limit=None, offset=0):
+        """Full paths of matching files as a pathlist.PathList, no str is made per file until it's read"""
+        from .pathlist import PathList
+
+        timer_query = timer()
+        paths = PathList()
+        add = paths.add
+        for folder, name in self.rows(db, limit=limit, offset=offset):
+            add(folder, name)
+        l.info(f'Query returned {len(paths)} files in {timer_query}')
+        return paths
+
+    def pages(self, db, page_size=PAGE_SIZE):
+        """
+        Yields lists of full paths of matching files, page_size at a time.
+
+        Every page is a query of its own that starts after the sort key of the
+        last row of the previous one, so no read transaction stays open in
+        between. Without an order the files come in path order. Within one
+        watched folder the path, name, size and mtime orders read each page
+        from an index, so the millionth row costs as much as the first. Other
+        orders, and listings of every watched folder, sort all matching files
+        for every page.
+        """
+        where = self.where(db)
+        if where is None:
+            return
+        order = self.order or 'path'
+        if order == 'path' and self.root is not None:
+            yield from self._path_pages(db, schema.root_id(db, self.root), page_size)
+            return
+        where, params = where
+        keys = ORDERS[order]
+        compare = '<' if self.descending else '>'
+        after = f'({", ".join(keys)}) {compare} ({", ".join("?" * len(keys))})'
+        sql = (f'SELECT d.path, f.name, {", ".join(keys)} FROM {schema.FILES} f '
+               f'JOIN {schema.DIRECTORIES} d ON d.id = f.dir_id ')
+        join = os.path.join
+        last = None
+        while True:
+            with span('filter.page', order=order):
+                if last is None:
+                    page = db.execute(f'{sql} {where} {self.order_by(order)} LIMIT ?',
+                                      params + [page_size]).fetchall()
+                else:
+                    clause = f'{where} AND {after}' if where else f'WHERE {after}'
+                    page = db.execute(f'{sql} {clause} {self.order_by(order)} LIMIT ?',
+                                      params + list(last) + [page_size]).fetchall()
+            if not page:
+                return
+            yield [join(row[0], row[1]) for row in page]
+            if len(page) < page_size:
+                return
+            last = page[-1][2:]
+
+    def _path_pages(self, db, rid, page_size):
+        """
+        pages in path order, directory by directory through the (root_id, path)
+        index and the files of each through (dir_id, name).
+
+        A page starts with the rest of the directory the previous one stopped
+        in and goes on with the directories after it.
+        """
+        clauses, params = self._filters(ext_index=False)
+        in_root = ['d.root_id = ?']
+        root_params = [rid]
+        if self.folder is not None:
+            # A range of the index, the folder itself and what's below it are the part of it that matches
+            folder = os.path.normpath(str(self.folder))
+            in_root.append('d.path >= ? AND d.path < ? AND (d.path = ? OR d.path >= ?)')
+            root_params += [folder, folder + chr(ord(os.sep) + 1), folder, folder + os.sep]
+        sql = (f'SELECT d.path, f.name FROM {schema.DIRECTORIES} d JOIN {schema.FILES} f ON f.dir_id = d.id '
+               f'WHERE {" AND ".join(in_root + clauses)}')
+        params = root_params + params
+        direction = ' DESC' if self.descending else ''
+        compare = '<' if self.descending else '>'
+        by_path = f'ORDER BY d.path{direction}, f.name{direction} LIMIT ?'
+        join = os.path.join
+        last = None
+        while True:
+            with span('filter.page', order='path'):
+                if last is None:
+                    page = db.execute(f'{sql} {by_path}', params + [page_size]).fetchall()
+                else:
+                    page = db.execute(f'{sql} AND d.path = ? AND f.name {compare} ? '
+                                      f'ORDER BY f.name{direction} LIMIT ?',
+                                      params + list(last) + [page_size]).fetchall()
+                    if len(page) < page_size:
+                        page += db.execute(f'{sql} AND d.path {compare} ? {by_path}',
+                                           params + [last[0], page_size - len(page)]).fetchall()
+            if not page:
+                return
+            yield [join(folder, name) for folder, name in page]
+            if len(page) < page_size:
+                return
+            last = page[-1]
+
+    @span('filter.count')
+    def count(self, db) -> int:
+        where = self.where(db)
+        if where is None:
+            return 0
+        where, params = where
+        # Filters only touch the files table, no need for the join
+        return db.execute(f'SELECT count(*) FROM {schema.FILES} f {where}', params).fetchone()[0]
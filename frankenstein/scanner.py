@@ -0,0 +1,336 @@
+"""
+Incremental scanning of watched folders.
+
+Instead of dropping a watched folder and inserting every path again, the scanner
+compares the disk with the size and mtime of every file and the mtime of every
+directory in the index (see schema.py). On a rescan a directory whose mtime
+hasn't changed isn't listed again, only its subdirectories are checked. The
+difference between disk and index is written as inserts, updates and deletes so
+the folder never shows up empty while scanning. The totals of every directory
+(see tree.py) are updated with the same writes.
+
+Note that editing a file in place doesn't touch the mtime of its directory, use
+incremental=False to list every directory and pick those changes up as well.
+
+scan_changes produces the changes and apply_batch writes them, which lets the
+walk and the database writes run in different threads (see scanthread.py).
+scan_directories does the same for a handful of directories reported by the
+file system watcher (see watchthread.py) without walking the rest of the root.
+"""
+import os
+from collections import namedtuple
+
+from . import schema
+from . import sequences
+from . import tree
+from .blom import count, get_logger, span, timer
+from .walker import Walker, DEFAULT_WORKERS
+
+l = get_logger('frankenstein.scanner')
+
+ScanStats = namedtuple('ScanStats', 'inserted updated deleted dirs_listed dirs_skipped')
+
+# Changes of a single listed directory. dir_id is None for new directories.
+# inserts are (name, ext, size, mtime), updates (size, mtime, file id) and deletes (file id,)
+DirChange = namedtuple('DirChange', 'path dir_id mtime inserts updates deletes')
+
+# dirs is a list of DirChange and gone_dirs a list of directory ids
+Batch = namedtuple('Batch', 'root root_id dirs gone_dirs dirs_listed dirs_skipped')
+
+
+def ensure_tables(db, root: str) -> int:
+    """Makes sure root is a watched folder in the index and returns its id"""
+    schema.ensure_schema(db)
+    return schema.add_root(db, root)
+
+
+def _load_known(db, root_id, top):
+    known_dirs = {}
+    parents = {}
+    for dir_id, parent_id, path, mtime in db.execute(
+            f'SELECT id, parent_id, path, mtime FROM {schema.DIRECTORIES} WHERE root_id = ?', [root_id]):
+        known_dirs[path] = (dir_id, mtime)
+        parents[dir_id] = parent_id
+    paths = {dir_id: path for path, (dir_id, mtime) in known_dirs.items()}
+    known_children = {}
+    for dir_id, parent_id in parents.items():
+        if parent_id is not None and paths[dir_id] != top:
+            known_children.setdefault(paths[parent_id], []).append(paths[dir_id])
+    return known_dirs, known_children
+
+
+def _known_files(db, dir_id):
+    """{name: (file id, size, mtime)} of a directory"""
+    if dir_id is None:
+        return {}
+    return {name: (file_id, size, mtime) for file_id, name, size, mtime in
+            db.execute(f'SELECT id, name, size, mtime FROM {schema.FILES} WHERE dir_id = ?', [dir_id])}
+
+
+def _diff_directory(db, listing, dir_id):
+    """Returns the DirChange of a listed directory against the index, files found and bytes seen"""
+    before = _known_files(db, dir_id)
+    change = DirChange(listing.path, dir_id, listing.mtime, [], [], [])
+    names = set()
+    bytes_seen = 0
+    for file, size, file_mtime in listing.files:
+        name = os.path.basename(file)
+        names.add(name)
+        bytes_seen += size or 0
+        old = before.get(name)
+        if old is None:
+            change.inserts.append((name, schema.extension(name), size, file_mtime))
+        elif old[1:] != (size, file_mtime):
+            change.updates.append((size, file_mtime, old[0]))
+    change.deletes.extend((file_id,) for name, (file_id, size, mtime) in before.items() if name not in names)
+    return change, len(names), bytes_seen
+
+
+def scan_changes(db, root, incremental=True, workers=DEFAULT_WORKERS, batch_size=None,
+                 progress=None, cancel=None):
+    """
+    Walks a watched folder and yields the difference to the index as Batch objects.
+
+    A batch always holds whole directories (their files and their mtime) so the
+    index stays consistent when batches are committed one by one. batch_size is
+    the number of changed rows per batch, None yields everything as one batch.
+
+    progress(files_found, bytes_seen) is called for every directory and the walk
+    stops early when cancel (a threading.Event) is set. Directories that
+    disappeared are only removed when the walk wasn't cancelled.
+    """
+    root = str(root)
+    timer_scan = timer()
+    top = os.path.normpath(root)
+    root_id = schema.root_id(db, root)
+    with span('scan.load_known', root=root):
+        known_dirs, known_children = _load_known(db, root_id, top)
+    l.info(f'Loaded {len(known_dirs)} directories from index in {timer_scan}')
+
+    batch = Batch(root, root_id, [], [], 0, 0)
+    pending_rows = 0
+    seen_dirs = set()
+    files_found = bytes_seen = 0
+
+    def unchanged(path, mtime):
+        return incremental and path in known_dirs and known_dirs[path][1] == mtime
+
+    def children(path):
+        return known_children.get(path, ())
+
+    for listing in Walker(workers, root=root).walk(top, skip=unchanged, known_children=children):
+        if cancel is not None and cancel.is_set():
+            l.info(f'Scan of {root} cancelled')
+            break
+
+        path = listing.path
+        if listing.mtime is None:
+            continue
+        seen_dirs.add(path)
+        if listing.error is not None:
+            l.warning(f'Could not list {path}, keeping what is indexed')
+            continue
+
+        dir_id, known_mtime = known_dirs.get(path, (None, None))
+        if not listing.listed:
+            batch = batch._replace(dirs_skipped=batch.dirs_skipped + 1)
+            files, size = db.execute(f'SELECT count(*), total(size) FROM {schema.FILES} WHERE dir_id = ?',
+                                     [dir_id]).fetchone()
+            files_found += files
+            bytes_seen += int(size)
+            count('scan.dirs_skipped')
+        else:
+            batch = batch._replace(dirs_listed=batch.dirs_listed + 1)
+            with span('scan.diff_dir'):
+                change, found, seen = _diff_directory(db, listing, dir_id)
+            files_found += found
+            bytes_seen += seen
+            if change.inserts or change.updates or change.deletes or known_mtime != listing.mtime:
+                batch.dirs.append(change)
+                pending_rows += 1 + len(change.inserts) + len(change.updates) + len(change.deletes)
+
+        if progress is not None:
+            progress(files_found, bytes_seen)
+
+        if batch_size is not None and pending_rows >= batch_size:
+            yield batch
+            batch = Batch(root, root_id, [], [], 0, 0)
+            pending_rows = 0
+    else:
+        # Directories that disappeared take their files with them, unless the
+        # whole root is missing which is more likely an unmounted drive
+        if top not in seen_dirs:
+            l.warning(f'{root} could not be read, keeping what is indexed')
+        else:
+            batch.gone_dirs.extend(dir_id for path, (dir_id, mtime) in known_dirs.items()
+                                   if path not in seen_dirs)
+
+    l.info(f'Walked {root} in {timer_scan}')
+    count('scan.walks')
+    yield batch
+
+
+def _directory(db, root_id, path):
+    """(id, mtime) of an indexed directory or None"""
+    return db.execute(f'SELECT id, mtime FROM {schema.DIRECTORIES} WHERE root_id = ? AND path = ?',
+                      [root_id, path]).fetchone()
+
+
+def _subtree_ids(db, root_id, path):
+    """Ids of an indexed directory and everything below it"""
+    return [dir_id for dir_id, in db.execute(
+        f'SELECT id FROM {schema.DIRECTORIES} WHERE root_id = ? AND (path = ? OR (path >= ? AND path < ?))',
+        [root_id, path, path + os.sep, path + chr(ord(os.sep) + 1)])]
+
+
+@span('scan.directories')
+def scan_directories(db, root, paths, workers=DEFAULT_WORKERS) -> Batch:
+    """
+    Brings only the given directories of a watched folder up to date and returns the changes as one Batch.
+
+    Every directory in paths is listed again whatever its mtime, so files edited
+    in place are picked up too. New subdirectories are walked completely, ones
+    that disappeared are removed with everything below them, and indexed
+    subdirectories are left alone. A path that isn't indexed yet is handled
+    through its closest indexed parent.
+    """
+    root = str(root)
+    timer_update = timer()
+    top = os.path.normpath(root)
+    root_id = schema.root_id(db, root)
+    batch = Batch(root, root_id, [], [], 0, 0)
+    if root_id is None:
+        return batch
+
+    starts = set()
+    for path in paths:
+        path = os.path.normpath(str(path))
+        if path != top and not path.startswith(top + os.sep):
+            continue
+        while path != top and _directory(db, root_id, path) is None:
+            path = os.path.dirname(path)
+        starts.add(path)
+
+    walker = Walker(workers, root=root)
+    done = set()
+    # Parents sort before their children, a directory already walked as part of a new one is skipped
+    for start in sorted(starts):
+        if start in done:
+            continue
+        known = _directory(db, root_id, start)
+        if known is None:
+            continue
+        dir_id = known[0]
+        children = {path for path, in db.execute(f'SELECT path FROM {schema.DIRECTORIES} WHERE parent_id = ?',
+                                                 [dir_id])}
+        seen = set()
+
+        def indexed_child(path, mtime):
+            return path in children
+
+        for listing in walker.walk(start, skip=indexed_child):
+            seen.add(listing.path)
+            if listing.path == start and listing.mtime is None:
+                if start == top:
+                    l.warning(f'{root} could not be read, keeping what is indexed')
+                else:
+                    batch.gone_dirs.extend(_subtree_ids(db, root_id, start))
+                break
+            if listing.path == start and listing.error is not None:
+                # It exists but couldn't be listed, which says nothing about its subdirectories
+                l.warning(f'Could not list {start}, keeping what is indexed')
+                break
+            if not listing.listed:
+                continue
+            done.add(listing.path)
+            batch = batch._replace(dirs_listed=batch.dirs_listed + 1)
+            change, found, seen_bytes = _diff_directory(db, listing, dir_id if listing.path == start else None)
+            if change.dir_id is None or change.inserts or change.updates or change.deletes \
+                    or known[1] != listing.mtime:
+                batch.dirs.append(change)
+        else:
+            for child in children - seen:
+                batch.gone_dirs.extend(_subtree_ids(db, root_id, child))
+
+    l.info(f'Updated {len(starts)} directories of {root} in {timer_update}')
+    return batch
+
+
+def _directory_id(db, root_id, path):
+    row = db.execute(f'SELECT id FROM {schema.DIRECTORIES} WHERE root_id = ? AND path = ?',
+                     [root_id, path]).fetchone()
+    return row[0] if row else None
+
+
+def apply_batch(db, batch) -> ScanStats:
+    """Writes a Batch from scan_changes to the index in one transaction"""
+    inserted = updated = deleted = 0
+    top = os.path.normpath(batch.root)
+    rollup = tree.Rollup(db)
+    with span('db.write', dirs=len(batch.dirs)) as write, db.conn:
+        for change in batch.dirs:
+            dir_id = change.dir_id
+            if dir_id is None:
+                # Parents are always listed (and written) before their children
+                parent_id = None if change.path == top else _directory_id(db, batch.root_id,
+                                                                          os.path.dirname(change.path))
+                dir_id = db.conn.execute(f'INSERT INTO {schema.DIRECTORIES} (root_id, parent_id, path, mtime) '
+                                         f'VALUES (?, ?, ?, ?)',
+                                         (batch.root_id, parent_id, change.path, change.mtime)).lastrowid
+                rollup.directory(dir_id, parent_id)
+            else:
+                db.conn.execute(f'UPDATE {schema.DIRECTORIES} SET mtime = ? WHERE id = ?', (change.mtime, dir_id))
+            rollup.inserted(dir_id, change.inserts)
+            rollup.updated(dir_id, change.updates)
+            rollup.deleted(dir_id, change.deletes)
+            if change.inserts:
+                last_id = db.conn.execute(f'SELECT max(id) FROM {schema.FILES}').fetchone()[0] or 0
+                db.conn.executemany(f'INSERT INTO {schema.FILES} (root_id, dir_id, name, ext, size, mtime) '
+                                    f'VALUES ({batch.root_id}, {dir_id}, ?, ?, ?, ?)', change.inserts)
+                # Rows are removed from the search index by a trigger, added here
+                db.conn.execute(f'INSERT INTO {schema.FILES_FTS} (rowid, name, folder) '
+                                f'SELECT id, name, ? FROM {schema.FILES} WHERE dir_id = ? AND id > ?',
+                                (schema.relative_folder(top, change.path), dir_id, last_id))
+            db.conn.executemany(f'UPDATE {schema.FILES} SET size = ?, mtime = ? WHERE id = ?', change.updates)
+            db.conn.executemany(f'DELETE FROM {schema.FILES} WHERE id = ?', change.deletes)
+            if change.inserts or change.deletes:
+                sequences.update_directory(db, batch.root_id, dir_id, change.path)
+            inserted += len(change.inserts)
+            updated += len(change.updates)
+            deleted += len(change.deletes)
+
+        for dir_id in batch.gone_dirs:
+            rollup.removed(dir_id)
+        # Parents are looked up before gone directories are deleted
+        rollup.apply()
+        for dir_id in batch.gone_dirs:
+            deleted += db.conn.execute(f'DELETE FROM {schema.FILES} WHERE dir_id = ?', [dir_id]).rowcount
+        db.conn.executemany(f'DELETE FROM {schema.DIRECTORIES} WHERE id = ?', [(x,) for x in batch.gone_dirs])
+        write.set(inserted=inserted, updated=updated, deleted=deleted)
+    count('db.inserted', inserted)
+    count('db.updated', updated)
+    count('db.deleted', deleted)
+    return ScanStats(inserted, updated, deleted, batch.dirs_listed, batch.dirs_skipped)
+
+
+def add_stats(a: ScanStats, b: ScanStats) -> ScanStats:
+    return ScanStats(*(x + y for x, y in zip(a, b)))
+
+
+def scan_root(db, root, incremental=True, workers=DEFAULT_WORKERS, batch_size=None) -> ScanStats:
+    """
+    Brings the index of a watched folder up to date with what's on disk.
+
+    With incremental=True directories whose mtime didn't change since the last
+    scan are not listed again. workers is the number of directories listed at once.
+    By default all changes are written in a single transaction.
+    """
+    root = str(root)
+    ensure_tables(db, root)
+    stats = ScanStats(0, 0, 0, 0, 0)
+    timer_db_write = timer()
+    with span('scan', root=root, incremental=incremental):
+        for batch in scan_changes(db, root, incremental, workers, batch_size):
+            stats = add_stats(stats, apply_batch(db, batch))
+    l.info(f'Wrote {stats.inserted} inserts, {stats.updated} updates, {stats.deleted} deletes in {timer_db_write}')
+    return stats
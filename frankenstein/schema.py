@@ -0,0 +1,478 @@
+"""
+Database schema of the index.
+
+All watched folders share three tables:
+
+    roots        one row per watched folder
+    directories  every directory below a root, with its mtime from the last scan
+    files        every file with root/directory ids, name, lowercase extension, size and mtime
+
+The full path of a file is directories.path joined with files.name. Databases from
+before this layout (one table per watched folder with a path column) are migrated
+the first time they are opened with ensure_schema. Sizes and mtimes they don't
+have become 0 until the next scan, never NULL: the orders of query.py page on
+them and NULL doesn't compare.
+
+files_fts is an FTS5 trigram index over file names and their folder (relative to
+the root) used for substring search, see search.py. Rows are added by the
+scanner and removed by a trigger whenever a file row is deleted.
+
+sequences holds the image sequences detected per directory (see sequences.py),
+files.seq_id points at the sequence a file is a frame of.
+
+hashes holds the content hashes of files that may have copies (see hashing.py),
+a row is removed by a trigger as soon as the size or mtime of its file changes.
+
+files.width, height, channels and bits come from image headers (see
+imagemeta.py) and files.meta says if the header was read. They are reset by a
+trigger when the size or mtime of a file changes. Sound files use
+channels, bits and meta too, with duration (seconds) and sample_rate from
+waveform.py, video clips width, height and duration from videoframes.py.
+
+3D models have files.vertices and triangles, models holds the rest of what
+modelmeta.py reads (polygons, bounding box and referenced textures). The row
+is removed by triggers like the hashes of a file.
+
+files.phash is the perceptual hash of an image made with its thumbnail (see
+similar.py), reset by the same trigger as the headers.
+
+directories.files and bytes are the totals of a directory and everything below
+it, directory_exts the same per extension. The scanner keeps them up to date,
+see tree.py.
+
+roots.snapshot is the id of the snapshot a watched folder was last imported
+from (see snapshot.py), NULL for folders scanned here.
+
+Connections are plain sqlite3 (see Database), sqlite_utils is only imported
+when the schema has to be created or upgraded.
+"""
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from pathlib import Path
+
+from .blom import get_logger, timer
+
+l = get_logger('frankenstein.schema')
+
+SCHEMA_VERSION = 12
+
+ROOTS = 'roots'
+DIRECTORIES = 'directories'
+FILES = 'files'
+FILES_FTS = 'files_fts'
+SEQUENCES = 'sequences'
+HASHES = 'hashes'
+MODELS = 'models'
+DIRECTORY_EXTS = 'directory_exts'
+TABLES = (ROOTS, DIRECTORIES, FILES, FILES_FTS, SEQUENCES, HASHES, MODELS, DIRECTORY_EXTS)
+
+# Bookkeeping table of the incremental scanner before version 1
+_LEGACY_DIRECTORIES = '_directories'
+
+
+RootStats = namedtuple('RootStats', 'path files directories bytes sequences')
+
+
+class Database:
+    """
+    sqlite3 connection with the execute and conn of sqlite_utils.Database.
+
+    Importing sqlite_utils takes longer than a whole query from the command
+    line should, so day to day use goes through this instead.
+    """
+
+    def __init__(self, path, read_only=False):
+        if read_only:
+            # Read connections of a pool are handed from thread to thread, one query at a time
+            self.conn = sqlite3.connect(f'{Path(path).absolute().as_uri()}?mode=ro', uri=True,
+                                        check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(str(path))
+        self.conn.execute('PRAGMA recursive_triggers = on')
+
+    def execute(self, sql, parameters=None):
+        if parameters is not None:
+            return self.conn.execute(sql, parameters)
+        return self.conn.execute(sql)
+
+    def executescript(self, sql):
+        return self.conn.executescript(sql)
+
+
+def connect(path, read_only=False) -> Database:
+    """Opens the index at path, every thread should use its own connection"""
+    db = Database(path, read_only)
+    if not read_only:
+        db.execute('PRAGMA synchronous = NORMAL')
+    db.conn.execute('PRAGMA busy_timeout = 10000')
+    return db
+
+
+def extension(name: str) -> str:
+    """Lowercase extension without the dot, '' when there is none"""
+    return os.path.splitext(name)[1][1:].lower()
+
+
+def relative_folder(top: str, path: str) -> str:
+    """Directory path below the (normalized) root path, '' for the root itself"""
+    return path[len(top):].lstrip('\\/')
+
+
+def ensure_schema(db):
+    """Creates the tables and indexes and upgrades old databases, safe to call every start"""
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+    timer_schema = timer()
+    import sqlite_utils
+
+    db = sqlite_utils.Database(db.conn)
+    db.enable_wal()
+    for upgrade_version, upgrade in _UPGRADES:
+        if version < upgrade_version:
+            upgrade(db)
+            db.execute(f'PRAGMA user_version = {upgrade_version}')
+    l.info(f'Schema version {SCHEMA_VERSION} ready in {timer_schema}')
+
+
+def _create_tables(db):
+    db[ROOTS].create({'id': int, 'path': str, 'added': float}, pk='id', not_null=['path'], if_not_exists=True)
+    db[ROOTS].create_index(['path'], unique=True, if_not_exists=True)
+
+    db[DIRECTORIES].create({'id': int, 'root_id': int, 'parent_id': int, 'path': str, 'mtime': float},
+                           pk='id', not_null=['root_id', 'path'],
+                           foreign_keys=[('root_id', ROOTS, 'id'), ('parent_id', DIRECTORIES, 'id')],
+                           if_not_exists=True)
+    db[DIRECTORIES].create_index(['root_id', 'path'], unique=True, if_not_exists=True)
+    db[DIRECTORIES].create_index(['parent_id'], if_not_exists=True)
+
+    db[FILES].create({'id': int, 'root_id': int, 'dir_id': int, 'name': str, 'ext': str,
+                      'size': int, 'mtime': float},
+                     pk='id', not_null=['root_id', 'dir_id', 'name', 'ext'],
+                     foreign_keys=[('root_id', ROOTS, 'id'), ('dir_id', DIRECTORIES, 'id')],
+                     if_not_exists=True)
+    db[FILES].create_index(['dir_id', 'name'], unique=True, if_not_exists=True)
+    db[FILES].create_index(['root_id', 'ext'], if_not_exists=True)
+    db[FILES].create_index(['ext'], if_not_exists=True)
+    db[FILES].create_index(['root_id', 'size'], if_not_exists=True)
+    db[FILES].create_index(['root_id', 'mtime'], if_not_exists=True)
+
+    _migrate_table_per_root(db)
+
+
+def _create_search(db):
+    db.executescript(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {FILES_FTS} USING fts5(name, folder, tokenize = 'trigram');
+        CREATE TRIGGER IF NOT EXISTS {FILES}_fts_delete AFTER DELETE ON {FILES} BEGIN
+            DELETE FROM {FILES_FTS} WHERE rowid = old.id;
+        END;
+    """)
+    with db.conn:
+        for rid, root in db.execute(f'SELECT id, path FROM {ROOTS}').fetchall():
+            top = os.path.normpath(root)
+            cursor = db.execute(f'SELECT f.id, f.name, d.path FROM {FILES} f '
+                                f'JOIN {DIRECTORIES} d ON d.id = f.dir_id WHERE f.root_id = ?', [rid])
+            db.conn.executemany(f'INSERT INTO {FILES_FTS} (rowid, name, folder) VALUES (?, ?, ?)',
+                                ((file_id, name, relative_folder(top, path)) for file_id, name, path in cursor))
+    l.info(f'Built search index')
+
+
+def _create_sequences(db):
+    from . import sequences
+
+    db[SEQUENCES].create({'id': int, 'root_id': int, 'dir_id': int, 'prefix': str, 'suffix': str, 'ext': str,
+                          'padding': int, 'first': int, 'last': int, 'frames': int, 'ranges': str},
+                         pk='id', not_null=['root_id', 'dir_id', 'ext'],
+                         foreign_keys=[('root_id', ROOTS, 'id'), ('dir_id', DIRECTORIES, 'id')],
+                         if_not_exists=True)
+    db[SEQUENCES].create_index(['dir_id'], if_not_exists=True)
+    db[SEQUENCES].create_index(['root_id', 'ext'], if_not_exists=True)
+    if 'seq_id' not in db[FILES].columns_dict:
+        db[FILES].add_column('seq_id', int)
+    db[FILES].create_index(['root_id', 'seq_id'], if_not_exists=True)
+    db.executescript(f"""
+        CREATE TRIGGER IF NOT EXISTS {DIRECTORIES}_sequences_delete AFTER DELETE ON {DIRECTORIES} BEGIN
+            DELETE FROM {SEQUENCES} WHERE dir_id = old.id;
+        END;
+    """)
+    found = 0
+    with db.conn:
+        for root_id, dir_id, path in db.execute(f'SELECT root_id, id, path FROM {DIRECTORIES}').fetchall():
+            found += sequences.update_directory(db, root_id, dir_id, path)
+    l.info(f'Found {found} image sequences in the index')
+
+
+def _create_hashes(db):
+    # sample is a hash of the head, middle and tail of a file and full of all of it, both blobs
+    db[HASHES].create({'file_id': int, 'size': int, 'sample': bytes, 'full': bytes},
+                      pk='file_id', not_null=['size'], foreign_keys=[('file_id', FILES, 'id')],
+                      if_not_exists=True)
+    db[HASHES].create_index(['size', 'sample'], if_not_exists=True)
+    db[HASHES].create_index(['full'], if_not_exists=True)
+    # Candidates for copies are files of the same size, across all roots
+    db[FILES].create_index(['size'], if_not_exists=True)
+    db.executescript(f"""
+        CREATE TRIGGER IF NOT EXISTS {FILES}_hashes_delete AFTER DELETE ON {FILES} BEGIN
+            DELETE FROM {HASHES} WHERE file_id = old.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS {FILES}_hashes_update AFTER UPDATE OF size, mtime ON {FILES}
+        WHEN old.size IS NOT new.size OR old.mtime IS NOT new.mtime BEGIN
+            DELETE FROM {HASHES} WHERE file_id = old.id;
+        END;
+    """)
+
+
+def _add_image_columns(db):
+    columns = db[FILES].columns_dict
+    for column in ('width', 'height', 'channels', 'bits', 'meta'):
+        if column not in columns:
+            db[FILES].add_column(column, int)
+    # "4K+ EXR" and the like, and resolution order within a root
+    db[FILES].create_index(['ext', 'width'], if_not_exists=True)
+    db[FILES].create_index(['root_id', 'width'], if_not_exists=True)
+    db.executescript(f"""
+        CREATE TRIGGER IF NOT EXISTS {FILES}_meta_update AFTER UPDATE OF size, mtime ON {FILES}
+        WHEN old.size IS NOT new.size OR old.mtime IS NOT new.mtime BEGIN
+            UPDATE {FILES} SET width = NULL, height = NULL, channels = NULL, bits = NULL, meta = NULL
+            WHERE id = old.id;
+        END;
+    """)
+
+
+def _add_audio_columns(db):
+    columns = db[FILES].columns_dict
+    if 'duration' not in columns:
+        db[FILES].add_column('duration', float)
+    if 'sample_rate' not in columns:
+        db[FILES].add_column('sample_rate', int)
+    db[FILES].create_index(['ext', 'duration'], if_not_exists=True)
+    db.executescript(f"""
+        DROP TRIGGER IF EXISTS {FILES}_meta_update;
+        CREATE TRIGGER {FILES}_meta_update AFTER UPDATE OF size, mtime ON {FILES}
+        WHEN old.size IS NOT new.size OR old.mtime IS NOT new.mtime BEGIN
+            UPDATE {FILES} SET width = NULL, height = NULL, channels = NULL, bits = NULL, duration = NULL,
+                sample_rate = NULL, meta = NULL
+            WHERE id = old.id;
+        END;
+    """)
+
+
+def _create_models(db):
+    columns = db[FILES].columns_dict
+    for column in ('vertices', 'triangles'):
+        if column not in columns:
+            db[FILES].add_column(column, int)
+    # "Under 50k triangles" within a file type
+    db[FILES].create_index(['ext', 'triangles'], if_not_exists=True)
+    # Bounding box of all vertices, textures are absolute paths separated by newlines
+    db[MODELS].create({'file_id': int, 'polygons': int, 'min_x': float, 'min_y': float, 'min_z': float,
+                       'max_x': float, 'max_y': float, 'max_z': float, 'textures': str},
+                      pk='file_id', foreign_keys=[('file_id', FILES, 'id')], if_not_exists=True)
+    db.executescript(f"""
+        CREATE TRIGGER IF NOT EXISTS {FILES}_models_delete AFTER DELETE ON {FILES} BEGIN
+            DELETE FROM {MODELS} WHERE file_id = old.id;
+        END;
+        DROP TRIGGER IF EXISTS {FILES}_meta_update;
+        CREATE TRIGGER {FILES}_meta_update AFTER UPDATE OF size, mtime ON {FILES}
+        WHEN old.size IS NOT new.size OR old.mtime IS NOT new.mtime BEGIN
+            UPDATE {FILES} SET width = NULL, height = NULL, channels = NULL, bits = NULL, duration = NULL,
+                sample_rate = NULL, vertices = NULL, triangles = NULL, meta = NULL
+            WHERE id = old.id;
+            DELETE FROM {MODELS} WHERE file_id = old.id;
+        END;
+    """)
+
+
+def _add_phash(db):
+    if 'phash' not in db[FILES].columns_dict:
+        # 64 bits stored signed
+        db[FILES].add_column('phash', int)
+    db.executescript(f"""
+        DROP TRIGGER IF EXISTS {FILES}_meta_update;
+        CREATE TRIGGER {FILES}_meta_update AFTER UPDATE OF size, mtime ON {FILES}
+        WHEN old.size IS NOT new.size OR old.mtime IS NOT new.mtime BEGIN
+            UPDATE {FILES} SET width = NULL, height = NULL, channels = NULL, bits = NULL, duration = NULL,
+                sample_rate = NULL, vertices = NULL, triangles = NULL, phash = NULL, meta = NULL
+            WHERE id = old.id;
+            DELETE FROM {MODELS} WHERE file_id = old.id;
+        END;
+    """)
+
+
+def _create_tree(db):
+    from . import tree
+
+    columns = db[DIRECTORIES].columns_dict
+    for column in ('files', 'bytes'):
+        if column not in columns:
+            db[DIRECTORIES].add_column(column, int, not_null_default=0)
+    db[DIRECTORY_EXTS].create({'dir_id': int, 'ext': str, 'files': int, 'bytes': int}, pk=('dir_id', 'ext'),
+                              foreign_keys=[('dir_id', DIRECTORIES, 'id')], if_not_exists=True)
+    db.executescript(f"""
+        CREATE TRIGGER IF NOT EXISTS {DIRECTORIES}_exts_delete AFTER DELETE ON {DIRECTORIES} BEGIN
+            DELETE FROM {DIRECTORY_EXTS} WHERE dir_id = old.id;
+        END;
+    """)
+    tree.rebuild(db)
+
+
+def _add_snapshot(db):
+    if 'snapshot' not in db[ROOTS].columns_dict:
+        db[ROOTS].add_column('snapshot', str)
+
+
+def _fill_unknown_sizes(db):
+    """Files migrated before the unknown sizes and mtimes were written as 0"""
+    with db.conn:
+        db.conn.execute(f'UPDATE {FILES} SET size = coalesce(size, 0), mtime = coalesce(mtime, 0) '
+                        f'WHERE size IS NULL OR mtime IS NULL')
+
+
+def _add_name_index(db):
+    # Name order of a watched folder read from the index, the rowid after name makes the key unique
+    db[FILES].create_index(['root_id', 'name'], if_not_exists=True)
+
+
+_UPGRADES = [
+    (1, _create_tables),
+    (2, _create_search),
+    (3, _create_sequences),
+    (4, _create_hashes),
+    (5, _add_image_columns),
+    (6, _add_audio_columns),
+    (7, _create_models),
+    (8, _add_phash),
+    (9, _create_tree),
+    (10, _add_snapshot),
+    (11, _fill_unknown_sizes),
+    (12, _add_name_index),
+]
+
+
+def _legacy_roots(db):
+    """Tables of the old layout, one per watched folder named after its path"""
+    for table in db.tables:
+        if table.name in TABLES or table.name.startswith('_') or table.name.startswith('sqlite_'):
+            continue
+        if 'path' in table.columns_dict:
+            yield table
+
+
+def _migrate_table_per_root(db):
+    legacy = list(_legacy_roots(db))
+    if not legacy:
+        return
+    l.info(f'Migrating {len(legacy)} watched folders to the shared schema')
+
+    legacy_dirs = {}
+    if db[_LEGACY_DIRECTORIES].exists():
+        for root, path, mtime in db.execute(f'SELECT root, path, mtime FROM [{_LEGACY_DIRECTORIES}]'):
+            legacy_dirs[(root, path)] = mtime
+
+    with db.conn:
+        for table in legacy:
+            timer_migrate = timer()
+            root = table.name
+            root_id = add_root(db, root, commit=False)
+            columns = table.columns_dict
+            select = ', '.join(x if x in columns else 'NULL' for x in ('path', 'size', 'mtime'))
+            dir_ids = {}
+            rows = []
+            for path, size, mtime in db.execute(f'SELECT {select} FROM [{root}]'):
+                folder, name = os.path.split(os.path.normpath(path))
+                dir_id = dir_ids.get(folder)
+                if dir_id is None:
+                    dir_id = dir_ids[folder] = _migrate_directory(db, root, root_id, folder, dir_ids, legacy_dirs)
+                # Unknown until the directory is listed again, see the module docstring
+                rows.append((root_id, dir_id, name, extension(name), size or 0, mtime or 0))
+            db.conn.executemany(f'INSERT OR IGNORE INTO {FILES} (root_id, dir_id, name, ext, size, mtime) '
+                                f'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            db.conn.execute(f'DROP TABLE [{root}]')
+            l.info(f'Migrated {len(rows)} files of {root} in {timer_migrate}')
+        db.conn.execute(f'DROP TABLE IF EXISTS [{_LEGACY_DIRECTORIES}]')
+
+
+def _migrate_directory(db, root, root_id, folder, dir_ids, legacy_dirs):
+    """Inserts folder and any missing parents up to the root, returns the id of folder"""
+    top = os.path.normpath(root)
+    parent_id = None
+    if folder != top and folder.startswith(top):
+        parent = os.path.dirname(folder)
+        parent_id = dir_ids.get(parent)
+        if parent_id is None:
+            parent_id = dir_ids[parent] = _migrate_directory(db, root, root_id, parent, dir_ids, legacy_dirs)
+    # Without a known mtime the next scan lists the directory again
+    mtime = legacy_dirs.get((root, folder))
+    cursor = db.conn.execute(f'INSERT INTO {DIRECTORIES} (root_id, parent_id, path, mtime) VALUES (?, ?, ?, ?)',
+                             (root_id, parent_id, folder, mtime))
+    return cursor.lastrowid
+
+
+def get_roots(db) -> list:
+    """Paths of all watched folders"""
+    return [path for path, in db.execute(f'SELECT path FROM {ROOTS} ORDER BY path')]
+
+
+def scanned_roots(db) -> list:
+    """Paths of the watched folders that are scanned here and not imported from a snapshot"""
+    return [path for path, in db.execute(f'SELECT path FROM {ROOTS} WHERE snapshot IS NULL ORDER BY path')]
+
+
+def root_id(db, root):
+    row = db.execute(f'SELECT id FROM {ROOTS} WHERE path = ?', [str(root)]).fetchone()
+    return row[0] if row else None
+
+
+def add_root(db, root, commit=True) -> int:
+    """Adds a watched folder and returns its id, adding an existing one returns the existing id"""
+    root = str(root)
+    existing = root_id(db, root)
+    if existing is not None:
+        return existing
+    cursor = db.conn.execute(f'INSERT INTO {ROOTS} (path, added) VALUES (?, ?)', (root, time.time()))
+    if commit:
+        db.conn.commit()
+    return cursor.lastrowid
+
+
+def clear_root(db, root):
+    """Removes every file and directory indexed for a watched folder but keeps the folder"""
+    rid = root_id(db, root)
+    if rid is None:
+        return
+    with db.conn:
+        db.conn.execute(f'DELETE FROM {FILES} WHERE root_id = ?', [rid])
+        db.conn.execute(f'DELETE FROM {DIRECTORIES} WHERE root_id = ?', [rid])
+
+
+def remove_root(db, root):
+    """Removes a watched folder and everything indexed for it"""
+    clear_root(db, root)
+    with db.conn:
+        db.conn.execute(f'DELETE FROM {ROOTS} WHERE path = ?', [str(root)])
+
+
+def root_stats(db) -> list:
+    """RootStats of every watched folder"""
+    # Files and bytes are the totals of the top directory (see tree.py), the only one without a parent.
+    # +root_id makes SQLite look it up by parent_id instead of going through every directory of the root
+    return [RootStats(*row) for row in db.execute(
+        f'SELECT r.path, '
+        f'coalesce((SELECT sum(files) FROM {DIRECTORIES} WHERE parent_id IS NULL AND +root_id = r.id), 0), '
+        f'(SELECT count(*) FROM {DIRECTORIES} WHERE root_id = r.id), '
+        f'coalesce((SELECT sum(bytes) FROM {DIRECTORIES} WHERE parent_id IS NULL AND +root_id = r.id), 0), '
+        f'(SELECT count(*) FROM {SEQUENCES} WHERE root_id = r.id) '
+        f'FROM {ROOTS} r ORDER BY r.path')]
+
+
+def root_files(db, root):
+    """Yields the full path of every file indexed for a watched folder"""
+    rid = root_id(db, root)
+    if rid is None:
+        return
+    join = os.path.join
+    for folder, name in db.execute(f'SELECT d.path, f.name FROM {FILES} f '
+                                   f'JOIN {DIRECTORIES} d ON d.id = f.dir_id WHERE f.root_id = ?', [rid]):
+        yield join(folder, name)
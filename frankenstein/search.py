@@ -0,0 +1,110 @@
+"""
+Substring search over every indexed file.
+
+Backed by the files_fts trigram index (see schema.py), so "brick" or "rain_loop"
+is found anywhere in a file name or in its folders below the watched root. Every
+word of the search text has to match, matches in the file name rank higher than
+matches in the folder.
+
+    search(db, 'brick wall', limit=100)
+"""
+import os
+from collections import namedtuple
+
+from . import query
+from . import schema
+from .blom import get_logger, span, timer
+
+l = get_logger('frankenstein.search')
+
+# The trigram tokenizer can't match shorter words, those fall back to LIKE
+MIN_MATCH_LENGTH = 3
+
+# bm25 weights of the name and folder columns
+NAME_WEIGHT = 10.0
+FOLDER_WEIGHT = 1.0
+
+SearchResult = namedtuple('SearchResult', 'id path score')
+
+
+def _like(term):
+    return '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def _build(db, text, root=None, extensions=None):
+    """Returns the FROM/WHERE part and its parameters, None when nothing can match"""
+    terms = text.split()
+    if not terms:
+        return None
+    long_terms = [x for x in terms if len(x) >= MIN_MATCH_LENGTH]
+    short_terms = [x for x in terms if len(x) < MIN_MATCH_LENGTH]
+
+    clauses = []
+    params = []
+    if long_terms:
+        clauses.append(f'{schema.FILES_FTS} MATCH ?')
+        params.append(' '.join('"' + x.replace('"', '""') + '"' for x in long_terms))
+    for term in short_terms:
+        clauses.append(f"({schema.FILES_FTS}.name LIKE ? ESCAPE '\\' "
+                       f"OR {schema.FILES_FTS}.folder LIKE ? ESCAPE '\\')")
+        params.extend([_like(term), _like(term)])
+
+    filters = query.FileQuery(root, extensions=extensions).where(db)
+    if filters is None:
+        return None
+    where, filter_params = filters
+    if where:
+        clauses.append(where[len('WHERE '):])
+        params.extend(filter_params)
+
+    sql = (f'FROM {schema.FILES_FTS} JOIN {schema.FILES} f ON f.id = {schema.FILES_FTS}.rowid '
+           f'JOIN {schema.DIRECTORIES} d ON d.id = f.dir_id WHERE ' + ' AND '.join(clauses))
+    return sql, params, bool(long_terms)
+
+
+@span('search')
+def search(db, text, root=None, extensions=None, limit=100, offset=0) -> list:
+    """
+    Returns a page of SearchResult for text, best matches first.
+
+    root limits the search to one watched folder and extensions to those file types.
+    """
+    timer_search = timer()
+    built = _build(db, text, root, extensions)
+    if built is None:
+        return []
+    sql, params, ranked = built
+    if ranked:
+        score = f'bm25({schema.FILES_FTS}, {NAME_WEIGHT}, {FOLDER_WEIGHT})'
+        order = 'ORDER BY score, f.name'
+    else:
+        score = '0'
+        order = 'ORDER BY f.name'
+    join = os.path.join
+    results = [SearchResult(file_id, join(folder, name), score) for file_id, folder, name, score in
+               db.execute(f'SELECT f.id, d.path, f.name, {score} AS score {sql} {order} LIMIT ? OFFSET ?',
+                          params + [limit, offset])]
+    l.debug(f'Search for {text!r} returned {len(results)} results in {timer_search}')
+    return results
+
+
+def pages(db, text, root=None, extensions=None, page_size=query.PAGE_SIZE):
+    """Yields lists of matching paths, best matches first, page_size at a time"""
+    offset = 0
+    while True:
+        page = [x.path for x in search(db, text, root, extensions, limit=page_size, offset=offset)]
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        offset += page_size
+
+
+@span('search.count')
+def count(db, text, root=None, extensions=None) -> int:
+    """Number of files matching text"""
+    built = _build(db, text, root, extensions)
+    if built is None:
+        return 0
+    sql, params, ranked = built
+    return db.execute(f'SELECT count(*) {sql}', params).fetchone()[0]
@@ -0,0 +1,284 @@
+"""
+Image sequence detection.
+
+Files are grouped in a single pass with a dict keyed on directory, the text
+before and after the frame number and the extension. The frame number is the
+last run of digits before the extension, so name_0001.exr, name.1001.exr and
+shot010_v2.0001.exr all work. Padding is kept and gaps are reported:
+
+    name.####.exr [1001-1100, 1102-1250]
+
+Sequences are also stored in the index when a directory is scanned (see
+update_directory), so grouping a watched folder is a lookup.
+"""
+import os
+import re
+from collections import namedtuple
+
+from . import query
+from . import schema
+from .blom import get_logger, span, timer
+
+l = get_logger('frankenstein.sequences')
+
+# Only these are grouped, so versioned files like model_v01.ma stay as they are
+SEQUENCE_EXTENSIONS = {'exr', 'dpx', 'cin', 'png', 'jpg', 'jpeg', 'tif', 'tiff', 'tga', 'bmp', 'hdr',
+                       'iff', 'sgi', 'rgb', 'psd', 'webp', 'jp2', 'tx'}
+
+# Fewer frames than this aren't a sequence
+MIN_FRAMES = 2
+
+# Directories read per query by indexed_pages
+DIRECTORY_BATCH = 16
+
+_FRAME = re.compile(r'^(.*?)(\d+)(\D*)$')
+_DISPLAY = re.compile(r'^(.*) \[([0-9, -]+)\]$')
+
+
+class Sequence(namedtuple('Sequence', 'folder prefix suffix ext padding frames')):
+    """
+    A detected sequence, frames is a sorted list of ints.
+
+    prefix and suffix are the text of the file name before and after the frame number.
+    """
+    __slots__ = ()
+
+    @property
+    def pattern(self) -> str:
+        """Path with the frame number replaced by # for every digit of padding"""
+        name = self.prefix + '#' * self.padding + self.suffix + ('.' + self.ext if self.ext else '')
+        return os.path.join(self.folder, name)
+
+    @property
+    def ranges(self) -> list:
+        return frame_ranges(self.frames)
+
+    @property
+    def missing(self) -> int:
+        """Number of frames missing between the first and the last frame"""
+        return self.frames[-1] - self.frames[0] + 1 - len(self.frames)
+
+    def frame_path(self, frame: int) -> str:
+        name = self.prefix + str(frame).zfill(self.padding) + self.suffix + ('.' + self.ext if self.ext else '')
+        return os.path.join(self.folder, name)
+
+    def display(self) -> str:
+        return f'{self.pattern} [{format_ranges(self.ranges)}]'
+
+
+def frame_ranges(frames) -> list:
+    """[(first, last), ...] of consecutive frames in a sorted list"""
+    ranges = []
+    start = previous = None
+    for frame in frames:
+        if start is None:
+            start = previous = frame
+        elif frame == previous + 1:
+            previous = frame
+        elif frame != previous:
+            ranges.append((start, previous))
+            start = previous = frame
+    if start is not None:
+        ranges.append((start, previous))
+    return ranges
+
+
+def format_ranges(ranges) -> str:
+    """1001-1100, 1102-1250"""
+    return ', '.join(str(a) if a == b else f'{a}-{b}' for a, b in ranges)
+
+
+def parse_ranges(text: str) -> list:
+    ranges = []
+    for part in text.split(','):
+        first, _, last = part.strip().partition('-')
+        ranges.append((int(first), int(last or first)))
+    return ranges
+
+
+def split_name(name: str):
+    """Returns (prefix, digits, suffix, ext) of a file name or None when it has no frame number"""
+    stem, ext = os.path.splitext(name)
+    match = _FRAME.match(stem)
+    if match is None:
+        return None
+    prefix, digits, suffix = match.groups()
+    return prefix, digits, suffix, ext[1:]
+
+
+def detect(folder, names, extensions=SEQUENCE_EXTENSIONS):
+    """
+    Groups the file names of one folder.
+
+    Returns (sequences, singles, members) where singles are the names not in any
+    sequence and members holds the frame names of every sequence, in the same order. Pass
+    extensions=None to group every file type.
+    """
+    groups = {}
+    singles = []
+    for name in names:
+        parts = split_name(name)
+        if parts is None or (extensions is not None and parts[3].lower() not in extensions):
+            singles.append(name)
+            continue
+        prefix, digits, suffix, ext = parts
+        groups.setdefault((prefix, suffix, ext), []).append((int(digits), len(digits), name))
+
+    sequences = []
+    members = []
+    for (prefix, suffix, ext), frames in groups.items():
+        if len(frames) < MIN_FRAMES:
+            singles.extend(name for frame, width, name in frames)
+            continue
+        frames.sort()
+        padding = min(width for frame, width, name in frames)
+        sequence = Sequence(folder, prefix, suffix, ext, padding, [frame for frame, width, name in frames])
+        sequences.append(sequence)
+        members.append([name for frame, width, name in frames])
+    return sequences, singles, members
+
+
+def group(paths, extensions=SEQUENCE_EXTENSIONS):
+    """Returns (sequences, singles) for a list of full paths, paths isn't modified"""
+    folders = {}
+    for path in paths:
+        folder, name = os.path.split(path)
+        folders.setdefault(folder, []).append(name)
+
+    sequences = []
+    singles = []
+    for folder, names in folders.items():
+        found, single_names, members = detect(folder, names, extensions)
+        sequences.extend(found)
+        singles.extend(os.path.join(folder, x) for x in single_names)
+    return sequences, singles
+
+
+@span('group.combined')
+def combined(paths, extensions=SEQUENCE_EXTENSIONS) -> list:
+    """Sorted list where the frames of every sequence are replaced by one display entry"""
+    sequences, singles = group(paths, extensions)
+    return sorted(singles + [x.display() for x in sequences])
+
+
+def from_display(text: str):
+    """Returns (pattern, ranges) of an entry made by Sequence.display or None for plain paths"""
+    match = _DISPLAY.match(text)
+    if match is None or '#' not in match.group(1):
+        return None
+    return match.group(1), parse_ranges(match.group(2))
+
+
+def first_frame_path(text: str) -> str:
+    """Path of the first frame of a display entry, plain paths are returned as they are"""
+    parsed = from_display(text)
+    if parsed is None:
+        return text
+    pattern, ranges = parsed
+    folder, name = os.path.split(pattern)
+    padding = name.count('#')
+    return os.path.join(folder, name.replace('#' * padding, str(ranges[0][0]).zfill(padding), 1))
+
+
+@span('group.update_dir')
+def update_directory(db, root_id, dir_id, folder):
+    """
+    Detects the sequences of one indexed directory and stores them.
+
+    Called by the scanner inside its transaction for every directory that changed.
+    """
+    names = [name for name, in db.conn.execute(f'SELECT name FROM {schema.FILES} WHERE dir_id = ?', [dir_id])]
+    found, singles, members = detect(folder, names)
+    db.conn.execute(f'UPDATE {schema.FILES} SET seq_id = NULL WHERE dir_id = ? AND seq_id IS NOT NULL', [dir_id])
+    db.conn.execute(f'DELETE FROM {schema.SEQUENCES} WHERE dir_id = ?', [dir_id])
+    for sequence, names in zip(found, members):
+        seq_id = db.conn.execute(
+            f'INSERT INTO {schema.SEQUENCES} (root_id, dir_id, prefix, suffix, ext, padding, first, last, '
+            f'frames, ranges) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (root_id, dir_id, sequence.prefix, sequence.suffix + ('.' + sequence.ext if sequence.ext else ''),
+             sequence.ext.lower(), sequence.padding,
+             sequence.frames[0], sequence.frames[-1], len(sequence.frames),
+             format_ranges(sequence.ranges))).lastrowid
+        db.conn.executemany(f'UPDATE {schema.FILES} SET seq_id = ? WHERE dir_id = ? AND name = ?',
+                            [(seq_id, dir_id, name) for name in names])
+    return len(found)
+
+
+def _extension_clause(extensions):
+    extensions = sorted({query.normalize_extension(x) for x in extensions or ()} - {''})
+    return (f'AND ext IN ({", ".join("?" * len(extensions))})' if extensions else ''), extensions
+
+
+def indexed_pages(db, root, extensions=None, page_size=query.PAGE_SIZE, folder=None):
+    """
+    Yields the listing of a watched folder with sequences grouped, about page_size entries at a time.
+
+    Straight from the index, files that are part of a sequence are replaced by
+    its display entry. Directories come in path order and are read a batch at a
+    time so big roots never load in one go. folder limits it to that directory
+    and the ones below it.
+    """
+    rid = schema.root_id(db, root)
+    if rid is None:
+        return
+    ext_clause, extensions = _extension_clause(extensions)
+    join = os.path.join
+    last, compare, within, within_params = '', '>', '', []
+    if folder is not None:
+        # Starts at the folder itself, siblings like "folder-2" sort between it and its subdirectories
+        folder = os.path.normpath(str(folder))
+        last, compare = folder, '>='
+        within = 'AND path < ? AND (path = ? OR path >= ?)'
+        within_params = [folder + chr(ord(os.sep) + 1), folder, folder + os.sep]
+    page = []
+    while True:
+        with span('group.dir_batch'):
+            folders = db.execute(f'SELECT id, path FROM {schema.DIRECTORIES} WHERE root_id = ? AND path {compare} ? '
+                                 f'{within} ORDER BY path LIMIT ?',
+                                 [rid, last] + within_params + [DIRECTORY_BATCH]).fetchall()
+            if not folders:
+                break
+            last, compare = folders[-1][1], '>'
+
+            ids = [x[0] for x in folders]
+            in_clause = f'dir_id IN ({", ".join("?" * len(ids))})'
+            names = {}
+            for dir_id, name in db.execute(f'SELECT dir_id, name FROM {schema.FILES} WHERE {in_clause} '
+                                           f'AND seq_id IS NULL {ext_clause}', ids + extensions):
+                names.setdefault(dir_id, []).append(name)
+            for dir_id, prefix, suffix, padding, ranges in db.execute(
+                    f'SELECT dir_id, prefix, suffix, padding, ranges FROM {schema.SEQUENCES} '
+                    f'WHERE {in_clause} {ext_clause}', ids + extensions):
+                names.setdefault(dir_id, []).append(f'{prefix + "#" * padding + suffix} [{ranges}]')
+            for dir_id, folder in folders:
+                page.extend(join(folder, x) for x in sorted(names.get(dir_id, ())))
+        if len(page) >= page_size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+def indexed(db, root, extensions=None) -> list:
+    """Listing of a watched folder with sequences grouped, see indexed_pages"""
+    timer_grouped = timer()
+    listing = [x for page in indexed_pages(db, root, extensions) for x in page]
+    l.info(f'Grouped listing of {root} in {timer_grouped}')
+    return listing
+
+
+@span('group.count')
+def indexed_count(db, root, extensions=None, folder=None) -> int:
+    """Number of entries in the grouped listing of a watched folder, or of a folder in it"""
+    rid = schema.root_id(db, root)
+    if rid is None:
+        return 0
+    ext_clause, extensions = _extension_clause(extensions)
+    where, params = 'root_id = ?', [rid]
+    if folder is not None:
+        where, params = query.folder_clause(folder, rid, 'dir_id')
+    singles = db.execute(f'SELECT count(*) FROM {schema.FILES} WHERE {where} AND seq_id IS NULL {ext_clause}',
+                         params + extensions).fetchone()[0]
+    found = db.execute(f'SELECT count(*) FROM {schema.SEQUENCES} WHERE {where} {ext_clause}',
+                       params + extensions).fetchone()[0]
+    return singles + found
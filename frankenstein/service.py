@@ -0,0 +1,552 @@
+"""
+Index service: one process owns the index and answers queries over HTTP.
+
+A shared database.db on a network drive gets locked by every client that
+writes to it and every query goes over the network page by page. With the
+service one machine (or one user session) holds the index, scans are jobs run
+one after the other by a single writer and queries are spread over a pool of
+read-only connections. In WAL mode a scan never blocks a read:
+
+    python -m frankenstein serve --port 8765
+    python -m frankenstein serve --socket /tmp/frankenstein.sock
+
+LocalIndex and RemoteIndex have the same query methods, the GUI takes either
+(see main.py, FRANKENSTEIN_SERVICE picks the service and the GUI doesn't open
+an index file of its own then). Listings, the folder tree, similar images and
+duplicates all go through them:
+
+    index = service.open_index('http://assets:8765')    # or LocalIndex(db)
+    for page in index.files(query.FileQuery('/mnt/assets', ['exr'])):
+        ...
+
+Paging works like FileQuery.pages: the first request answers the first page
+and a cursor, the cursor is asked for every next one. The service keeps the
+page generators, no read transaction stays open in between. There is no
+authentication, the service listens on localhost unless told otherwise.
+"""
+import http.client
+import json
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from . import hashing
+from . import query
+from . import schema
+from . import search
+from . import sequences
+from . import tree
+from .blom import count, get_logger, span, timer
+
+l = get_logger('frankenstein.service')
+
+DEFAULT_PORT = 8765
+# Read connections, one per query running at the same time
+DEFAULT_READERS = 8
+# Seconds a cursor is kept after its last page was asked for
+CURSOR_TIMEOUT = 300
+MAX_CURSORS = 1000
+# Seconds a client waits for an answer
+REQUEST_TIMEOUT = 60
+# Seconds the service keeps an idle client connection open
+IDLE_TIMEOUT = 30
+# Changed rows committed per transaction while scanning, like the GUI does
+BATCH_SIZE = 5000
+
+# Environment variable with the address of the service the GUI uses
+SERVICE_VARIABLE = 'FRANKENSTEIN_SERVICE'
+
+
+class ServiceError(Exception):
+    pass
+
+
+class _Rows:
+    """Rows of a finished query with the fetch methods of a cursor"""
+
+    def __init__(self, rows):
+        self._rows = rows
+        self._next = 0
+
+    def __iter__(self):
+        rows, self._rows = self._rows[self._next:], []
+        return iter(rows)
+
+    def fetchone(self):
+        if self._next >= len(self._rows):
+            return None
+        self._next += 1
+        return self._rows[self._next - 1]
+
+    def fetchmany(self, size=1):
+        rows = self._rows[self._next:self._next + size]
+        self._next += len(rows)
+        return rows
+
+    def fetchall(self):
+        return list(self)
+
+
+class ReadPool:
+    """
+    Read-only connections to the index with the execute of schema.Database.
+
+    Every execute borrows a connection, reads all rows and gives it back, so
+    the query functions of query.py, search.py and sequences.py run on the
+    pool as they are and one page never waits for another.
+    """
+
+    def __init__(self, path, size=DEFAULT_READERS):
+        self._idle = queue.Queue()
+        self._all = [schema.connect(path, read_only=True) for _ in range(size)]
+        for db in self._all:
+            self._idle.put(db)
+
+    def execute(self, sql, parameters=None) -> _Rows:
+        waited = time.perf_counter()
+        db = self._idle.get()
+        count('service.pool_wait_us', int((time.perf_counter() - waited) * 1_000_000))
+        try:
+            return _Rows(db.execute(sql, parameters).fetchall())
+        finally:
+            self._idle.put(db)
+
+    def close(self):
+        for db in self._all:
+            db.conn.close()
+
+
+class LocalIndex:
+    """The query methods on an index file (or a ReadPool), what the GUI uses without a service"""
+
+    def __init__(self, db):
+        self.db = db
+        # similar.SimilarityIndex of every image hash, loaded when it's first used
+        self._similar = None
+
+    def roots(self) -> list:
+        return schema.get_roots(self.db)
+
+    def files(self, files, page_size=query.PAGE_SIZE):
+        """Pages of the paths a query.FileQuery matches"""
+        return files.pages(self.db, page_size)
+
+    def count(self, files) -> int:
+        return files.count(self.db)
+
+    def search(self, text, root=None, extensions=None, page_size=query.PAGE_SIZE):
+        return search.pages(self.db, text, root, extensions, page_size)
+
+    def search_count(self, text, root=None, extensions=None) -> int:
+        return search.count(self.db, text, root, extensions)
+
+    def sequences(self, root, extensions=None, folder=None, page_size=query.PAGE_SIZE):
+        """Pages of a watched folder with image sequences as one entry"""
+        return sequences.indexed_pages(self.db, root, extensions, page_size, folder)
+
+    def sequence_count(self, root, extensions=None, folder=None) -> int:
+        return sequences.indexed_count(self.db, root, extensions, folder)
+
+    def tree_top(self, root):
+        """tree.Folder of a watched folder, None when it wasn't scanned yet"""
+        return tree.top(self.db, root)
+
+    def tree_folder(self, dir_id):
+        return tree.folder(self.db, dir_id)
+
+    def tree_children(self, dir_id) -> list:
+        return tree.children(self.db, dir_id)
+
+    def similar(self, path, limit=50, value=None):
+        """
+        Paths of the images that look like the one at path, nearest first.
+
+        value is the hash to look for when path has none yet, None is answered
+        when neither is there.
+        """
+        from . import similar
+
+        file_id = similar.file_id(self.db, path)
+        if value is None:
+            value = similar.file_hash(self.db, file_id) if file_id is not None else None
+            if value is None:
+                return None
+        if self._similar is None:
+            self._similar = similar.SimilarityIndex.load(self.db)
+        found = self._similar.nearest(value, limit, exclude=file_id)
+        return [x for x in similar.paths(self.db, [x for x, distance in found]) if x is not None]
+
+    def similar_stale(self):
+        """Loads the image hashes again the next time, after new ones were stored or files changed"""
+        self._similar = None
+
+    def duplicates(self, root=None) -> list:
+        """hashing.DuplicateGroup of the files hashed so far, nothing is read from disk"""
+        return hashing.duplicates(self.db, root)
+
+
+class _Cursors:
+    """Page generators of running listings by id, forgotten when they aren't asked for"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # id: [generator, last used]
+        self._cursors = {}
+
+    def expire(self):
+        """Forgets the cursors nobody asked for in CURSOR_TIMEOUT seconds"""
+        with self._lock:
+            now = time.monotonic()
+            for key, (generator, used) in list(self._cursors.items()):
+                if now - used > CURSOR_TIMEOUT:
+                    del self._cursors[key]
+
+    def first(self, pages) -> dict:
+        """Answer with the first page of pages and a cursor for the rest"""
+        cursor = uuid.uuid4().hex
+        with self._lock:
+            now = time.monotonic()
+            while len(self._cursors) >= MAX_CURSORS:
+                del self._cursors[min(self._cursors, key=lambda x: self._cursors[x][1])]
+            self._cursors[cursor] = [iter(pages), now]
+        return self.next(cursor)
+
+    def next(self, cursor) -> dict:
+        with self._lock:
+            entry = self._cursors.get(cursor)
+            if entry is None:
+                raise KeyError(cursor)
+            entry[1] = time.monotonic()
+        # A generator runs in one thread at a time, a client asks for its pages one after the other
+        page = next(entry[0], None)
+        if page is None:
+            with self._lock:
+                self._cursors.pop(cursor, None)
+            return {'page': [], 'cursor': None}
+        return {'page': page, 'cursor': cursor}
+
+
+class _ScanJobs(threading.Thread):
+    """The only writer: runs scan jobs one after the other on its own connection"""
+
+    def __init__(self, path, stages, done=None):
+        threading.Thread.__init__(self, name='service-writer', daemon=True)
+        self.path = path
+        self.stages = stages
+        # Called after every job that finished
+        self.done = done
+        self.queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def submit(self, roots, incremental=True) -> str:
+        job = uuid.uuid4().hex
+        with self._lock:
+            self._jobs[job] = {'roots': roots, 'incremental': incremental, 'state': 'queued', 'stats': None,
+                               'error': None}
+        self.queue.put(job)
+        return job
+
+    def status(self, job) -> dict:
+        with self._lock:
+            return dict(self._jobs[job])
+
+    def _set(self, job, **values):
+        with self._lock:
+            self._jobs[job].update(values)
+
+    def stop(self):
+        self.queue.put(None)
+
+    def run(self):
+        from . import scanner
+
+        db = schema.connect(self.path)
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            status = self.status(job)
+            self._set(job, state='running')
+            timer_job = timer()
+            try:
+                stats = scanner.ScanStats(0, 0, 0, 0, 0)
+                for root in status['roots']:
+                    scanner.ensure_tables(db, root)
+                    scanned = scanner.scan_root(db, root, status['incremental'], batch_size=BATCH_SIZE)
+                    stats = scanner.add_stats(stats, scanned)
+                    for update in self.stages:
+                        update(db, root)
+            except Exception as e:
+                l.exception(f'Scan job {job} failed')
+                self._set(job, state='failed', error=str(e))
+                continue
+            self._set(job, state='done', stats=stats._asdict())
+            if self.done is not None:
+                self.done()
+            l.info(f'Scan job {job} of {len(status["roots"])} folders done in {timer_job}')
+        db.conn.close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """JSON in, JSON out, the routes are in IndexService.routes"""
+    protocol_version = 'HTTP/1.1'
+    # Idle keep-alive connections are closed, clients open a new one
+    timeout = IDLE_TIMEOUT
+
+    def _answer(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        self.server.service.cursors.expire()
+        path = urlsplit(self.path).path
+        route = self.server.service.routes.get((method, path))
+        if route is None:
+            self._answer(404, {'error': f'No {method} {path}'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length)) if length else {}
+            with span('service.request', route=path):
+                answer = route(body)
+        except KeyError as e:
+            self._answer(404, {'error': f'Unknown {e.args[0]}'})
+        except (TypeError, ValueError) as e:
+            self._answer(400, {'error': str(e)})
+        except Exception as e:
+            l.exception(f'{method} {path} failed')
+            self._answer(500, {'error': str(e)})
+        else:
+            self._answer(200, answer)
+        count('service.requests')
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+
+    def log_message(self, format, *args):
+        l.debug(f'{self.address_string()} {format % args}')
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class IndexService:
+    """The HTTP server, the read pool and the writer of one index file"""
+
+    def __init__(self, path, readers=DEFAULT_READERS, stages=None):
+        db = schema.connect(path)
+        schema.ensure_schema(db)
+        db.conn.close()
+        self.pool = ReadPool(path, readers)
+        self.index = LocalIndex(self.pool)
+        self.cursors = _Cursors()
+        self.jobs = _ScanJobs(path, stages or (), self.index.similar_stale)
+        self.server = None
+        self.routes = {
+            ('GET', '/roots'): lambda body: {'roots': self.index.roots()},
+            ('POST', '/files'): lambda body: self.cursors.first(
+                self.index.files(query.FileQuery(**body['query']), body.get('page_size', query.PAGE_SIZE))),
+            ('POST', '/files/count'): lambda body: {'count': self.index.count(query.FileQuery(**body['query']))},
+            ('POST', '/search'): lambda body: self.cursors.first(
+                self.index.search(body['text'], body.get('root'), body.get('extensions'),
+                                  body.get('page_size', query.PAGE_SIZE))),
+            ('POST', '/search/count'): lambda body: {'count': self.index.search_count(
+                body['text'], body.get('root'), body.get('extensions'))},
+            ('POST', '/sequences'): lambda body: self.cursors.first(
+                self.index.sequences(body['root'], body.get('extensions'), body.get('folder'),
+                                     body.get('page_size', query.PAGE_SIZE))),
+            ('POST', '/sequences/count'): lambda body: {'count': self.index.sequence_count(
+                body['root'], body.get('extensions'), body.get('folder'))},
+            ('POST', '/tree/top'): lambda body: {'folder': self.index.tree_top(body['root'])},
+            ('POST', '/tree/folder'): lambda body: {'folder': self.index.tree_folder(body['id'])},
+            ('POST', '/tree/children'): lambda body: {'folders': self.index.tree_children(body['id'])},
+            ('POST', '/similar'): lambda body: {'paths': self.index.similar(
+                body['path'], body.get('limit', 50), body.get('value'))},
+            ('POST', '/duplicates'): lambda body: {'groups': [
+                (x.size, x.digest.hex(), x.paths) for x in self.index.duplicates(body.get('root'))]},
+            ('POST', '/next'): lambda body: self.cursors.next(body['cursor']),
+            ('POST', '/scan'): lambda body: {'job': self.jobs.submit(list(body['roots']),
+                                                                     body.get('incremental', True))},
+            ('POST', '/job'): lambda body: self.jobs.status(body['job']),
+        }
+
+    def listen(self, host='127.0.0.1', port=DEFAULT_PORT, socket_path=None):
+        """Opens the socket, serve_forever answers on it"""
+        if socket_path is not None:
+            # Left behind by a service that didn't stop cleanly
+            if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                os.unlink(socket_path)
+            self.server = _UnixHTTPServer(socket_path, _Handler)
+        else:
+            self.server = ThreadingHTTPServer((host, port), _Handler)
+            self.server.daemon_threads = True
+        self.server.service = self
+        return self.server.server_address
+
+    def serve_forever(self):
+        self.jobs.start()
+        l.info(f'Serving the index on {self.server.server_address}')
+        try:
+            self.server.serve_forever()
+        finally:
+            self.jobs.stop()
+
+    def shutdown(self):
+        """Stops serve_forever from another thread"""
+        self.server.shutdown()
+        self.server.server_close()
+        self.pool.close()
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class RemoteIndex:
+    """The query methods of LocalIndex answered by a service, plus scan jobs"""
+
+    def __init__(self, address, timeout=REQUEST_TIMEOUT):
+        """address is http://host:port or unix:/path/to/socket"""
+        self.address = address
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if self.address.startswith('unix:'):
+                connection = _UnixConnection(self.address[len('unix:'):], self.timeout)
+            else:
+                parts = urlsplit(self.address)
+                connection = http.client.HTTPConnection(parts.hostname, parts.port or DEFAULT_PORT,
+                                                        timeout=self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def _drop(self, connection):
+        connection.close()
+        self._local.connection = None
+
+    def _request(self, method, path, body=None) -> dict:
+        data = json.dumps(body).encode() if body is not None else None
+        with span('service.call', route=path):
+            for attempt in range(2):
+                connection = self._connection()
+                reused = connection.sock is not None
+                try:
+                    connection.request(method, path, data, {'Content-Type': 'application/json'})
+                    response = connection.getresponse()
+                except (BrokenPipeError, ConnectionResetError) as e:
+                    self._drop(connection)
+                    # A kept connection the service closed while it was idle fails before a byte is answered, only
+                    # then the request is sent again: anything else may have run already and /next can't run twice
+                    if reused and not attempt:
+                        continue
+                    raise ServiceError(f'No answer from {self.address}: {e}')
+                except (OSError, http.client.HTTPException) as e:
+                    self._drop(connection)
+                    raise ServiceError(f'No answer from {self.address}: {e}')
+                try:
+                    answer = json.loads(response.read() or b'{}')
+                except (OSError, http.client.HTTPException, ValueError) as e:
+                    self._drop(connection)
+                    raise ServiceError(f'Broken answer from {self.address}: {e}')
+                break
+        if response.status != 200:
+            raise ServiceError(answer.get('error', f'{method} {path} answered {response.status}'))
+        return answer
+
+    def _pages(self, path, body):
+        answer = self._request('POST', path, body)
+        while True:
+            if answer['page']:
+                yield answer['page']
+            if answer['cursor'] is None:
+                return
+            answer = self._request('POST', '/next', {'cursor': answer['cursor']})
+
+    def roots(self) -> list:
+        return self._request('GET', '/roots')['roots']
+
+    def files(self, files, page_size=query.PAGE_SIZE):
+        return self._pages('/files', {'query': vars(files), 'page_size': page_size})
+
+    def count(self, files) -> int:
+        return self._request('POST', '/files/count', {'query': vars(files)})['count']
+
+    def search(self, text, root=None, extensions=None, page_size=query.PAGE_SIZE):
+        return self._pages('/search', {'text': text, 'root': root, 'extensions': extensions,
+                                       'page_size': page_size})
+
+    def search_count(self, text, root=None, extensions=None) -> int:
+        return self._request('POST', '/search/count', {'text': text, 'root': root, 'extensions': extensions})['count']
+
+    def sequences(self, root, extensions=None, folder=None, page_size=query.PAGE_SIZE):
+        return self._pages('/sequences', {'root': root, 'extensions': extensions, 'folder': folder,
+                                          'page_size': page_size})
+
+    def sequence_count(self, root, extensions=None, folder=None) -> int:
+        return self._request('POST', '/sequences/count', {'root': root, 'extensions': extensions,
+                                                          'folder': folder})['count']
+
+    def tree_top(self, root):
+        found = self._request('POST', '/tree/top', {'root': root})['folder']
+        return None if found is None else tree.Folder(*found)
+
+    def tree_folder(self, dir_id):
+        found = self._request('POST', '/tree/folder', {'id': dir_id})['folder']
+        return None if found is None else tree.Folder(*found)
+
+    def tree_children(self, dir_id) -> list:
+        return [tree.Folder(*x) for x in self._request('POST', '/tree/children', {'id': dir_id})['folders']]
+
+    def similar(self, path, limit=50, value=None):
+        return self._request('POST', '/similar', {'path': path, 'limit': limit, 'value': value})['paths']
+
+    def similar_stale(self):
+        # The service loads its hashes again after its scan jobs
+        pass
+
+    def duplicates(self, root=None) -> list:
+        groups = self._request('POST', '/duplicates', {'root': root})['groups']
+        return [hashing.DuplicateGroup(size, bytes.fromhex(digest), paths) for size, digest, paths in groups]
+
+    def scan(self, roots, incremental=True) -> str:
+        """Queues a scan of watched folders (added when they aren't yet), returns the job id"""
+        return self._request('POST', '/scan', {'roots': list(roots), 'incremental': incremental})['job']
+
+    def job(self, job) -> dict:
+        """state (queued, running, done or failed), stats and error of a scan job"""
+        return self._request('POST', '/job', {'job': job})
+
+
+def open_index(address, db=None):
+    """RemoteIndex of a service address, LocalIndex of db when there is none"""
+    return RemoteIndex(address) if address else LocalIndex(db)
@@ -0,0 +1,229 @@
+"""
+Visual similarity of images through 64 bit perceptual hashes.
+
+The hash is made when the thumbnail is (see thumbnails.py): the image is scaled
+to 32x32 gray pixels, the lowest 8x8 frequencies of its DCT are compared to
+their median and give one bit each. Images that look alike have hashes that
+differ in few bits, a Hamming distance up to about 10 is the same picture
+scaled, recompressed or slightly graded. The hash is stored in files.phash and
+reset when the file changes.
+
+SimilarityIndex keeps every hash in one contiguous uint64 array and compares a
+query against all of them at once, about 15 ms per million hashes. From
+MULTI_INDEX_SIZE hashes on it builds a multi-index: the hashes split into 4
+bands of 16 bits, each band sorted. Two hashes within d bits have at least one
+band within d // 4 bits, so only the hashes with a band that close to the query
+are compared and the result is the same as that of a scan:
+
+    index = SimilarityIndex.load(db)
+    for file_id, distance in index.nearest(index.hash_of(file_id), 50):
+        ...
+"""
+import os
+
+import numpy as np
+
+from . import schema
+from .blom import count, get_logger, span, timer
+
+l = get_logger('frankenstein.similar')
+
+HASH_SIZE = 32
+# Hashes within this distance are shown as similar
+MAX_DISTANCE = 12
+# Hashes from which nearest uses the multi-index before scanning
+MULTI_INDEX_SIZE = 1_000_000
+BANDS = 4
+BAND_BITS = 64 // BANDS
+# Above this many bits per band there are so many candidates a scan is faster
+MAX_BAND_DISTANCE = 3
+
+# Every 16 bit value with at most n bits set, per n
+_BAND_MASKS = None
+# cos(pi * (2n + 1) * k / 2N) of the 8 lowest frequencies
+_DCT = np.cos(np.pi * (2 * np.arange(HASH_SIZE)[None, :] + 1) * np.arange(8)[:, None] / (2 * HASH_SIZE))
+
+
+def phash(pixels) -> int:
+    """Perceptual hash of a (32, 32) array of gray pixels, as an unsigned 64 bit int"""
+    frequencies = _DCT @ np.asarray(pixels, np.float64) @ _DCT.T
+    # The DC term is the average brightness and would skew the median
+    values = frequencies.ravel()[1:]
+    bits = np.concatenate([[False], values > np.median(values)])
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def distance(a: int, b: int) -> int:
+    """Number of bits two hashes differ in"""
+    return bin(a ^ b).count('1')
+
+
+def _to_sql(value: int) -> int:
+    """SQLite integers are signed"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _from_sql(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+def _popcount(values):
+    """Set bits of every uint64 in an array, overwrites it"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    # numpy before 2.0 has no bitwise_count, the bits are summed in pairs, nibbles and bytes
+    shifted = values >> np.uint64(1)
+    shifted &= np.uint64(0x5555555555555555)
+    values -= shifted
+    np.right_shift(values, np.uint64(2), out=shifted)
+    shifted &= np.uint64(0x3333333333333333)
+    values &= np.uint64(0x3333333333333333)
+    values += shifted
+    np.right_shift(values, np.uint64(4), out=shifted)
+    values += shifted
+    values &= np.uint64(0x0f0f0f0f0f0f0f0f)
+    values *= np.uint64(0x0101010101010101)
+    values >>= np.uint64(56)
+    return values.astype(np.uint8)
+
+
+def _band_masks(bits):
+    """16 bit values with at most bits set, to flip the bits of a band with"""
+    global _BAND_MASKS
+    if _BAND_MASKS is None:
+        values = np.arange(1 << BAND_BITS, dtype=np.uint64)
+        _BAND_MASKS = _popcount(values.copy()), values.astype(np.uint16)
+    set_bits, values = _BAND_MASKS
+    return values[set_bits <= bits]
+
+
+def store(db, rows):
+    """Stores (file id, size, mtime, hash) rows, only for files that still have that size and mtime"""
+    with db.conn:
+        db.conn.executemany(f'UPDATE {schema.FILES} SET phash = ? WHERE id = ? AND size IS ? AND mtime IS ?',
+                            [(_to_sql(value), file_id, size, mtime) for file_id, size, mtime, value in rows])
+
+
+def file_hash(db, file_id):
+    """Hash of a file, None when it wasn't made yet"""
+    row = db.execute(f'SELECT phash FROM {schema.FILES} WHERE id = ?', [file_id]).fetchone()
+    return None if row is None or row[0] is None else _from_sql(row[0])
+
+
+def file_id(db, path):
+    """Id of an indexed file, None when it isn't indexed"""
+    row = db.execute(f'SELECT f.id FROM {schema.FILES} f JOIN {schema.DIRECTORIES} d ON d.id = f.dir_id '
+                     f'WHERE d.path = ? AND f.name = ?', [os.path.dirname(path), os.path.basename(path)]).fetchone()
+    return None if row is None else row[0]
+
+
+def paths(db, file_ids) -> list:
+    """Paths of file ids in the same order, None for ids that are gone"""
+    found = {}
+    for start in range(0, len(file_ids), 500):
+        batch = list(file_ids[start:start + 500])
+        for file_id, folder, name in db.execute(
+                f'SELECT f.id, d.path, f.name FROM {schema.FILES} f JOIN {schema.DIRECTORIES} d ON d.id = f.dir_id '
+                f'WHERE f.id IN ({", ".join("?" * len(batch))})', batch):
+            found[file_id] = os.path.join(folder, name)
+    return [found.get(x) for x in file_ids]
+
+
+class SimilarityIndex:
+    """Hashes of images and their file ids in two arrays, sorted by file id"""
+
+    def __init__(self, file_ids, hashes):
+        self.file_ids = np.ascontiguousarray(file_ids, np.int64)
+        self.hashes = np.ascontiguousarray(hashes, np.uint64)
+        self._bands = None
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @classmethod
+    def load(cls, db, root=None):
+        """Every hash in the index, or of one watched folder"""
+        timer_load = timer()
+        clause = 'AND root_id = ?' if root is not None else ''
+        params = [schema.root_id(db, root)] if root is not None else []
+        with span('similar.load'):
+            rows = db.execute(f'SELECT id, phash FROM {schema.FILES} WHERE phash IS NOT NULL {clause} ORDER BY id',
+                              params).fetchall()
+            if rows:
+                file_ids, hashes = zip(*rows)
+            else:
+                file_ids, hashes = (), ()
+            # Stored signed, the bits are the same
+            index = cls(np.array(file_ids, np.int64), np.array(hashes, np.int64).view(np.uint64))
+        l.info(f'Loaded {len(index)} image hashes in {timer_load}')
+        return index
+
+    def hash_of(self, file_id):
+        """Hash of a file in the index, None when it has none"""
+        position = np.searchsorted(self.file_ids, file_id)
+        if position < len(self.file_ids) and self.file_ids[position] == file_id:
+            return int(self.hashes[position])
+        return None
+
+    def distances(self, value: int, positions=None):
+        """Distance of every hash in the index (or those at positions) to value"""
+        hashes = self.hashes if positions is None else self.hashes[positions]
+        return _popcount(hashes ^ np.uint64(value))
+
+    def _build_bands(self):
+        """Per band the sorted band values and the positions of their hashes"""
+        bands = []
+        for band in range(BANDS):
+            keys = (self.hashes >> np.uint64(band * BAND_BITS)).astype(np.uint16)
+            order = np.argsort(keys, kind='stable')
+            bands.append((keys[order], order))
+        self._bands = bands
+
+    def _candidates(self, value: int, bits):
+        """Positions of the hashes with a band within bits of that band of value"""
+        if self._bands is None:
+            with span('similar.build_bands', hashes=len(self)):
+                self._build_bands()
+        masks = _band_masks(bits)
+        found = []
+        for band, (keys, order) in enumerate(self._bands):
+            probes = np.uint16((value >> (band * BAND_BITS)) & ((1 << BAND_BITS) - 1)) ^ masks
+            starts = np.searchsorted(keys, probes, 'left')
+            lengths = np.searchsorted(keys, probes, 'right') - starts
+            # The ranges of all probes one after the other
+            ends = np.cumsum(lengths)
+            offsets = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - lengths - starts, lengths)
+            found.append(order[offsets])
+        return np.unique(np.concatenate(found))
+
+    @span('similar.nearest')
+    def nearest(self, value: int, limit=50, max_distance=MAX_DISTANCE, exclude=None) -> list:
+        """
+        (file id, distance) of the limit hashes closest to value, nearest first.
+
+        Only hashes within max_distance bits are returned, exclude is a file id
+        to leave out (usually the image the search started from).
+        """
+        if not len(self):
+            return []
+        if len(self) >= MULTI_INDEX_SIZE and max_distance // BANDS <= MAX_BAND_DISTANCE:
+            positions = self._candidates(value, max_distance // BANDS)
+            found = self.distances(value, positions)
+            keep = found <= max_distance
+            positions, found = positions[keep], found[keep]
+            count('similar.multi_index')
+        else:
+            found = self.distances(value)
+            positions = np.flatnonzero(found <= max_distance)
+            found = found[positions]
+            count('similar.scans')
+        if exclude is not None:
+            keep = self.file_ids[positions] != exclude
+            positions, found = positions[keep], found[keep]
+        found = found.astype(np.int64)
+        if len(positions) > limit:
+            best = np.argpartition(found, limit)[:limit]
+            positions, found = positions[best], found[best]
+        # Nearest first, by file id within the same distance
+        order = np.lexsort((self.file_ids[positions], found))
+        return [(int(self.file_ids[x]), int(found[i])) for i, x in zip(order, positions[order])]
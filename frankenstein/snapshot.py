@@ -0,0 +1,730 @@
+"""
+Compact read-only snapshots of the index, to share one scan with many workstations.
+
+The file server scans the NAS and exports a snapshot, workstations import it
+into their own index (or query it as it is) instead of scanning the same
+folders again:
+
+    python -m frankenstein export /mnt/share/index/full.snap
+    python -m frankenstein import /mnt/share/index/full.snap
+
+A snapshot is one file: a JSON header with the offset of every section and the
+sections after it, 8 byte aligned so each one is a numpy array straight on the
+memory map. Opening a snapshot only reads the header. Directory paths and file
+names are sorted and front coded, every string stores how many bytes it shares
+with the one before it and the rest, every RESTART-th string whole so any one
+can be decoded from the one at its restart point. The rest is a column per
+field of the files table. Columns most files have no value in (durations of
+images, triangles of sounds) only hold the files that have one.
+
+A delta carries the changes between two full snapshots: every directory of the
+new one, the files that are new or changed and the names of those that are
+gone. It can only be imported on top of the snapshot it was made from,
+roots.snapshot remembers which one that is for every watched folder:
+
+    python -m frankenstein export today.snap --base yesterday.snap --delta today.delta
+    python -m frankenstein import today.delta
+
+Imports go through scanner.apply_batch like the changes of a scan, so the
+search index, image sequences and folder totals follow. Content hashes (see
+hashing.py) aren't part of a snapshot. Paths are stored as they are, the
+folders have to be mounted at the same place on every workstation.
+"""
+import json
+import mmap
+import os
+import struct
+import time
+import uuid
+from bisect import bisect_left
+
+import numpy as np
+
+from . import schema
+from . import scanner
+from .blom import count, get_logger, span, timer
+
+l = get_logger('frankenstein.snapshot')
+
+MAGIC = b'FRKSNAP\x00'
+FORMAT = 1
+# Strings stored whole every this many, the most a lookup decodes
+RESTART = 16
+ALIGN = 8
+# Changed files written per transaction while importing
+BATCH_SIZE = 5000
+
+# Columns of the files table and their type in a snapshot, values that are NULL are stored as 0
+FILE_COLUMNS = (('size', 'i8'), ('mtime', 'f8'), ('width', 'i4'), ('height', 'i4'), ('channels', 'i2'),
+                ('bits', 'i2'), ('meta', 'i1'), ('duration', 'f8'), ('sample_rate', 'i4'), ('vertices', 'i8'),
+                ('triangles', 'i8'), ('phash', 'i8'))
+MODEL_COLUMNS = (('polygons', 'i8'), ('min_x', 'f8'), ('min_y', 'f8'), ('min_z', 'f8'), ('max_x', 'f8'),
+                 ('max_y', 'f8'), ('max_z', 'f8'))
+# Written by the importer after the rows are, everything but size and mtime
+_DETAIL_COLUMNS = FILE_COLUMNS[2:]
+
+# Rows read from the index at once while exporting
+_CHUNK = 100_000
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _encode(text: str) -> bytes:
+    # Names that aren't valid UTF-8 on disk come back from os.listdir with surrogates
+    return text.encode('utf-8', 'surrogateescape')
+
+
+def _decode(data: bytes) -> str:
+    return data.decode('utf-8', 'surrogateescape')
+
+
+def _aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _shared(a: bytes, b: bytes) -> int:
+    """Length of the common prefix of a and b, up to what a prefix length can hold"""
+    length = min(len(a), len(b), 0xffff)
+    # The first byte that differs is the highest set one of both as big endian numbers xor'ed
+    different = int.from_bytes(a[:length], 'big') ^ int.from_bytes(b[:length], 'big')
+    return length - (different.bit_length() + 7) // 8
+
+
+class _Writer:
+    """Sections of a snapshot, written in one go by write"""
+
+    def __init__(self):
+        self.sections = {}
+
+    def array(self, name, values, dtype=None):
+        self.sections[name] = np.ascontiguousarray(values, dtype)
+
+    def strings(self, name, values, front=True):
+        """Strings as offsets into their bytes, front coded when they are sorted"""
+        prefixes = np.zeros(len(values), np.uint16)
+        chunks = []
+        lengths = np.zeros(len(values) + 1, np.int64)
+        previous = b''
+        for i, value in enumerate(values):
+            data = _encode(value)
+            shared = _shared(previous, data) if front and i % RESTART else 0
+            prefixes[i] = shared
+            chunks.append(data[shared:])
+            lengths[i + 1] = len(data) - shared
+            previous = data
+        offsets = np.cumsum(lengths)
+        if front:
+            self.array(f'{name}.prefix', prefixes)
+        self.array(f'{name}.offsets', offsets, np.uint32 if offsets[-1] < 1 << 32 else np.uint64)
+        self.array(f'{name}.data', np.frombuffer(b''.join(chunks), np.uint8))
+
+    def column(self, name, values, valid, dtype):
+        """A column with NULLs, only its values when that's smaller than a value for every row"""
+        values = np.asarray(values, dtype)
+        valid = np.asarray(valid, bool)
+        present = int(np.count_nonzero(valid))
+        if present == len(valid):
+            self.array(name, values)
+        elif present * (values.itemsize + 4) < len(valid) * values.itemsize:
+            self.array(f'{name}.index', np.flatnonzero(valid), np.uint32)
+            self.array(name, values[valid])
+        else:
+            self.array(name, values)
+            self.array(f'{name}.valid', np.packbits(valid))
+
+    def write(self, path, header):
+        """Writes the snapshot next to path and moves it in place, readers never see half of it"""
+        layout = {}
+        offset = 0
+        for name, values in self.sections.items():
+            layout[name] = [offset, values.dtype.str, len(values)]
+            offset = _aligned(offset + values.nbytes)
+        header = dict(header, format=FORMAT, sections=layout)
+        encoded = json.dumps(header, separators=(',', ':')).encode()
+        start = _aligned(16 + len(encoded))
+        temporary = f'{path}.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(MAGIC + struct.pack('<Q', len(encoded)) + encoded)
+            for name, values in self.sections.items():
+                f.seek(start + layout[name][0])
+                f.write(values.tobytes())
+            f.truncate(start + offset)
+        os.replace(temporary, path)
+        return start + offset
+
+
+class _Strings:
+    """Read side of _Writer.strings, decodes a block of RESTART strings at a time"""
+
+    def __init__(self, snapshot, name):
+        self.prefixes = snapshot.section(f'{name}.prefix') if snapshot.has(f'{name}.prefix') else None
+        self.offsets = snapshot.section(f'{name}.offsets')
+        self.data = snapshot.section(f'{name}.data')
+        self._block = None
+        self._values = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def decode(self, start=0, stop=None) -> list:
+        """Strings from start to stop, start has to be a restart point when they are front coded"""
+        stop = len(self) if stop is None else stop
+        if start >= stop:
+            return []
+        offsets = self.offsets[start:stop + 1].tolist()
+        base = offsets[0]
+        data = self.data[base:offsets[-1]].tobytes()
+        if self.prefixes is None:
+            return [_decode(data[a - base:b - base]) for a, b in zip(offsets, offsets[1:])]
+        values = []
+        previous = b''
+        for shared, a, b in zip(self.prefixes[start:stop].tolist(), offsets, offsets[1:]):
+            previous = previous[:shared] + data[a - base:b - base]
+            values.append(previous)
+        return [_decode(x) for x in values]
+
+    def __getitem__(self, i) -> str:
+        block = i - i % RESTART if self.prefixes is not None else i
+        if block != self._block:
+            self._values = self.decode(block, min(block + RESTART, len(self)) if self.prefixes is not None else i + 1)
+            self._block = block
+        return self._values[i - block]
+
+    def range(self, start, stop) -> list:
+        """Strings from start to stop, from anywhere"""
+        block = start - start % RESTART if self.prefixes is not None else start
+        return self.decode(block, stop)[start - block:]
+
+    def bisect(self, value: str, start, stop) -> int:
+        """Position value would be inserted at between start and stop, the strings have to be sorted"""
+        if self.prefixes is None:
+            raise ValueError('Only front coded strings are sorted')
+        # The restart points are searched first, they decode without the strings before them
+        low, high = (start + RESTART - 1) // RESTART, (stop + RESTART - 1) // RESTART
+        while low < high:
+            middle = (low + high) // 2
+            if self[middle * RESTART] < value:
+                low = middle + 1
+            else:
+                high = middle
+        # value is after the strings of the block before restart point low
+        low, high = max(start, (low - 1) * RESTART), min(stop, low * RESTART)
+        if low >= high:
+            return low
+        return low + bisect_left(self.range(low, high), value)
+
+
+class Snapshot:
+    """
+    A snapshot file on a memory map.
+
+    Sections are numpy arrays on the map and only valid while the snapshot is
+    open, copy what has to outlive it.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._file = open(self.path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, length = struct.unpack_from('<8sQ', self._map) if len(self._map) >= 16 else (None, 0)
+            if magic != MAGIC:
+                raise SnapshotError(f'{self.path} is not a snapshot')
+            header = json.loads(self._map[16:16 + length])
+        except (ValueError, OSError):
+            self._file.close()
+            raise SnapshotError(f'{self.path} is not a snapshot')
+        except SnapshotError:
+            self._file.close()
+            raise
+        if header['format'] != FORMAT:
+            self.close()
+            raise SnapshotError(f'{self.path} is format {header["format"]}, this version reads {FORMAT}')
+        self.header = header
+        self._start = _aligned(16 + length)
+        self._columns = {}
+        self._strings = {}
+
+    def close(self):
+        self._columns = {}
+        self._strings = {}
+        try:
+            self._map.close()
+        except BufferError:
+            # Arrays of it are still around, the map is closed when they are gone
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def id(self) -> str:
+        return self.header['id']
+
+    @property
+    def base(self):
+        """Id of the snapshot a delta was made against, None for a full snapshot"""
+        return self.header['base']
+
+    @property
+    def roots(self) -> list:
+        return self.header['roots']
+
+    @property
+    def extensions(self) -> list:
+        return self.header['extensions']
+
+    def __len__(self):
+        """Number of files"""
+        return len(self.section('files.dir'))
+
+    def has(self, name) -> bool:
+        return name in self.header['sections']
+
+    def section(self, name):
+        offset, dtype, length = self.header['sections'][name]
+        return np.frombuffer(self._map, dtype, length, self._start + offset)
+
+    def strings(self, name) -> _Strings:
+        if name not in self._strings:
+            self._strings[name] = _Strings(self, name)
+        return self._strings[name]
+
+    def column(self, name, table='files'):
+        """(values, valid) of a column for every row, values are 0 where valid is False"""
+        key = (table, name)
+        if key not in self._columns:
+            rows = len(self.section('files.dir')) if table == 'files' else len(self.section('models.file'))
+            section = f'{table}.{name}'
+            values = self.section(section)
+            if self.has(f'{section}.index'):
+                index = self.section(f'{section}.index')
+                dense = np.zeros(rows, values.dtype)
+                dense[index] = values
+                valid = np.zeros(rows, bool)
+                valid[index] = True
+                values = dense
+            elif self.has(f'{section}.valid'):
+                valid = np.unpackbits(self.section(f'{section}.valid'), count=rows).view(bool)
+            else:
+                valid = np.ones(rows, bool)
+            self._columns[key] = values, valid
+        return self._columns[key]
+
+    def root_range(self, root_index):
+        """First and last + 1 directory of a root, they are sorted by root"""
+        starts = self.header['root_dirs'] + [len(self.section('dirs.root'))]
+        return starts[root_index], starts[root_index + 1]
+
+    def directory(self, position) -> str:
+        return self.strings('dirs.path')[position]
+
+    def files_of(self, position):
+        """First and last + 1 file of a directory"""
+        first = self.section('dirs.first')
+        return int(first[position]), int(first[position + 1])
+
+    def file_path(self, position) -> str:
+        directory = int(self.section('files.dir')[position])
+        return os.path.join(self.directory(directory), self.strings('files.name')[position])
+
+    def paths(self, positions) -> list:
+        return [self.file_path(x) for x in positions]
+
+    def _folder_rows(self, folder):
+        """Bool mask of the files in folder and below it"""
+        folder = os.path.normpath(str(folder))
+        paths = self.strings('dirs.path')
+        first = self.section('dirs.first')
+        rows = np.zeros(len(self), bool)
+        for root_index in range(len(self.roots)):
+            start, stop = self.root_range(root_index)
+            for low, high in ((folder, folder + '\0'), (folder + os.sep, folder + chr(ord(os.sep) + 1))):
+                low, high = paths.bisect(low, start, stop), paths.bisect(high, start, stop)
+                if low < high:
+                    rows[first[low]:first[high]] = True
+        return rows
+
+    @span('snapshot.select')
+    def select(self, files) -> np.ndarray:
+        """
+        Positions of the files a query.FileQuery matches, in its order.
+
+        Everything but text search works the same as on the index, files
+        without an order come by path.
+        """
+        rows = np.ones(len(self), bool)
+        if files.root is not None:
+            root = str(files.root)
+            if root not in self.roots:
+                return np.zeros(0, np.int64)
+            if files.folder is None:
+                rows &= self.section('dirs.root')[self.section('files.dir')] == self.roots.index(root)
+        if files.folder is not None:
+            rows &= self._folder_rows(files.folder)
+        if files.extensions:
+            codes = [i for i, x in enumerate(self.extensions) if x in files.extensions]
+            rows &= np.isin(self.section('files.ext'), codes)
+        for column, compare, value in (
+                ('size', np.greater_equal, files.min_size), ('size', np.less_equal, files.max_size),
+                ('mtime', np.greater_equal, files.modified_after), ('mtime', np.less_equal, files.modified_before),
+                ('width', np.greater_equal, files.min_width), ('height', np.greater_equal, files.min_height),
+                ('channels', np.equal, files.channels), ('bits', np.equal, files.bits),
+                ('duration', np.greater_equal, files.min_duration), ('duration', np.less_equal, files.max_duration),
+                ('triangles', np.greater_equal, files.min_triangles),
+                ('triangles', np.less_equal, files.max_triangles)):
+            if value is not None:
+                values, valid = self.column(column)
+                rows &= valid & compare(values, value)
+        positions = np.flatnonzero(rows)
+        count('snapshot.selected', len(positions))
+        return self._ordered(positions, files.order, files.descending)
+
+    def _ordered(self, positions, order, descending):
+        if order == 'name':
+            names = self.strings('files.name')
+            keys = np.array([names[x] for x in positions], dtype=object)
+            positions = positions[np.argsort(keys, kind='stable')]
+        elif order in ('size', 'mtime', 'duration', 'triangles'):
+            positions = positions[np.argsort(self.column(order)[0][positions], kind='stable')]
+        elif order == 'resolution':
+            width, height = self.column('width')[0], self.column('height')[0]
+            pixels = width[positions].astype(np.int64) * height[positions]
+            positions = positions[np.argsort(pixels, kind='stable')]
+        return positions[::-1] if descending and order is not None else positions
+
+
+def _new_id() -> str:
+    return uuid.uuid4().hex
+
+
+def _root_indexes(db, roots):
+    """{root id: index} of the exported roots, by path"""
+    found = db.execute(f'SELECT id, path FROM {schema.ROOTS} ORDER BY path').fetchall()
+    if roots is not None:
+        roots = {str(x) for x in roots}
+        found = [(rid, path) for rid, path in found if path in roots]
+    return {rid: i for i, (rid, path) in enumerate(found)}, [path for rid, path in found]
+
+
+def export(db, path, roots=None) -> str:
+    """Writes a full snapshot of the index (or of the watched folders in roots) to path, returns its id"""
+    timer_export = timer()
+    indexes, root_paths = _root_indexes(db, roots)
+    writer = _Writer()
+    clause = f'IN ({", ".join(str(x) for x in indexes)})'
+    with span('snapshot.export', roots=len(root_paths)) as export_span:
+        # Directories by root and path, the files in the same order
+        directories = db.execute(f'SELECT d.id, d.root_id, d.parent_id, d.path, d.mtime '
+                                 f'FROM {schema.DIRECTORIES} d JOIN {schema.ROOTS} r ON r.id = d.root_id '
+                                 f'WHERE d.root_id {clause} ORDER BY r.path, d.path').fetchall()
+        positions = {row[0]: i for i, row in enumerate(directories)}
+        dir_roots = np.array([indexes[row[1]] for row in directories], np.uint16)
+        writer.array('dirs.root', dir_roots)
+        writer.array('dirs.parent', [positions.get(row[2], -1) for row in directories], np.int32)
+        writer.array('dirs.mtime', [row[4] or 0 for row in directories], np.float64)
+        writer.strings('dirs.path', [row[3] for row in directories])
+
+        dtype = [('id', 'i8'), ('dir', 'i8'), ('name', 'O'), ('ext', 'O')]
+        dtype += [(name, kind) for name, kind in FILE_COLUMNS] + [(f'{name}.valid', '?') for name, kind in FILE_COLUMNS]
+        values = ', '.join(f'coalesce(f.{name}, 0)' for name, kind in FILE_COLUMNS)
+        valid = ', '.join(f'f.{name} IS NOT NULL' for name, kind in FILE_COLUMNS)
+        cursor = db.execute(f'SELECT f.id, f.dir_id, f.name, f.ext, {values}, {valid} '
+                            f'FROM {schema.FILES} f JOIN {schema.DIRECTORIES} d ON d.id = f.dir_id '
+                            f'JOIN {schema.ROOTS} r ON r.id = f.root_id '
+                            f'WHERE f.root_id {clause} ORDER BY r.path, d.path, f.name')
+        chunks = []
+        while True:
+            rows = cursor.fetchmany(_CHUNK)
+            if not rows:
+                break
+            chunks.append(np.array(rows, dtype))
+        files = np.concatenate(chunks) if chunks else np.zeros(0, dtype)
+        dir_ids = np.array([row[0] for row in directories], np.int64)
+        order = np.argsort(dir_ids)
+        file_dirs = order[np.searchsorted(dir_ids, files['dir'], sorter=order)] if len(files) else files['dir']
+        extensions = {}
+        writer.array('files.dir', file_dirs, np.int32)
+        writer.array('dirs.first', np.searchsorted(file_dirs, np.arange(len(directories) + 1)), np.int64)
+        writer.strings('files.name', files['name'].tolist())
+        writer.array('files.ext', [extensions.setdefault(x, len(extensions)) for x in files['ext'].tolist()],
+                     np.uint16)
+        for name, kind in FILE_COLUMNS:
+            writer.column(f'files.{name}', files[name], files[f'{name}.valid'], kind)
+
+        file_ids = files['id']
+        order = np.argsort(file_ids)
+        models = db.execute(f'SELECT m.file_id, {", ".join(f"m.{name}" for name, kind in MODEL_COLUMNS)}, '
+                            f'm.textures FROM {schema.MODELS} m JOIN {schema.FILES} f ON f.id = m.file_id '
+                            f'WHERE f.root_id {clause}').fetchall()
+        model_files = np.array([row[0] for row in models], np.int64)
+        model_files = order[np.searchsorted(file_ids, model_files, sorter=order)] if len(models) else model_files
+        _models(writer, model_files, [row[1:] for row in models])
+
+        header = {'id': _new_id(), 'base': None, 'created': time.time(), 'roots': root_paths,
+                  'extensions': list(extensions),
+                  'root_dirs': np.searchsorted(dir_roots, np.arange(len(root_paths))).tolist()}
+        size = writer.write(path, header)
+        export_span.set(files=len(files), directories=len(directories), bytes=size)
+    l.info(f'Exported {len(files)} files in {len(directories)} directories to {path} '
+           f'({size} bytes) in {timer_export}')
+    return header['id']
+
+
+def _models(writer, files, rows):
+    """Model rows of the files at positions files (sorted by them), rows as in the models table"""
+    order = np.argsort(files, kind='stable')
+    writer.array('models.file', files[order], np.int32)
+    for i, (name, kind) in enumerate(MODEL_COLUMNS):
+        column = [rows[x][i] for x in order]
+        writer.column(f'models.{name}', [x or 0 for x in column], [x is not None for x in column], kind)
+    textures = [rows[x][-1] for x in order]
+    writer.strings('models.textures', [x or '' for x in textures], front=False)
+    writer.array('models.textures.valid', np.packbits(np.array([x is not None for x in textures], bool)))
+
+
+def _model_rows(snapshot):
+    """{file position: models row} of a snapshot"""
+    if not snapshot.has('models.file'):
+        return {}
+    columns = [snapshot.column(name, 'models') for name, kind in MODEL_COLUMNS]
+    files = snapshot.section('models.file').tolist()
+    textures = snapshot.strings('models.textures').decode()
+    has_textures = np.unpackbits(snapshot.section('models.textures.valid'), count=len(files)).view(bool)
+    rows = {}
+    for i, position in enumerate(files):
+        row = [values[i].item() if valid[i] else None for values, valid in columns]
+        rows[position] = tuple(row) + (textures[i] if has_textures[i] else None,)
+    return rows
+
+
+def _walk(snapshot, root_index):
+    """Yields (directory path, name, file position) of a root, in the order they are stored"""
+    start, stop = snapshot.root_range(root_index)
+    paths = snapshot.strings('dirs.path').range(start, stop)
+    first = snapshot.section('dirs.first')
+    names = snapshot.strings('files.name')
+    begin, end = int(first[start]), int(first[stop])
+    all_names = names.range(begin, end)
+    offsets = first[start:stop + 1].tolist()
+    for path, a, b in zip(paths, offsets, offsets[1:]):
+        for position in range(a, b):
+            yield path, all_names[position - begin], position
+
+
+def export_delta(base, new, path) -> int:
+    """
+    Writes the changes from snapshot base to snapshot new (both full, opened) to path.
+
+    Returns the number of new, changed and deleted files in it.
+    """
+    if base.base is not None or new.base is not None:
+        raise SnapshotError('Deltas are made between two full snapshots')
+    timer_delta = timer()
+    with span('snapshot.delta') as delta_span:
+        matched_base, matched_new, added, deleted = [], [], [], []
+        for root_index, root in enumerate(new.roots):
+            base_files = _walk(base, base.roots.index(root)) if root in base.roots else iter(())
+            new_files = _walk(new, root_index)
+            old, current = next(base_files, None), next(new_files, None)
+            while old is not None or current is not None:
+                if current is None or old is not None and old[:2] < current[:2]:
+                    deleted.append(old[:2])
+                    old = next(base_files, None)
+                elif old is None or current[:2] < old[:2]:
+                    added.append(current[2])
+                    current = next(new_files, None)
+                else:
+                    matched_base.append(old[2])
+                    matched_new.append(current[2])
+                    old, current = next(base_files, None), next(new_files, None)
+
+        # Files that are in both are compared a column at a time
+        matched_base, matched_new = np.array(matched_base, np.int64), np.array(matched_new, np.int64)
+        changed = (np.array(base.extensions + [''], object)[base.section('files.ext')[matched_base]] !=
+                   np.array(new.extensions + [''], object)[new.section('files.ext')[matched_new]])
+        for name, kind in FILE_COLUMNS:
+            base_values, base_valid = base.column(name)
+            new_values, new_valid = new.column(name)
+            changed |= base_values[matched_base] != new_values[matched_new]
+            changed |= base_valid[matched_base] != new_valid[matched_new]
+        base_models, new_models = _model_rows(base), _model_rows(new)
+        for i in np.flatnonzero(~changed).tolist():
+            if base_models.get(int(matched_base[i])) != new_models.get(int(matched_new[i])):
+                changed[i] = True
+        selected = np.sort(np.concatenate([np.array(added, np.int64), matched_new[changed]]))
+
+        writer = _Writer()
+        for name in ('dirs.root', 'dirs.parent', 'dirs.mtime', 'dirs.path.prefix', 'dirs.path.offsets',
+                     'dirs.path.data'):
+            writer.array(name, new.section(name))
+        file_dirs = new.section('files.dir')[selected]
+        writer.array('files.dir', file_dirs)
+        writer.array('dirs.first', np.searchsorted(file_dirs, np.arange(len(new.section('dirs.root')) + 1)),
+                     np.int64)
+        names = new.strings('files.name')
+        writer.strings('files.name', [names[x] for x in selected.tolist()])
+        writer.array('files.ext', new.section('files.ext')[selected])
+        for name, kind in FILE_COLUMNS:
+            values, valid = new.column(name)
+            writer.column(f'files.{name}', values[selected], valid[selected], kind)
+        models = [x for x in selected.tolist() if x in new_models]
+        _models(writer, np.searchsorted(selected, np.array(models, np.int64)), [new_models[x] for x in models])
+
+        # Gone files of directories that are still there, gone directories are found by the importer
+        paths = new.strings('dirs.path')
+        directories = {}
+        for root_index in range(len(new.roots)):
+            start, stop = new.root_range(root_index)
+            directories.update((x, i) for i, x in enumerate(paths.range(start, stop), start))
+        deleted = [(directories[folder], name) for folder, name in deleted if folder in directories]
+        writer.array('deleted.dir', [x for x, name in deleted], np.int32)
+        writer.strings('deleted.name', [name for x, name in deleted], front=False)
+
+        header = dict(new.header, base=base.id, created=time.time())
+        del header['sections']
+        size = writer.write(path, header)
+        delta_span.set(changed=len(selected), deleted=len(deleted), bytes=size)
+    l.info(f'Wrote {len(selected)} new or changed and {len(deleted)} deleted files to {path} ({size} bytes) '
+           f'in {timer_delta}')
+    return len(selected) + len(deleted)
+
+
+def _details(snapshot, start, stop):
+    """Values of _DETAIL_COLUMNS of the files from start to stop"""
+    columns = []
+    for name, kind in _DETAIL_COLUMNS:
+        values, valid = snapshot.column(name)
+        columns.append([x if present else None for x, present in zip(values[start:stop].tolist(),
+                                                                        valid[start:stop].tolist())])
+    return list(zip(*columns))
+
+
+def _write_details(db, root_id, rows):
+    """Stores (directory path, name, details, models row, existed) after the files were written"""
+    file_id = (f'(SELECT f.id FROM {schema.FILES} f WHERE f.dir_id = (SELECT id FROM {schema.DIRECTORIES} '
+               f'WHERE root_id = {root_id} AND path = ?) AND f.name = ?)')
+    with db.conn:
+        db.conn.executemany(f'UPDATE {schema.FILES} SET {", ".join(f"{name} = ?" for name, kind in _DETAIL_COLUMNS)} '
+                            f'WHERE id = {file_id}',
+                            [details + (folder, name) for folder, name, details, model, existed in rows])
+        db.conn.executemany(f'DELETE FROM {schema.MODELS} WHERE file_id = {file_id}',
+                            [(folder, name) for folder, name, details, model, existed in rows if existed])
+        db.conn.executemany(f'INSERT INTO {schema.MODELS} (file_id, '
+                            f'{", ".join(name for name, kind in MODEL_COLUMNS)}, textures) '
+                            f'VALUES ({file_id}, {", ".join("?" * (len(MODEL_COLUMNS) + 1))})',
+                            [(folder, name) + model for folder, name, details, model, existed in rows
+                             if model is not None])
+
+
+def _known_files(db, dir_id):
+    """{name: (file id, size, mtime, details)} of a directory"""
+    if dir_id is None:
+        return {}
+    return {row[1]: (row[0], row[2], row[3], tuple(row[4:])) for row in db.execute(
+        f'SELECT id, name, size, mtime, {", ".join(name for name, kind in _DETAIL_COLUMNS)} '
+        f'FROM {schema.FILES} WHERE dir_id = ?', [dir_id])}
+
+
+def _import_root(db, snapshot, root_index, batch_size, models):
+    root = snapshot.roots[root_index]
+    rid = scanner.ensure_tables(db, root)
+    known_dirs = {path: (dir_id, mtime) for dir_id, path, mtime in db.execute(
+        f'SELECT id, path, mtime FROM {schema.DIRECTORIES} WHERE root_id = ?', [rid])}
+    start, stop = snapshot.root_range(root_index)
+    paths = snapshot.strings('dirs.path').range(start, stop)
+    mtimes = snapshot.section('dirs.mtime')
+    first = snapshot.section('dirs.first')
+    names = snapshot.strings('files.name')
+    extensions = snapshot.extensions
+    ext_codes = snapshot.section('files.ext')
+    sizes, size_valid = snapshot.column('size')
+    file_mtimes, mtime_valid = snapshot.column('mtime')
+    deleted_dirs = snapshot.section('deleted.dir') if snapshot.base is not None else None
+    deleted_names = snapshot.strings('deleted.name') if snapshot.base is not None else None
+
+    stats = scanner.ScanStats(0, 0, 0, 0, 0)
+    batch = scanner.Batch(root, rid, [], [], 0, 0)
+    details = []
+    pending = listed = 0
+    for position, path in enumerate(paths, start):
+        dir_id, mtime = known_dirs.pop(path, (None, None))
+        change = scanner.DirChange(path, dir_id, float(mtimes[position]), [], [], [])
+        a, b = int(first[position]), int(first[position + 1])
+        if snapshot.base is not None:
+            low, high = (int(x) for x in np.searchsorted(deleted_dirs, [position, position + 1]))
+        # A delta lists every directory, most without a change to their files
+        changed = snapshot.base is None or a < b or low < high
+        known = _known_files(db, dir_id) if changed else {}
+        rows = zip(range(a, b), names.range(a, b), ext_codes[a:b].tolist(), sizes[a:b].tolist(),
+                   size_valid[a:b].tolist(), file_mtimes[a:b].tolist(), mtime_valid[a:b].tolist(),
+                   _details(snapshot, a, b))
+        for i, name, ext, size, has_size, file_mtime, has_mtime, detail in rows:
+            size = size if has_size else None
+            file_mtime = file_mtime if has_mtime else None
+            model = models.get(i)
+            before = known.pop(name, None)
+            if before is None:
+                change.inserts.append((name, extensions[ext], size, file_mtime))
+            elif (before[1], before[2]) != (size, file_mtime):
+                change.updates.append((size, file_mtime, before[0]))
+            elif before[3] == detail and model is None:
+                # Models rows aren't compared, they are few and written again
+                continue
+            details.append((path, name, detail, model, before is not None))
+        if snapshot.base is None:
+            change.deletes.extend((file_id,) for file_id, size, file_mtime, detail in known.values())
+        elif low < high:
+            for name in deleted_names.range(low, high):
+                if name in known:
+                    change.deletes.append((known[name][0],))
+        if dir_id is None or mtime != change.mtime or change.inserts or change.updates or change.deletes:
+            batch.dirs.append(change)
+            pending += len(change.inserts) + len(change.updates) + len(change.deletes) + 1
+        listed += 1
+        if pending >= batch_size:
+            # Directories the snapshot didn't change count as skipped
+            batch = batch._replace(dirs_listed=listed, dirs_skipped=listed - len(batch.dirs))
+            stats = scanner.add_stats(stats, scanner.apply_batch(db, batch))
+            _write_details(db, rid, details)
+            batch, details, pending, listed = scanner.Batch(root, rid, [], [], 0, 0), [], 0, 0
+    # Directories that aren't in the snapshot are gone, a delta has all of them too
+    batch.gone_dirs.extend(dir_id for dir_id, mtime in known_dirs.values())
+    batch = batch._replace(dirs_listed=listed, dirs_skipped=listed - len(batch.dirs))
+    stats = scanner.add_stats(stats, scanner.apply_batch(db, batch))
+    _write_details(db, rid, details)
+    with db.conn:
+        db.conn.execute(f'UPDATE {schema.ROOTS} SET snapshot = ? WHERE id = ?', [snapshot.id, rid])
+    return stats
+
+
+def apply(db, path, batch_size=BATCH_SIZE) -> scanner.ScanStats:
+    """
+    Brings the watched folders of a snapshot (or delta) in the index up to date with it.
+
+    Folders that aren't watched yet are added. A delta is refused unless every
+    folder in it was last imported from the snapshot it was made against.
+    """
+    timer_import = timer()
+    stats = scanner.ScanStats(0, 0, 0, 0, 0)
+    with Snapshot(path) as snapshot, span('snapshot.import', delta=snapshot.base is not None) as import_span:
+        schema.ensure_schema(db)
+        if snapshot.base is not None:
+            for root in snapshot.roots:
+                row = db.execute(f'SELECT snapshot FROM {schema.ROOTS} WHERE path = ?', [root]).fetchone()
+                if row is None or row[0] != snapshot.base:
+                    raise SnapshotError(f'{path} is a delta to snapshot {snapshot.base}, {root} is not at it, '
+                                        f'import the full snapshot first')
+        models = _model_rows(snapshot)
+        for root_index in range(len(snapshot.roots)):
+            stats = scanner.add_stats(stats, _import_root(db, snapshot, root_index, batch_size, models))
+        import_span.set(inserted=stats.inserted, updated=stats.updated, deleted=stats.deleted)
+    l.info(f'Imported {path}: {stats.inserted} inserts, {stats.updated} updates, {stats.deleted} deletes '
+           f'in {timer_import}')
+    return stats
@@ -0,0 +1,191 @@
+"""
+Directory tree of the index with the size of every folder.
+
+directories.files and bytes are the totals of a directory and everything
+below it, directory_exts holds the same per extension. They are never counted
+again: apply_batch in scanner.py collects what a batch inserts, resizes and
+deletes in a Rollup, which adds it to the directory and every parent up to the
+root in the same transaction. Expanding a folder is one query on
+directories.parent_id:
+
+    top = tree.top(db, root)
+    for folder in tree.children(db, top.id):
+        print(folder.name, folder.files, format_bytes(folder.bytes))
+"""
+import os
+from collections import namedtuple
+
+from . import schema
+from .blom import count, get_logger, span, timer
+
+l = get_logger('frankenstein.tree')
+
+# folders is the number of direct subdirectories
+Folder = namedtuple('Folder', 'id path name files bytes folders')
+
+# Ids looked up per query
+_ID_BATCH = 500
+
+_FOLDER_COLUMNS = (f'd.id, d.path, d.files, d.bytes, '
+                   f'(SELECT count(*) FROM {schema.DIRECTORIES} c WHERE c.parent_id = d.id)')
+
+
+def _folder(row) -> Folder:
+    dir_id, path, files, size, folders = row
+    return Folder(dir_id, path, os.path.basename(path) or path, files, size, folders)
+
+
+def top(db, root):
+    """Folder of a watched folder itself, None when it wasn't scanned yet"""
+    rid = schema.root_id(db, root)
+    if rid is None:
+        return None
+    row = db.execute(f'SELECT {_FOLDER_COLUMNS} FROM {schema.DIRECTORIES} d WHERE d.root_id = ? AND d.path = ?',
+                     [rid, os.path.normpath(str(root))]).fetchone()
+    return None if row is None else _folder(row)
+
+
+def folder(db, dir_id):
+    """Folder of a directory id, None when it's gone"""
+    row = db.execute(f'SELECT {_FOLDER_COLUMNS} FROM {schema.DIRECTORIES} d WHERE d.id = ?', [dir_id]).fetchone()
+    return None if row is None else _folder(row)
+
+
+def folder_at(db, path):
+    """Folder of an indexed directory path, None when it isn't indexed"""
+    # Through the (root_id, path) index, there are only a few roots
+    row = db.execute(f'SELECT {_FOLDER_COLUMNS} FROM {schema.DIRECTORIES} d '
+                     f'WHERE d.root_id IN (SELECT id FROM {schema.ROOTS}) AND d.path = ?',
+                     [os.path.normpath(str(path))]).fetchone()
+    return None if row is None else _folder(row)
+
+
+@span('tree.children')
+def children(db, dir_id) -> list:
+    """Folders directly below a directory, by name"""
+    return [_folder(row) for row in db.execute(
+        f'SELECT {_FOLDER_COLUMNS} FROM {schema.DIRECTORIES} d WHERE d.parent_id = ? ORDER BY d.path', [dir_id])]
+
+
+def extensions(db, dir_id) -> list:
+    """(extension, files, bytes) below a directory, biggest first"""
+    return db.execute(f'SELECT ext, files, bytes FROM {schema.DIRECTORY_EXTS} WHERE dir_id = ? '
+                      f'ORDER BY bytes DESC, ext', [dir_id]).fetchall()
+
+
+class Rollup:
+    """
+    Changes to the files of directories, per extension.
+
+    Old sizes are read from the index, so updated and deleted have to be called
+    before the files are changed. apply adds everything to the directories and
+    their parents.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        # dir_id: parent_id of the directories seen so far
+        self.parents = {}
+        # (dir_id, ext): [files, bytes]
+        self.deltas = {}
+
+    def _add(self, dir_id, ext, files, size):
+        delta = self.deltas.setdefault((dir_id, ext), [0, 0])
+        delta[0] += files
+        delta[1] += size
+
+    def _old(self, file_ids):
+        """{file id: (ext, size)} from the index"""
+        found = {}
+        for start in range(0, len(file_ids), _ID_BATCH):
+            batch = file_ids[start:start + _ID_BATCH]
+            found.update((file_id, (ext, size)) for file_id, ext, size in self.db.execute(
+                f'SELECT id, ext, size FROM {schema.FILES} WHERE id IN ({", ".join("?" * len(batch))})', batch))
+        return found
+
+    def directory(self, dir_id, parent_id):
+        """A directory inserted by the batch, it isn't in the index yet"""
+        self.parents[dir_id] = parent_id
+
+    def inserted(self, dir_id, inserts):
+        """(name, ext, size, mtime) of new files"""
+        for name, ext, size, mtime in inserts:
+            self._add(dir_id, ext, 1, size or 0)
+
+    def updated(self, dir_id, updates):
+        """(size, mtime, file id) of changed files"""
+        old = self._old([file_id for size, mtime, file_id in updates])
+        for size, mtime, file_id in updates:
+            if file_id in old:
+                ext, old_size = old[file_id]
+                self._add(dir_id, ext, 0, (size or 0) - (old_size or 0))
+
+    def deleted(self, dir_id, deletes):
+        """(file id,) of deleted files"""
+        for ext, size in self._old([file_id for file_id, in deletes]).values():
+            self._add(dir_id, ext, -1, -(size or 0))
+
+    def removed(self, dir_id):
+        """A directory that's deleted with all its files"""
+        for ext, files, size in self.db.execute(f'SELECT ext, count(*), total(size) FROM {schema.FILES} '
+                                                f'WHERE dir_id = ? GROUP BY ext', [dir_id]):
+            self._add(dir_id, ext, -files, -int(size))
+
+    def _ancestors(self, dir_id):
+        """dir_id and its parents up to the root"""
+        while dir_id is not None:
+            yield dir_id
+            if dir_id not in self.parents:
+                row = self.db.execute(f'SELECT parent_id FROM {schema.DIRECTORIES} WHERE id = ?', [dir_id]).fetchone()
+                self.parents[dir_id] = None if row is None else row[0]
+            dir_id = self.parents[dir_id]
+
+    def apply(self):
+        """Adds the changes to every directory they are below, call it in the transaction of the changes"""
+        totals = {}
+        for (dir_id, ext), (files, size) in self.deltas.items():
+            if not files and not size:
+                continue
+            for ancestor in self._ancestors(dir_id):
+                total = totals.setdefault((ancestor, ext), [0, 0])
+                total[0] += files
+                total[1] += size
+        self.deltas = {}
+        if not totals:
+            return
+        directories = {}
+        for (dir_id, ext), (files, size) in totals.items():
+            total = directories.setdefault(dir_id, [0, 0])
+            total[0] += files
+            total[1] += size
+        with span('tree.rollup', rows=len(totals)):
+            self.db.conn.executemany(
+                f'INSERT INTO {schema.DIRECTORY_EXTS} (dir_id, ext, files, bytes) VALUES (?, ?, ?, ?) '
+                f'ON CONFLICT (dir_id, ext) DO UPDATE SET files = files + excluded.files, '
+                f'bytes = bytes + excluded.bytes',
+                [(dir_id, ext, files, size) for (dir_id, ext), (files, size) in totals.items()])
+            # Extensions that are gone from a folder
+            self.db.conn.executemany(f'DELETE FROM {schema.DIRECTORY_EXTS} WHERE dir_id = ? AND ext = ? AND files <= 0',
+                                     [key for key, (files, size) in totals.items() if files < 0])
+            self.db.conn.executemany(f'UPDATE {schema.DIRECTORIES} SET files = files + ?, bytes = bytes + ? '
+                                     f'WHERE id = ?',
+                                     [(files, size, dir_id) for dir_id, (files, size) in directories.items()])
+        count('tree.rollups', len(totals))
+
+
+def rebuild(db, root=None):
+    """Counts the totals of every directory again, of one watched folder when root is given"""
+    timer_rebuild = timer()
+    clause = 'WHERE root_id = ?' if root is not None else ''
+    params = [schema.root_id(db, root)] if root is not None else []
+    rollup = Rollup(db)
+    with db.conn:
+        db.conn.execute(f'DELETE FROM {schema.DIRECTORY_EXTS} WHERE dir_id IN '
+                        f'(SELECT id FROM {schema.DIRECTORIES} {clause})', params)
+        db.conn.execute(f'UPDATE {schema.DIRECTORIES} SET files = 0, bytes = 0 {clause}', params)
+        rollup.parents.update(db.execute(f'SELECT id, parent_id FROM {schema.DIRECTORIES} {clause}', params))
+        for dir_id, ext, files, size in db.execute(f'SELECT dir_id, ext, count(*), total(size) FROM {schema.FILES} '
+                                                   f'{clause} GROUP BY dir_id, ext', params):
+            rollup._add(dir_id, ext, files, int(size))
+        rollup.apply()
+    l.info(f'Counted the totals of {len(rollup.parents)} directories in {timer_rebuild}')
@@ -0,0 +1,271 @@
+"""
+Poster frames and scrub strips of video clips, so a clip can be previewed without opening it.
+
+Frames are decoded by a local ffmpeg, seeking to each position before opening
+the stream so only the data around it is read from the NAS:
+
+    poster  one frame 10% into the clip, at most POSTER_SIZE pixels
+    strip   FRAMES evenly spaced frames of FRAME_WIDTH pixels next to each other in one JPEG
+
+Frame i of the strip is the rectangle (i * frame_width, 0, frame_width,
+frame_height), scrubbing to a fraction p of the clip shows frame int(p * frames).
+Both are stored in their own SQLite file (videoframes.db, next to thumbnails.db)
+keyed on path, size and mtime. update is the stage that runs after a scan (see
+stagethread.py): it extracts the frames of new and changed clips in worker
+processes and records their duration and dimensions in the index.
+
+Nothing is extracted when ffmpeg isn't on the PATH.
+"""
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+from collections import namedtuple
+
+from . import schema
+from . import workers
+from .blom import count, get_logger, span, timer
+
+l = get_logger('frankenstein.videoframes')
+
+VIDEOFRAMES_PATH = 'videoframes.db'
+VIDEOFRAMES_TABLE = 'videoframes'
+
+# Executable name or full path of ffmpeg
+FFMPEG = 'ffmpeg'
+
+EXTENSIONS = ['mp4', 'm4v', 'mov', 'mkv', 'avi', 'webm', 'mxf', 'mpg', 'mpeg', 'wmv', 'mts', 'm2ts']
+
+FRAMES = 16
+FRAME_WIDTH = 160
+POSTER_SIZE = 512
+# Where the poster is taken, as a fraction of the duration
+POSTER_AT = 0.1
+# ffmpeg JPEG quality, 2 (best) to 31
+QUALITY = 4
+# Seconds before a stuck ffmpeg is killed
+TIMEOUT = 60
+
+DEFAULT_PROCESSES = 2
+# Clips per task
+BATCH = 4
+WRITE_BATCH = 20
+
+VideoInfo = namedtuple('VideoInfo', 'width height duration')
+VideoFrames = namedtuple('VideoFrames', 'duration width height frames frame_width frame_height poster strip')
+
+_DURATION = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+_VIDEO_SIZE = re.compile(r'Stream #.*?: Video: .*?\b(\d{2,5})x(\d{2,5})\b')
+_ROTATION = re.compile(r'rotation of (-?\d+(?:\.\d+)?) degrees')
+
+
+def ffmpeg():
+    """Full path of ffmpeg, None when it isn't installed"""
+    return shutil.which(FFMPEG)
+
+
+def _run(command, data=None) -> subprocess.CompletedProcess:
+    return subprocess.run(command, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=TIMEOUT,
+                          stdin=None if data is not None else subprocess.DEVNULL)
+
+
+def probe(path, executable=None):
+    """VideoInfo of the first video stream from what ffmpeg prints about the file, None when it has none"""
+    result = _run([executable or ffmpeg(), '-hide_banner', '-i', path])
+    # Without an output ffmpeg exits with an error after printing the streams
+    text = result.stderr.decode('utf-8', 'replace')
+    size = _VIDEO_SIZE.search(text)
+    duration = _DURATION.search(text)
+    if size is None:
+        return None
+    width, height = int(size.group(1)), int(size.group(2))
+    rotation = _ROTATION.search(text)
+    if rotation is not None and round(abs(float(rotation.group(1)))) % 180 == 90:
+        # ffmpeg turns the frames upright while decoding
+        width, height = height, width
+    seconds = None
+    if duration is not None:
+        hours, minutes, rest = duration.groups()
+        seconds = int(hours) * 3600 + int(minutes) * 60 + float(rest)
+    return VideoInfo(width, height, seconds)
+
+
+def _even(value) -> int:
+    """Nearest even size of at least 2, the JPEG encoder halves the chroma"""
+    return max(2, int(round(value / 2)) * 2)
+
+
+def _fit(info, size):
+    """Frame size no bigger than size x size"""
+    scale = size / max(info.width, info.height)
+    return _even(info.width * scale), _even(info.height * scale)
+
+
+def _frame(executable, path, position, width, height) -> bytes:
+    """RGB bytes of the frame at position seconds, b'' when there is none"""
+    # The keyframe before position is close enough and only that frame is decoded, all
+    # frames from it up to position are decoded for streams without keyframe flags
+    for skip in (['-skip_frame', 'nokey'], []):
+        result = _run([executable, '-v', 'error', *skip, '-noaccurate_seek', '-ss', f'{position:.3f}', '-i', path,
+                       '-frames:v', '1', '-an', '-sn', '-vf', f'scale={width}:{height}', '-f', 'rawvideo',
+                       '-pix_fmt', 'rgb24', '-'])
+        if len(result.stdout) == width * height * 3:
+            return result.stdout
+    return b''
+
+
+def _encode(executable, frames, width, height) -> bytes:
+    """JPEG of RGB frames next to each other"""
+    result = _run([executable, '-v', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}',
+                   '-i', '-', '-vf', f'tile={len(frames)}x1', '-frames:v', '1', '-pix_fmt', 'yuvj420p',
+                   '-q:v', str(QUALITY), '-f', 'image2pipe', '-c:v', 'mjpeg', '-'], b''.join(frames))
+    return result.stdout
+
+
+def extract(path, executable=None):
+    """VideoFrames of a clip, None when ffmpeg can't decode it"""
+    executable = executable or ffmpeg()
+    info = probe(path, executable)
+    if info is None:
+        return None
+    duration = info.duration or 0
+    poster_width, poster_height = _fit(info, POSTER_SIZE)
+    poster = _frame(executable, path, duration * POSTER_AT, poster_width, poster_height)
+    if not poster:
+        # Broken index or a duration that's off, the first frame is better than nothing
+        poster = _frame(executable, path, 0, poster_width, poster_height)
+    if not poster:
+        return None
+    frame_width, frame_height = _fit(info, FRAME_WIDTH)
+    frame_width = FRAME_WIDTH if info.width >= info.height else frame_width
+    frame_height = _even(frame_width * info.height / info.width)
+    frames = []
+    previous = bytes(frame_width * frame_height * 3)
+    for index in range(FRAMES):
+        # The middle of every 1/FRAMES of the clip
+        frame = _frame(executable, path, duration * (index + 0.5) / FRAMES, frame_width, frame_height) \
+            if duration else b''
+        previous = frame or previous
+        frames.append(previous)
+    poster = _encode(executable, [poster], poster_width, poster_height)
+    strip = _encode(executable, frames, frame_width, frame_height)
+    if not poster or not strip:
+        return None
+    return VideoFrames(info.duration, info.width, info.height, FRAMES, frame_width, frame_height, poster, strip)
+
+
+class VideoFrameCache:
+    """
+    SQLite store of VideoFrames keyed on path, size and mtime.
+
+    Clips that couldn't be decoded are stored without frames so they aren't tried again.
+    """
+
+    def __init__(self, path=VIDEOFRAMES_PATH):
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA busy_timeout = 10000')
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS {VIDEOFRAMES_TABLE} (path TEXT PRIMARY KEY, size INTEGER, '
+                          f'mtime FLOAT, duration FLOAT, width INTEGER, height INTEGER, frames INTEGER, '
+                          f'frame_width INTEGER, frame_height INTEGER, poster BLOB, strip BLOB)')
+
+    def get(self, path, size, mtime):
+        """VideoFrames of path, False when it couldn't be decoded, None when they aren't stored for this size and mtime"""
+        row = self.conn.execute(f'SELECT duration, width, height, frames, frame_width, frame_height, poster, strip '
+                                f'FROM {VIDEOFRAMES_TABLE} WHERE path = ? AND size IS ? AND mtime IS ?',
+                                [path, size, mtime]).fetchone()
+        if row is None:
+            return None
+        if not row[6]:
+            return False
+        return VideoFrames(*row)
+
+    def put_many(self, rows):
+        """Stores (path, size, mtime, VideoFrames or None) rows"""
+        with self.conn:
+            self.conn.executemany(
+                f'INSERT OR REPLACE INTO {VIDEOFRAMES_TABLE} (path, size, mtime, duration, width, height, frames, '
+                f'frame_width, frame_height, poster, strip) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(path, size, mtime, *frames) if frames else (path, size, mtime, None, None, None, None, None, None,
+                                                               b'', b'') for path, size, mtime, frames in rows])
+
+    def put(self, path, size, mtime, frames):
+        self.put_many([(path, size, mtime, frames)])
+
+    def close(self):
+        self.conn.close()
+
+
+def _extract_many(items):
+    """Runs in the worker processes, clips that can't be opened come back as False to try them later"""
+    executable = ffmpeg()
+    results = []
+    for file_id, path, size, mtime in items:
+        try:
+            # ffmpeg doesn't say if a file is missing or undecodable
+            os.stat(path)
+            frames = extract(path, executable)
+        except (OSError, subprocess.SubprocessError):
+            frames = False
+        results.append((file_id, path, size, mtime, frames))
+    return results
+
+
+def _candidates(db, root):
+    clause = 'AND f.root_id = ?' if root is not None else ''
+    params = [schema.root_id(db, root)] if root is not None else []
+    join = os.path.join
+    return [(file_id, join(folder, name), size, mtime) for file_id, folder, name, size, mtime in db.execute(
+        f'SELECT f.id, d.path, f.name, f.size, f.mtime FROM {schema.FILES} f '
+        f'JOIN {schema.DIRECTORIES} d ON d.id = f.dir_id '
+        f'WHERE f.ext IN ({", ".join("?" * len(EXTENSIONS))}) AND f.meta IS NULL {clause} ORDER BY f.dir_id',
+        EXTENSIONS + params)]
+
+
+def _write(db, cache, results):
+    results = [x for x in results if x[4] is not False]
+    cache.put_many([(path, size, mtime, frames) for file_id, path, size, mtime, frames in results])
+    # Only stored when the file still has the size and mtime it had when it was read
+    with db.conn:
+        db.conn.executemany(
+            f'UPDATE {schema.FILES} SET duration = ?, width = ?, height = ?, meta = ? '
+            f'WHERE id = ? AND size IS ? AND mtime IS ?',
+            [(frames.duration, frames.width, frames.height, 1, file_id, size, mtime)
+             if frames else (None, None, None, 0, file_id, size, mtime)
+             for file_id, path, size, mtime, frames in results])
+
+
+def update(db, root=None, processes=DEFAULT_PROCESSES, cancel=None, progress=None, cache_path=VIDEOFRAMES_PATH) -> int:
+    """
+    Extracts the frames of new and changed clips and returns how many were read.
+
+    root limits it to one watched folder. progress(done, total) is called as
+    frames are written, extracting stops when cancel (a threading.Event) is set.
+    """
+    timer_frames = timer()
+    if ffmpeg() is None:
+        l.info('ffmpeg not found, no video frames are extracted')
+        return 0
+    items = _candidates(db, root)
+    if not items:
+        return 0
+    cache = VideoFrameCache(cache_path)
+    pending = []
+
+    def collect(results):
+        pending.extend(results)
+        if len(pending) >= WRITE_BATCH:
+            _write(db, cache, pending)
+            pending.clear()
+
+    try:
+        with span('videoframes.update', files=len(items)), workers.process_pool(processes) as pool:
+            done = workers.run(pool, _extract_many, workers.batches(items, BATCH), processes, collect, cancel,
+                               None if progress is None else lambda done: progress(done, len(items)), root)
+            _write(db, cache, pending)
+    finally:
+        cache.close()
+    count('videoframes.clips', done)
+    l.info(f'Extracted frames of {done} clips in {timer_frames}')
+    return done
@@ -0,0 +1,119 @@
+"""
+Parallel directory walker built on os.scandir.
+
+rglob + is_file() costs one stat round trip per entry, which is what makes scans
+slow on SMB/NFS shares. The walker uses the type info os.scandir already returns
+and lists many directories at once on a bounded thread pool to hide the latency
+of the NAS. Results are yielded per directory as soon as they are listed.
+Every listing takes a slot of the I/O scheduler (see iosched.py) of the watched
+folder it's charged to.
+"""
+import os
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import iosched
+from .blom import count, get_logger, span
+
+l = get_logger('frankenstein.walker')
+
+DEFAULT_WORKERS = 16
+
+# files is a list of (path, size, mtime) and subdirs a list of (path, mtime).
+# A directory that wasn't listed (skipped or failed) has files and subdirs set to None.
+DirListing = namedtuple('DirListing', 'path mtime files subdirs listed error')
+
+
+class Walker:
+    """
+    Walks directory trees with a pool of scandir workers.
+
+    workers is the number of directories listed at the same time. root is the
+    watched folder the listings are scheduled as, the top of the walk when None.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, stat_files=True, root=None, priority=iosched.BACKGROUND):
+        self.workers = max(1, int(workers))
+        self.stat_files = stat_files
+        self.root = root
+        self.priority = priority
+
+    def _visit(self, path, mtime, skip, root):
+        with iosched.slot(root, self.priority):
+            return self._list(path, mtime, skip)
+
+    def _list(self, path, mtime, skip):
+        if mtime is None:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError as e:
+                return DirListing(path, None, None, None, False, e)
+
+        if skip is not None and skip(path, mtime):
+            return DirListing(path, mtime, None, None, False, None)
+
+        files = []
+        subdirs = []
+        # Time spent per directory is mostly NAS round trips, this is the span to look at on slow shares
+        with span('walk.list_dir'):
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append((entry.path, entry.stat(follow_symlinks=False).st_mtime))
+                            elif entry.is_file():
+                                if self.stat_files:
+                                    st = entry.stat()
+                                    files.append((entry.path, st.st_size, st.st_mtime))
+                                else:
+                                    files.append((entry.path, None, None))
+                        except OSError:
+                            count('walk.stat_errors')
+                            l.warning(f'Could not stat {entry.path}, skipping')
+            except OSError as e:
+                count('walk.list_errors')
+                return DirListing(path, mtime, None, None, False, e)
+        count('walk.dirs_listed')
+        count('walk.files', len(files))
+        return DirListing(path, mtime, files, subdirs, True, None)
+
+    def walk(self, top, skip=None, known_children=None):
+        """
+        Yields a DirListing for every directory below and including top.
+
+        skip(path, mtime) -> bool decides if a directory needs listing. For
+        directories that are skipped or can't be listed, known_children(path)
+        gives the subdirectories to continue with.
+        """
+        top = os.path.normpath(str(top))
+        root = self.root if self.root is not None else top
+        pending = deque([(top, None)])
+        running = set()
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='walker') as pool:
+            try:
+                while pending or running:
+                    # Keep a bounded number of listings in flight, the frontier waits in pending
+                    while pending and len(running) < self.workers * 2:
+                        path, mtime = pending.popleft()
+                        running.add(pool.submit(self._visit, path, mtime, skip, root))
+
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        listing = future.result()
+                        if listing.listed:
+                            pending.extend(listing.subdirs)
+                        elif known_children is not None and listing.mtime is not None:
+                            pending.extend((child, None) for child in known_children(listing.path))
+                        yield listing
+            finally:
+                for future in running:
+                    future.cancel()
+
+    def files(self, top):
+        """Yields the path of every file below top"""
+        for listing in self.walk(top):
+            if listing.listed:
+                for path, size, mtime in listing.files:
+                    yield path
@@ -0,0 +1,429 @@
+"""
+Waveform peaks of sound files, so a waveform can be drawn without decoding the audio.
+
+WAV (PCM, float and extensible) and AIFF/AIFC are read here in chunks of a few
+thousand frames, other formats (FLAC, OGG, ...) through soundfile when it's
+installed. Every BLOCK frames of all channels become one min/max pair, stored
+as int8 (-127..127 of full scale). Coarser levels, each 4 times shorter, are
+kept next to it so drawing a few hundred pixels never touches more than a few
+thousand values:
+
+    peaks = waveform.compute(path)
+    mins, maxs = peaks.columns(500)     # floats in -1..1, one pair per pixel
+
+Peaks live in their own SQLite file (waveforms.db, next to thumbnails.db) keyed
+on path, size and mtime. update is the stage that runs after a scan (see
+stagethread.py): it computes the peaks of new and changed sound files in
+worker processes and records their duration, sample rate, channels and bit
+depth in the index.
+"""
+import math
+import os
+import sqlite3
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+from . import schema
+from . import workers
+from .blom import count, get_logger, span, timer
+
+l = get_logger('frankenstein.waveform')
+
+WAVEFORM_PATH = 'waveforms.db'
+WAVEFORM_TABLE = 'waveforms'
+
+# Frames per min/max pair of the finest level, doubled for long files so it never has more than MAX_COLUMNS pairs
+BLOCK = 256
+MAX_COLUMNS = 65536
+# Coarser levels are made until a level is at most this long
+MIN_LEVEL = 256
+LEVEL_FACTOR = 4
+
+# Blocks decoded at a time
+CHUNK_BLOCKS = 256
+
+# Read without soundfile, which adds the rest it knows about
+EXTENSIONS = ['wav', 'wave', 'aif', 'aiff', 'aifc']
+SOUNDFILE_EXTENSIONS = ['flac', 'ogg', 'oga', 'opus', 'mp3', 'caf', 'w64', 'rf64']
+
+DEFAULT_PROCESSES = 4
+BATCH = 16
+WRITE_BATCH = 200
+
+# encoding is 'pcm' (signed, except 8 bit WAV) or 'float', offset is where the frames start
+AudioInfo = namedtuple('AudioInfo', 'sample_rate channels bits frames encoding offset big_endian')
+
+
+def extensions():
+    """Sound file extensions that can be read here"""
+    try:
+        import soundfile
+    except (ImportError, OSError):
+        return list(EXTENSIONS)
+    return EXTENSIONS + SOUNDFILE_EXTENSIONS
+
+
+def _chunks(f, start, end, big_endian):
+    """Yields (id, data offset, size) of the RIFF/IFF chunks between start and end"""
+    position = start
+    while position + 8 <= end:
+        f.seek(position)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        chunk_id, size = header[:4], struct.unpack('>I' if big_endian else '<I', header[4:])[0]
+        yield chunk_id, position + 8, size
+        # Chunks are padded to an even size
+        position += 8 + size + (size & 1)
+
+
+def _wav(f, file_size):
+    fmt = data = None
+    for chunk_id, offset, size in _chunks(f, 12, file_size, False):
+        if chunk_id == b'fmt ':
+            f.seek(offset)
+            fmt = f.read(min(size, 40))
+        elif chunk_id == b'data':
+            data = offset, min(size, file_size - offset)
+            break
+    if fmt is None or data is None:
+        return None
+    tag, channels, sample_rate = struct.unpack('<HHI', fmt[:8])
+    bits = struct.unpack('<H', fmt[14:16])[0]
+    if tag == 0xFFFE and len(fmt) >= 26:
+        # WAVE_FORMAT_EXTENSIBLE, the format is in the first two bytes of the sub format GUID
+        tag = struct.unpack('<H', fmt[24:26])[0]
+    if tag not in (1, 3) or not channels or not bits:
+        return None
+    frames = data[1] // (channels * ((bits + 7) // 8))
+    return AudioInfo(sample_rate, channels, bits, frames, 'float' if tag == 3 else 'pcm', data[0], False)
+
+
+def _extended(data):
+    """80 bit IEEE extended float of the AIFF sample rate"""
+    exponent, mantissa = struct.unpack('>HQ', data)
+    if not mantissa:
+        return 0
+    return mantissa * 2.0 ** ((exponent & 0x7FFF) - 16383 - 63)
+
+
+def _aiff(f, file_size, compressed):
+    comm = ssnd = None
+    for chunk_id, offset, size in _chunks(f, 12, file_size, True):
+        if chunk_id == b'COMM':
+            f.seek(offset)
+            comm = f.read(min(size, 26))
+        elif chunk_id == b'SSND':
+            f.seek(offset)
+            ssnd = offset + 8 + struct.unpack('>I', f.read(4))[0]
+    if comm is None or ssnd is None:
+        return None
+    channels, frames, bits = struct.unpack('>hIh', comm[:8])
+    sample_rate = _extended(comm[8:18])
+    encoding, big_endian = 'pcm', True
+    if compressed:
+        kind = comm[18:22]
+        if kind in (b'sowt',):
+            big_endian = False
+        elif kind in (b'fl32', b'FL32', b'fl64', b'FL64'):
+            encoding = 'float'
+        elif kind not in (b'NONE', b'twos'):
+            return None
+    if channels <= 0 or bits <= 0:
+        return None
+    return AudioInfo(int(round(sample_rate)), channels, bits, frames, encoding, ssnd, big_endian)
+
+
+def read_info(path):
+    """AudioInfo of a WAV or AIFF file, None for anything else"""
+    with open(path, 'rb') as f:
+        head = f.read(12)
+        file_size = os.fstat(f.fileno()).st_size
+        if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+            return _wav(f, file_size)
+        if head[:4] == b'FORM' and head[8:12] in (b'AIFF', b'AIFC'):
+            return _aiff(f, file_size, head[8:12] == b'AIFC')
+    return None
+
+
+def _decode(raw, info):
+    """Frames of raw bytes as a (frames, channels) float32 array in -1..1"""
+    width = (info.bits + 7) // 8
+    order = '>' if info.big_endian else '<'
+    if info.encoding == 'float':
+        samples = np.frombuffer(raw, f'{order}f{width}').astype(np.float32)
+    elif width == 1:
+        # 8 bit WAV is unsigned, 8 bit AIFF signed
+        samples = np.frombuffer(raw, np.int8 if info.big_endian else np.uint8).astype(np.float32)
+        if not info.big_endian:
+            samples -= 128
+        samples /= 128
+    elif width == 3:
+        packed = np.frombuffer(raw, np.uint8).reshape(-1, 3).astype(np.int32)
+        if info.big_endian:
+            packed = packed[:, ::-1]
+        samples = ((packed[:, 0] | packed[:, 1] << 8 | packed[:, 2] << 16) << 8 >> 8).astype(np.float32)
+        samples /= 1 << 23
+    else:
+        samples = np.frombuffer(raw, f'{order}i{width}').astype(np.float32)
+        samples /= 1 << (8 * width - 1)
+    return samples.reshape(-1, info.channels)
+
+
+def _blocks(path, info, frames_per_chunk):
+    """Yields (frames, channels) float32 arrays of a WAV or AIFF file"""
+    frame_bytes = info.channels * ((info.bits + 7) // 8)
+    with open(path, 'rb') as f:
+        f.seek(info.offset)
+        left = info.frames
+        while left > 0:
+            raw = f.read(min(left, frames_per_chunk) * frame_bytes)
+            usable = len(raw) - len(raw) % frame_bytes
+            if not usable:
+                return
+            yield _decode(raw[:usable], info)
+            left -= usable // frame_bytes
+
+
+def _soundfile_info(path):
+    import soundfile
+
+    info = soundfile.info(path)
+    bits = {'PCM_S8': 8, 'PCM_U8': 8, 'PCM_16': 16, 'PCM_24': 24, 'PCM_32': 32, 'FLOAT': 32,
+            'DOUBLE': 64}.get(info.subtype)
+    return AudioInfo(info.samplerate, info.channels, bits, info.frames, 'soundfile', 0, False)
+
+
+def _soundfile_blocks(path, info, frames_per_chunk):
+    import soundfile
+
+    yield from soundfile.blocks(path, blocksize=frames_per_chunk, dtype='float32', always_2d=True)
+
+
+class Peaks:
+    """Min/max pairs of a sound at a few resolutions, level 0 has one pair per block frames"""
+
+    def __init__(self, info, block, levels):
+        self.info = info
+        self.block = block
+        # List of (n, 2) int8 arrays, columns are min and max
+        self.levels = levels
+
+    @property
+    def duration(self) -> float:
+        return self.info.frames / self.info.sample_rate if self.info.sample_rate else 0.0
+
+    def columns(self, width):
+        """(mins, maxs) float arrays of width pixels in -1..1"""
+        if not self.levels or not len(self.levels[0]) or width <= 0:
+            return np.zeros(width, np.float32), np.zeros(width, np.float32)
+        # The coarsest level that still has a pair for every pixel
+        level = self.levels[0]
+        for candidate in self.levels:
+            if len(candidate) >= width:
+                level = candidate
+        edges = np.arange(width) * len(level) // width
+        if len(level) >= width:
+            mins = np.minimum.reduceat(level[:, 0], edges)
+            maxs = np.maximum.reduceat(level[:, 1], edges)
+        else:
+            mins, maxs = level[edges, 0], level[edges, 1]
+        return mins.astype(np.float32) / 127, maxs.astype(np.float32) / 127
+
+    def to_bytes(self) -> bytes:
+        return b''.join(x.tobytes() for x in self.levels)
+
+    @classmethod
+    def from_bytes(cls, info, block, data):
+        levels = []
+        position = 0
+        for length in _level_lengths(info.frames, block):
+            levels.append(np.frombuffer(data, np.int8, length * 2, position).reshape(length, 2))
+            position += length * 2
+        return cls(info, block, levels)
+
+
+def _block_size(frames):
+    block = BLOCK
+    while frames / block > MAX_COLUMNS:
+        block *= 2
+    return block
+
+
+def _level_lengths(frames, block):
+    length = math.ceil(frames / block)
+    lengths = [length]
+    while length > MIN_LEVEL:
+        length = math.ceil(length / LEVEL_FACTOR)
+        lengths.append(length)
+    return lengths
+
+
+def _reduce(level):
+    """Next coarser level, LEVEL_FACTOR pairs become one"""
+    padding = -len(level) % LEVEL_FACTOR
+    if padding:
+        level = np.concatenate([level, np.repeat(level[-1:], padding, axis=0)])
+    grouped = level.reshape(-1, LEVEL_FACTOR, 2)
+    return np.stack([grouped[:, :, 0].min(axis=1), grouped[:, :, 1].max(axis=1)], axis=1)
+
+
+def compute(path):
+    """Peaks of a sound file, None when it can't be decoded"""
+    ext = schema.extension(path)
+    if ext in EXTENSIONS:
+        info = read_info(path)
+        blocks = _blocks
+    elif ext in SOUNDFILE_EXTENSIONS:
+        try:
+            info = _soundfile_info(path)
+        except (ImportError, RuntimeError):
+            return None
+        blocks = _soundfile_blocks
+    else:
+        return None
+    if info is None or not info.frames:
+        return None
+    block = _block_size(info.frames)
+    pairs = []
+    carry = np.zeros((0, info.channels), np.float32)
+    for chunk in blocks(path, info, block * CHUNK_BLOCKS):
+        if len(carry):
+            chunk = np.concatenate([carry, chunk])
+        whole = len(chunk) - len(chunk) % block
+        carry = chunk[whole:]
+        if whole:
+            # Every block of all channels is one row
+            rows = chunk[:whole].reshape(-1, block * info.channels)
+            pairs.append(np.stack([rows.min(axis=1), rows.max(axis=1)], axis=1))
+    if len(carry):
+        pairs.append(np.array([[carry.min(), carry.max()]], np.float32))
+    if not pairs:
+        return None
+    values = np.concatenate(pairs)
+    # Rounded outwards so a quiet sound doesn't become a flat line
+    level = np.stack([np.floor(values[:, 0] * 127), np.ceil(values[:, 1] * 127)], axis=1)
+    level = np.clip(level, -127, 127).astype(np.int8)
+    # The header can promise more frames than the file has
+    info = info._replace(frames=min(info.frames, (len(level) - 1) * block + (len(carry) or block)))
+    levels = [level]
+    for length in _level_lengths(info.frames, block)[1:]:
+        levels.append(_reduce(levels[-1]))
+    return Peaks(info, block, levels)
+
+
+class WaveformCache:
+    """
+    SQLite store of Peaks keyed on path, size and mtime.
+
+    Files that couldn't be decoded are stored without peaks so they aren't tried again.
+    """
+
+    def __init__(self, path=WAVEFORM_PATH):
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA busy_timeout = 10000')
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS {WAVEFORM_TABLE} (path TEXT PRIMARY KEY, size INTEGER, '
+                          f'mtime FLOAT, sample_rate INTEGER, channels INTEGER, bits INTEGER, frames INTEGER, '
+                          f'block INTEGER, data BLOB)')
+
+    def get(self, path, size, mtime):
+        """Peaks of path, False when it couldn't be decoded, None when it isn't stored for this size and mtime"""
+        row = self.conn.execute(f'SELECT sample_rate, channels, bits, frames, block, data FROM {WAVEFORM_TABLE} '
+                                f'WHERE path = ? AND size IS ? AND mtime IS ?', [path, size, mtime]).fetchone()
+        if row is None:
+            return None
+        sample_rate, channels, bits, frames, block, data = row
+        if not data:
+            return False
+        return Peaks.from_bytes(AudioInfo(sample_rate, channels, bits, frames, None, 0, False), block, data)
+
+    def put_many(self, rows):
+        """Stores (path, size, mtime, Peaks or None) rows"""
+        with self.conn:
+            self.conn.executemany(
+                f'INSERT OR REPLACE INTO {WAVEFORM_TABLE} (path, size, mtime, sample_rate, channels, bits, frames, '
+                f'block, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(path, size, mtime, peaks.info.sample_rate, peaks.info.channels, peaks.info.bits,
+                  peaks.info.frames, peaks.block, peaks.to_bytes()) if peaks else
+                 (path, size, mtime, None, None, None, None, None, b'') for path, size, mtime, peaks in rows])
+
+    def put(self, path, size, mtime, peaks):
+        self.put_many([(path, size, mtime, peaks)])
+
+    def close(self):
+        self.conn.close()
+
+
+def _compute_many(items):
+    """Runs in the worker processes, files that can't be opened come back as False to try them later"""
+    results = []
+    for file_id, path, size, mtime in items:
+        try:
+            peaks = compute(path)
+        except OSError:
+            peaks = False
+        except ValueError:
+            # Truncated or inconsistent data
+            peaks = None
+        results.append((file_id, path, size, mtime, peaks))
+    return results
+
+
+def _candidates(db, root, exts):
+    clause = 'AND f.root_id = ?' if root is not None else ''
+    params = [schema.root_id(db, root)] if root is not None else []
+    join = os.path.join
+    return [(file_id, join(folder, name), size, mtime) for file_id, folder, name, size, mtime in db.execute(
+        f'SELECT f.id, d.path, f.name, f.size, f.mtime FROM {schema.FILES} f '
+        f'JOIN {schema.DIRECTORIES} d ON d.id = f.dir_id '
+        f'WHERE f.ext IN ({", ".join("?" * len(exts))}) AND f.meta IS NULL {clause} ORDER BY f.dir_id',
+        exts + params)]
+
+
+def _write(db, cache, results):
+    results = [x for x in results if x[4] is not False]
+    cache.put_many([(path, size, mtime, peaks) for file_id, path, size, mtime, peaks in results])
+    # Only stored when the file still has the size and mtime it had when it was read
+    with db.conn:
+        db.conn.executemany(
+            f'UPDATE {schema.FILES} SET duration = ?, sample_rate = ?, channels = ?, bits = ?, meta = ? '
+            f'WHERE id = ? AND size IS ? AND mtime IS ?',
+            [(peaks.duration, peaks.info.sample_rate, peaks.info.channels, peaks.info.bits, 1, file_id, size, mtime)
+             if peaks else (None, None, None, None, 0, file_id, size, mtime)
+             for file_id, path, size, mtime, peaks in results])
+
+
+def update(db, root=None, processes=DEFAULT_PROCESSES, cancel=None, progress=None, cache_path=WAVEFORM_PATH) -> int:
+    """
+    Computes the peaks of new and changed sound files and returns how many were read.
+
+    root limits it to one watched folder. progress(done, total) is called as
+    peaks are written, reading stops when cancel (a threading.Event) is set.
+    """
+    timer_peaks = timer()
+    items = _candidates(db, root, extensions())
+    if not items:
+        return 0
+    cache = WaveformCache(cache_path)
+    pending = []
+
+    def collect(results):
+        pending.extend(results)
+        if len(pending) >= WRITE_BATCH:
+            _write(db, cache, pending)
+            pending.clear()
+
+    try:
+        with span('waveform.update', files=len(items)), workers.process_pool(processes) as pool:
+            done = workers.run(pool, _compute_many, workers.batches(items, BATCH), processes, collect, cancel,
+                               None if progress is None else lambda done: progress(done, len(items)), root,
+                               workers.item_bytes)
+            _write(db, cache, pending)
+    finally:
+        cache.close()
+    count('waveform.files', done)
+    l.info(f'Computed waveforms of {done} sound files in {timer_peaks}')
+    return done
@@ -0,0 +1,75 @@
+"""
+Process pool shared by the steps that read file contents after a scan (hashing, image headers, ...).
+
+Work is handed out as tasks (lists of items) and only a couple of tasks per
+process are queued at a time, so the number of processes is also the number of
+files read from the NAS at once and cancelling doesn't wait for a long queue.
+Every task takes a slot of the I/O scheduler (see iosched.py) before it's handed
+to a process and gives it back when it's done.
+
+    with process_pool(4) as pool:
+        run(pool, parse_many, batches(items, 64), 4, write)
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from . import iosched
+
+# Tasks queued per process
+TASKS_AHEAD = 2
+
+
+def process_pool(processes) -> ProcessPoolExecutor:
+    # The GUI has Qt loaded which isn't safe to fork, start clean processes
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+
+
+def batches(items, size):
+    """Splits a list into tasks of size items"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def item_bytes(task) -> int:
+    """Size of the (file id, path, size, mtime) items of a task, the cost of reading them whole"""
+    return sum(x[2] or 0 for x in task)
+
+
+def run(pool, work, tasks, processes, collect, cancel=None, progress=None, root=None, cost=None) -> int:
+    """
+    Runs work(task) in the pool for every task and passes the results to collect on this thread.
+
+    work returns a list with a result per item. progress(done) is called with
+    the number of items done, cancel is a threading.Event. Tasks are scheduled
+    as reads of the watched folder root, cost(task) is the bytes they read when
+    that's more than a header (see item_bytes). Returns items done.
+    """
+    pending = set()
+    tasks = iter(tasks)
+    done = 0
+    try:
+        while True:
+            while len(pending) < processes * TASKS_AHEAD:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                request = iosched.acquire(root, iosched.BACKGROUND, cost(task) if cost is not None else 0, cancel)
+                if request is None:
+                    break
+                future = pool.submit(work, task)
+                # Also when it's cancelled, the slot mustn't wait for collect
+                future.add_done_callback(lambda future, request=request: iosched.release(request))
+                pending.add(future)
+            if not pending or (cancel is not None and cancel.is_set()):
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                results = future.result()
+                collect(results)
+                done += len(results)
+            if progress is not None:
+                progress(done)
+    finally:
+        for future in pending:
+            future.cancel()
+    return done
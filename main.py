@@ -1,20 +1,53 @@
 from PySide2 import QtCore, QtWidgets, QtGui
 from pathlib import Path
-from PySide6.QtGui import QIcon, QPixmap
 
-from blom import init_logger, timer
-import sqlite_utils as sql
+from frankenstein import blom
+from frankenstein.blom import init_logger, timer, format_bytes
 import sys
+import os
 from PySide2.QtUiTools import QUiLoader
 from PySide2.QtWidgets import QApplication, QMainWindow, QDialog, QMessageBox, QTableWidget, QListWidgetItem, QLineEdit, \
     QFileDialog
-from PySide2.QtCore import QFile, QIODevice, QSize, Qt, QCoreApplication, QRectF, Slot
+from PySide2.QtCore import QFile, QIODevice, QSize, Qt, QCoreApplication, QRectF, Slot, QTimer, QEvent
 import re
 from ui_loader import load_ui
+from frankenstein import iosched
+from frankenstein import scanner
+from frankenstein import schema
+from frankenstein import query
+from frankenstein import sequences
+from frankenstein import service
+from frankenstein import imagemeta
+from frankenstein import modelmeta
+from frankenstein import videoframes
+from frankenstein import waveform
+from frankenstein.walker import DEFAULT_WORKERS
+from scanthread import ScanManager
+from watchthread import WatchManager
+from thumbnails import ThumbnailManager, THUMBNAIL_PATH, image_hash
+from preview import PreviewLoader
+from filesmodel import FilesModel
+from foldermodel import FolderModel
+from stagethread import StageManager
+from statspanel import StatsPanel
+from duplicatespanel import DuplicatesPanel
 from time import sleep
 
 l = init_logger('frankenstein')
-db = sql.Database('database.db')
+DATABASE_PATH = 'database.db'
+
+# Number of search results grouped into sequences at once
+SEARCH_PAGE_SIZE = 500
+
+# Images listed by Find similar
+SIMILAR_LIMIT = 200
+
+# (order, descending) of the entries in the sortorder combobox
+SORT_ORDERS = [('path', False), ('name', False), ('size', True), ('mtime', True), ('resolution', True),
+               ('duration', False), ('triangles', False)]
+
+# Record spans and counters for the stats panel from the start, it can be switched off there
+TRACING = True
 
 
 def infomsg(parent, msg: str):
@@ -31,6 +64,54 @@ class MainWindow(QMainWindow):
         loader = QUiLoader()
         load_ui('ui.ui', self)
         self.progressBar.setValue(12)
+        blom.enable(TRACING)
+        self.stats_panel = None
+        self.duplicates_panel = None
+        # Everything that reads the index goes through a service when FRANKENSTEIN_SERVICE has its address,
+        # the local index file isn't opened then
+        address = os.environ.get(service.SERVICE_VARIABLE)
+        self.remote = bool(address)
+        self.db = None
+        if not self.remote:
+            self.db = schema.connect(DATABASE_PATH)
+            schema.ensure_schema(self.db)
+        self.index = service.open_index(address, self.db)
+        self.scans = ScanManager(DATABASE_PATH, parent=self)
+        # Only list directories whose mtime changed since last scan
+        self.scans.incremental = True
+        # Number of directories listed at the same time while scanning
+        self.scans.workers = DEFAULT_WORKERS
+        # Number of changed rows committed per transaction
+        self.scans.batch_size = 5000
+        # Scans, thumbnails and the other background reads share the NAS with the previews and make way for them:
+        # background reads at the same time, only 2 while previews are read, per watched folder, bytes per second
+        iosched.configure(slots=32, busy_slots=2, root_slots=16, root_bandwidth=None)
+        self._scan_total = 0
+        self._shown_image = None
+        # Decodes previews off the GUI thread and keeps the last ones shown
+        self.previews = PreviewLoader(THUMBNAIL_PATH, size=500, parent=self)
+        self.thumbnail_jobs = ThumbnailManager(DATABASE_PATH, THUMBNAIL_PATH, parent=self)
+        # Read after every scan, only new and changed files
+        self.stages = StageManager(DATABASE_PATH, [('Image headers', imagemeta.update),
+                                                   ('Waveforms', waveform.update),
+                                                   ('Video frames', videoframes.update),
+                                                   ('3D models', modelmeta.update)], parent=self)
+        # Watched folders are kept up to date with inotify, or polled on network mounts, the service does its own
+        self.watches = None
+        if not self.remote:
+            self.watches = WatchManager(DATABASE_PATH, self.scans, parent=self)
+            self.watches.watcher.poll_interval = 300
+        # Search runs when typing pauses for this many ms
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        # Rows are read from the database a page at a time as the list scrolls
+        self.files = FilesModel(self)
+        self.fileslist.setModel(self.files)
+        # Folders of the selected watched folder with their totals, the files list shows the selected one
+        self.folders = FolderModel(self)
+        self.foldertree.setModel(self.folders)
+        self._folder = None
         self._connectAll()
         self._refresh_ui()
         self.filterinput.setText('png jpeg jpg exr tif tiff')
@@ -40,9 +121,20 @@ class MainWindow(QMainWindow):
         l.info(f'Refreshing UI')
 
         self.watchlist.clear()
-        self.fileslist.clear()
+        self.files.clear()
+        self.folders.clear()
+        self._folder = None
 
-        self.watchlist.addItems(self._get_watchlist())
+        try:
+            watchlist = self._get_watchlist()
+        except service.ServiceError as e:
+            watchlist = []
+            self.statusbar.showMessage(str(e))
+        self.watchlist.addItems(watchlist)
+        self.previews.roots = watchlist
+        if not self.remote:
+            # Folders imported from a snapshot are kept up to date by importing the next one
+            self.watches.watch(schema.scanned_roots(self.db))
 
         QCoreApplication.processEvents()
         self.update()
@@ -50,14 +142,36 @@ class MainWindow(QMainWindow):
 
     def _connectAll(self):
         self.watch_refresh.clicked.connect(self._refresh_ui)
-        self.watchlist.itemSelectionChanged.connect(self.fileslist_list_files)
+        self.watchlist.itemSelectionChanged.connect(self.watchlist_selection_changed)
+        self.foldertree.selectionModel().currentChanged.connect(self.foldertree_select)
         self.watch_add.clicked.connect(self.watchlist_add_folder)
         self.watch_remove.clicked.connect(self.watchlist_remove_selected)
         self.watch_scan_all.clicked.connect(self.watchlist_scan_all)
         self.watch_scan_selected.clicked.connect(self.watchlist_scan_selected)
-        self.fileslist.itemSelectionChanged.connect(self.imageviever_show_image)
-        self.btn_filter.clicked.connect(self.fileslist_list_files)
+        self.fileslist.selectionModel().currentChanged.connect(self.imageviever_show_image)
+        self.btn_filter.clicked.connect(self.search_files)
         self.checkBoxGroupImageSequences.stateChanged.connect(self.groupImageSequences)
+        self.sortorder.currentIndexChanged.connect(self.search_files)
+        self.watch_scan_cancel.clicked.connect(self.watchlist_scan_cancel)
+        self.searchinput.textChanged.connect(self.search_timer.start)
+        self.search_timer.timeout.connect(self.search_files)
+        self.scans.progress.connect(self.scan_progress)
+        self.scans.finished.connect(self.scan_finished)
+        self.scans.failed.connect(self.scan_failed)
+        self.scans.idle.connect(self.scan_idle)
+        self.thumbnail_jobs.progress.connect(self.thumbnail_progress)
+        self.thumbnail_jobs.finished.connect(self.similar_stale)
+        self.stages.progress.connect(self.stage_progress)
+        self.stages.finished.connect(self.stage_finished)
+        if self.watches is not None:
+            self.watches.changed.connect(self.watch_changed)
+        self.previews.ready.connect(self.imageviever_preview_ready)
+        self.btn_stats.clicked.connect(self.show_stats)
+        self.btn_duplicates.clicked.connect(self.show_duplicates)
+        self.btn_similar.clicked.connect(self.find_similar)
+        # Moving the mouse over the preview of a clip scrubs through its cached frames
+        self.labelimage.setMouseTracking(True)
+        self.labelimage.installEventFilter(self)
 
     def test(self):
         print("hahahaha")
@@ -65,28 +179,90 @@ class MainWindow(QMainWindow):
     def _table_to_list(self, folder):
         timer_scan_folder_db = timer()
         l.info(f'Looking in db for {str(folder)}')
-        files = list(db[str(folder)].rows_where(select="path"))
-        files_list = [x['path'] for x in files]
+        files_list = [x for page in self.index.files(query.FileQuery(folder)) for x in page]
         l.info(f'Took {timer_scan_folder_db}, returning files')
         return files_list
 
 
     def _get_watchlist(self):
-        return [str(x.name) for x in db.tables]
+        return self.index.roots()
 
     def updateProgressBar(self, val):
-        # TODO do this in thread instead
-        l.info(f'Setting progressbar to something')
         self.progressBar.setValue(val)
 
-    def groupImageSequences(self):
+    def closeEvent(self, event):
+        if self.watches is not None:
+            self.watches.shutdown()
+        self.scans.shutdown()
+        self.thumbnail_jobs.shutdown()
+        self.stages.shutdown()
+        self.previews.shutdown()
+        if self.duplicates_panel is not None:
+            self.duplicates_panel.shutdown()
+        QMainWindow.closeEvent(self, event)
+
+    def show_stats(self):
+        if self.stats_panel is None:
+            self.stats_panel = StatsPanel(self)
+        self.stats_panel.show()
+        self.stats_panel.raise_()
+
+    def show_duplicates(self):
+        if self.duplicates_panel is None:
+            # Hashing writes to the index, a service hashes on its own machine
+            self.duplicates_panel = DuplicatesPanel(self.index, None if self.remote else DATABASE_PATH, self)
+        self.duplicates_panel.show()
+        self.duplicates_panel.raise_()
+
+    def find_similar(self):
+        """Lists the images that look like the shown one, nearest first"""
+        if self._shown_image is None:
+            return
+        timeer = timer()
+        try:
+            paths = self.index.similar(self._shown_image, SIMILAR_LIMIT)
+            if paths is None:
+                # Not hashed yet, the preview is close enough to the thumbnail it's made from
+                image = self.previews.cached(self._shown_image)
+                if image is None:
+                    self.statusbar.showMessage(f'{self._shown_image} is not decoded yet')
+                    return
+                paths = self.index.similar(self._shown_image, SIMILAR_LIMIT, image_hash(image))
+        except service.ServiceError as e:
+            self.statusbar.showMessage(str(e))
+            return
+        self.files.set_pages([[self._shown_image] + paths], len(paths) + 1)
+        self.number_of_files.setText(f'{len(paths)} similar')
+        l.info(f'Found {len(paths)} images similar to {self._shown_image} in {timeer}')
 
-        paths=sortImageSequence.combinedPaths(self.currentFiles)
+    def similar_stale(self):
+        # New hashes were stored or files changed
+        self.index.similar_stale()
 
-        self.fileslist.clear()
-        self.fileslist.addItems(paths)
-        self.number_of_files.setText(f'{len(paths)} files')
-        self.update()
+    def groupImageSequences(self):
+        # Listing and search both look at the checkbox
+        self.search_files()
+
+    def watchlist_selection_changed(self):
+        selected = [x.text() for x in self.watchlist.selectedItems()]
+        self._folder = None
+        # Background work of the folder that's looked at goes first
+        focused = selected[0] if selected else None
+        iosched.focus(focused)
+        self.scans.focus(focused)
+        self.thumbnail_jobs.focus(focused)
+        self.stages.focus(focused)
+        self.folders.set_root(self.index, selected[0] if selected else None)
+        self.foldertree.expand(self.folders.index(0, 0))
+        self.fileslist_list_files()
+
+    def foldertree_select(self, current):
+        folder = self.folders.folder(current)
+        if folder is None:
+            return
+        # The whole watched folder lists like before
+        self._folder = folder.path if current.parent().isValid() else None
+        self.fileslist_list_files()
 
     def fileslist_list_files(self):
         timeer = timer()
@@ -95,43 +271,67 @@ class MainWindow(QMainWindow):
         except:
             l.warning('Skipping fileslist_list_files selected couldnt be found')
             return
-        l.info(f'Listing files for {selected}')
-
-        listan = self._table_to_list(selected)
-
-        # Filtering
-        filtertext = self.filterinput.text()
-
-        if filtertext:
-            filters = filtertext.split()
-            l.info(f'filters: {filters}')
-
-            newlistan = []
+        l.info(f'Listing files for {self._folder or selected}')
 
-            for filt in filters:
-                newlistan.extend([x for x in listan if x.endswith(filt.lower())])
-                newlistan.extend([x for x in listan if x.endswith(filt.upper())])
-            listan = newlistan
-
-        number_of_files = len(listan)
-
-        self.currentFiles = listan
+        # Filtering happens in the database against the indexed extension and image columns
+        filters = query.parse_filter(self.filterinput.text())
+        extensions = filters['extensions']
+        l.info(f'filters: {filters}')
+        try:
+            if self.checkBoxGroupImageSequences.isChecked():
+                # Sequences are detected while scanning, this is a lookup
+                pages = self.index.sequences(selected, extensions, self._folder)
+                number_of_files = self.index.sequence_count(selected, extensions, self._folder)
+            else:
+                order, descending = SORT_ORDERS[max(0, self.sortorder.currentIndex())]
+                files = query.FileQuery(selected, order=order, descending=descending, folder=self._folder, **filters)
+                pages = self.index.files(files)
+                number_of_files = self.index.count(files)
+        except service.ServiceError as e:
+            self.statusbar.showMessage(str(e))
+            return
 
-        self.fileslist.clear()
-        self.fileslist.addItems(listan)
+        self.files.set_pages(pages, number_of_files)
         self.number_of_files.setText(f'{number_of_files} files')
         self.update()
 
         l.info(f'Took {timeer}')
 
+    def search_files(self):
+        text = self.searchinput.text().strip()
+        if not text:
+            self.fileslist_list_files()
+            return
+        timeer = timer()
+        extensions = query.parse_extensions(self.filterinput.text())
+        try:
+            if self.checkBoxGroupImageSequences.isChecked():
+                results = next(iter(self.index.search(text, extensions=extensions, page_size=SEARCH_PAGE_SIZE)), [])
+                self.files.set_pages([sortImageSequence.combinedPaths(results)])
+                more = len(results) == SEARCH_PAGE_SIZE
+            else:
+                self.files.set_pages(self.index.search(text, extensions=extensions))
+                more = self.files.rowCount() == query.PAGE_SIZE
+            if more:
+                self.number_of_files.setText(f'{self.index.search_count(text, extensions=extensions)} files')
+            else:
+                self.number_of_files.setText(f'{self.files.rowCount()} files')
+        except service.ServiceError as e:
+            self.statusbar.showMessage(str(e))
+            return
+        l.info(f'Search for {text} took {timeer}')
+
     def watchlist_add_folder(self):
         path = QFileDialog.getExistingDirectory(self, self.tr("Load Folder"))
 
-        if path:
+        if path and self.remote:
+            # The service adds it when the scan job starts
+            self._start_scan([path])
+        elif path:
 
             clock = timer()
             l.info(f'Adding {path} to db')
-            db[path].create({'path': str})
+            scanner.ensure_tables(self.db, path)
             l.info(f"Added {1} folder in {clock}")
             self._refresh_ui()
 
@@ -142,176 +342,179 @@ class MainWindow(QMainWindow):
         # Can be optimized by removing it from gui only and db instead of refreshing the whole list from db after removing it.
 
         selected = self.watchlist.selectedItems()[0].text()
+        if self.remote:
+            self.statusbar.showMessage(f'{selected} is watched by the index service, it can only be removed there')
+            return
 
-        l.info(f'Removing selected table: {selected}')
-        db[selected].drop()
-        db.conn.commit()
+        l.info(f'Removing selected folder: {selected}')
+        self.watches.unwatch(selected)
+        schema.remove_root(self.db, selected)
 
-        self.refresh_ui()
+        self._refresh_ui()
 
     def watchlist_scan_selected(self):
-        selected = self.watchlist.selectedItems()[0].text()
+        try:
+            selected = self.watchlist.selectedItems()[0].text()
+        except IndexError:
+            l.warning('Nothing selected to scan')
+            return
         l.info(f"Scanning selected {selected}")
-        timer_scan_total = timer()
-
-        self.updateProgressBar(0)
-        l.info('#' * 50)
-        timer_scan = timer()
-        l.info(f'Dropping folder...')
-        db[selected].drop()
-        db.conn.commit()
-        files_folders = list(Path(selected).rglob("*"))
-        l.info(f"Found {len(files_folders)} files and folders total in {timer_scan}")
-
-        # l.info('TODO cleaning db if exists')
-
-        l.info(f'Checking which is file and folder (can prob be optimized)')
-        timer_filefolder = timer()
-        files = [x for x in files_folders if x.is_file()]
-        l.info(f'Found {len(files)} files')
-        l.info(f'Found {len(files_folders) - len(files)} folders')
-        files_clean = [{'path': str(x)} for x in files]
-        l.info(f'Took {timer_filefolder}')
-
-        l.info('Writing to db')
-        timer_db_write = timer()
-        db[str(selected)].insert_all(files_clean)
-        l.info(f'Took {timer_db_write}')
-
-        l.info(f'Total took {timer_scan_total} refreshing...')
-        self.updateProgressBar(100)
-        self._refresh_ui()
+        self._start_scan([selected])
 
     def watchlist_scan_all(self):
         watchlist = self._get_watchlist()
         l.info(f"Scanning all {len(watchlist)} folders in watchlist")
-        timer_scan_all_total = timer()
-
-        for i, folder in enumerate(watchlist):
-            self.updateProgressBar((i + 1) / len(watchlist) * 100)
-            l.info('#' * 50)
-            l.info(f"Scanning folder {i} of {len(watchlist)}  {folder}")
-            timer_scan = timer()
-            l.info(f'Dropping folder...')
-            db[folder].drop()
-            db.conn.commit()
-            files_folders = list(Path(folder).rglob("*"))
-            l.info(f"Found {len(files_folders)} files and folders total in {timer_scan}")
-
-            # l.info('TODO cleaning db if exists')
-
-            l.info(f'Checking which is file and folder (can prob be optimized)')
-            timer_filefolder = timer()
-            files = [x for x in files_folders if x.is_file()]
-            l.info(f'Found {len(files)} files')
-            l.info(f'Found {len(files_folders) - len(files)} folders')
-            files_clean = [{'path': str(x)} for x in files]
-            l.info(f'Took {timer_filefolder}')
-
-            l.info('Writing to db')
-            timer_db_write = timer()
-            db[str(folder)].insert_all(files_clean)
-            l.info(f'Took {timer_db_write}')
-
-        l.info(f'Total took {timer_scan_all_total} refreshing...')
+        self._start_scan(watchlist)
+
+    def _start_scan(self, roots):
+        if self.remote:
+            # The service scans and reads the contents, one job after the other
+            try:
+                job = self.index.scan(roots)
+            except service.ServiceError as e:
+                self.statusbar.showMessage(str(e))
+                return
+            self.statusbar.showMessage(f'Queued scan job {job} of {len(roots)} folders')
+            return
+        for root in roots:
+            scanner.ensure_tables(self.db, root)
+        if not self.scans.is_scanning():
+            self._scan_total = 0
+            self.updateProgressBar(0)
+        self._scan_total += len([x for x in roots if not self.scans.is_scanning(x)])
+        self.scans.scan(roots)
+        self.watch_scan_cancel.setEnabled(True)
+
+    def watchlist_scan_cancel(self):
+        l.info('Cancelling scans')
+        self.scans.cancel()
+
+    def scan_progress(self, root, files_found, bytes_seen, rate):
+        self.statusbar.showMessage(f'Scanning {root}: {files_found} files, {format_bytes(bytes_seen)}, '
+                                   f'{round(rate)} files/sec')
+
+    def scan_finished(self, root, stats, cancelled):
+        done = self._scan_total - self.scans.pending()
+        self.updateProgressBar(done / max(self._scan_total, 1) * 100)
+        state = 'Cancelled' if cancelled else 'Finished'
+        if not cancelled:
+            self.thumbnail_jobs.generate(root)
+            self.stages.run(root)
+        self.statusbar.showMessage(f'{state} {root}: {stats.inserted} new, {stats.updated} changed, '
+                                   f'{stats.deleted} removed')
+
+        # Only reload the files list when it shows the root that changed
+        selected = [x.text() for x in self.watchlist.selectedItems()]
+        if root in selected:
+            self._refresh_folders()
+            if not self.checkBoxGroupImageSequences.isChecked():
+                self.fileslist_list_files()
+
+    def scan_failed(self, root, error):
+        done = self._scan_total - self.scans.pending()
+        self.updateProgressBar(done / max(self._scan_total, 1) * 100)
+        self.statusbar.showMessage(f'Writing {root} to the index failed: {error}')
+
+    def watch_changed(self, root, stats):
+        self.similar_stale()
+        self.statusbar.showMessage(f'Updated {root}: {stats.inserted} new, {stats.updated} changed, '
+                                   f'{stats.deleted} removed')
+        if stats.inserted or stats.updated:
+            self.stages.run(root)
+        # Search covers every watched folder, the listing only the selected one
+        selected = [x.text() for x in self.watchlist.selectedItems()]
+        if root in selected:
+            self._refresh_folders()
+        if self.searchinput.text().strip() or root in selected:
+            self.search_files()
+
+    def _refresh_folders(self):
+        if self.folders.rowCount() == 0:
+            # Scanned for the first time
+            selected = [x.text() for x in self.watchlist.selectedItems()]
+            self.folders.set_root(self.index, selected[0] if selected else None)
+            self.foldertree.expand(self.folders.index(0, 0))
+        else:
+            self.folders.refresh()
+
+    def thumbnail_progress(self, root, done, total):
+        self.statusbar.showMessage(f'Thumbnails for {root}: {done} of {total}')
+
+    def stage_progress(self, stage, root, done, total):
+        self.statusbar.showMessage(f'{stage} of {root}: {done} of {total}')
+
+    def stage_finished(self, stage, root):
+        # Image filters and the resolution order see the new values
+        selected = [x.text() for x in self.watchlist.selectedItems()]
+        if root in selected and not self.searchinput.text().strip() \
+                and not self.checkBoxGroupImageSequences.isChecked():
+            self.fileslist_list_files()
+
+    def scan_idle(self):
         self.updateProgressBar(100)
-        self._refresh_ui()
+        self.watch_scan_cancel.setEnabled(False)
 
     def imageviever_show_image(self):
-
-        timeer = timer()
-        selected = self.fileslist.selectedItems()[0].text()
+        row = self.fileslist.currentIndex().row()
+        if self.files.path(row) is None:
+            return
+        selected = sequences.first_frame_path(self.files.path(row))
         l.info(f'Showing image for {selected}')
+        self._shown_image = selected
+
+        image = self.previews.cached(selected)
+        if image is not None:
+            self._set_preview(image)
+        else:
+            self.previews.request(selected)
 
-        actualImage = QtGui.QImage(selected)
-        pixmap = QtGui.QPixmap(actualImage)
+        # Rows next to the selection are decoded ahead for arrow key browsing
+        neighbours = [self.files.path(x) for x in (row + 1, row - 1)]
+        self.previews.prefetch(sequences.first_frame_path(x) for x in neighbours if x is not None)
 
-        pixmap = pixmap.scaled(500, 500, QtCore.Qt.KeepAspectRatio)
+    def imageviever_preview_ready(self, path, image):
+        if path != self._shown_image:
+            return
+        if image.isNull():
+            l.warning(f'Could not read {path}')
+            return
+        self._set_preview(image)
+
+    def eventFilter(self, watched, event):
+        if watched is self.labelimage and self._shown_image is not None:
+            if event.type() == QEvent.MouseMove:
+                self.imageviever_scrub(event.pos().x() / max(1, self.labelimage.width()))
+            elif event.type() == QEvent.Leave:
+                image = self.previews.cached(self._shown_image)
+                if image is not None:
+                    self._set_preview(image)
+        return QMainWindow.eventFilter(self, watched, event)
+
+    def imageviever_scrub(self, fraction):
+        """Shows the frame at a fraction of the shown clip from its scrub strip, the clip isn't opened"""
+        strip = self.previews.strip(self._shown_image)
+        if strip is None:
+            return
+        image, frames = strip
+        width = image.width() // frames
+        index = min(frames - 1, max(0, int(fraction * frames)))
+        self._set_preview(image.copy(index * width, 0, width, image.height()))
 
+    def _set_preview(self, image):
+        pixmap = QtGui.QPixmap.fromImage(image).scaled(500, 500, QtCore.Qt.KeepAspectRatio)
         self.labelimage.setPixmap(pixmap)
         self.labelimage.setScaledContents(True)
-        l.info(f'Took {timeer}')
-
 
-def scan_folder_disk(folder):
-    timer_scan_folder_disk = timer()
-    l.info(f'Adding folder {str(folder)}')
-    l.warning('Deleing previous records')
-    db[folder].delete_where()
-    l.info('Deleted')
-    l.info(f'Scanning...')
-    files_folders = list(folder.rglob("*"))
-    l.info(f'Scan took {timer_scan_folder_disk}')
-    return files_folders
 
 class sortImageSequence:
-    regexPattern = r'\.[0-9]{1,100}\.'
-
     @staticmethod
-    def _getFrameNumber(path: str):
+    def combinedPaths(paths: list) -> list:
         """
-        Returns the frameNumber and regex match based on path
+        Returns a sorted list where every image sequence is replaced by one entry with its framerange
 
-        re.search(r'\.[0-9]{1,100}\.[a-z]+',x) #match frames and extension
-        re.search(r'\.[0-9]{1,100}\.',x) #match frames
-        """
-        match = re.search(sortImageSequence.regexPattern, str(path))  # match frames
-        if match:
-            match_clean = match.group()
-            match_clean = match_clean[1:-1]  # remove the dots
-            match_clean = int(match_clean)
-            return (match_clean, match)
-        else:
-            return None
-
-    @staticmethod
-    def combinedPaths(paths: list) -> str:
+        paths is not modified, see sequences.py
         """
-        Returns a string with combined framerange from the inserted list
-        """
-
-        # Find all sequences
-        sequences = {
-        }
-
-        for path in paths:
-            frame = sortImageSequence._getFrameNumber(path)
-            if frame:
-                delrange = frame[1].regs[0]
-                number = int(frame[1].group()[1:-1])
-                numberlength = len(str(frame[0]))
-                outstrtemp = path[:delrange[0]] + "." + ("#" * numberlength) + "." + path[delrange[1]:]
-
-                try:
-                    # Try if list already exists
-                    sequences[outstrtemp]
-                except KeyError:
-                    sequences[outstrtemp] = {}
-
-                sequences[outstrtemp][path] = {'delrange': delrange,
-                                               'numberlength': numberlength,
-                                               'number': number}
-
-        # Find start end sequences
-        for key, item in sequences.items():
-            frames = [x['number'] for y, x in item.items()]
-            sequences[key]["startframe"] = min(frames)
-            sequences[key]["endframe"] = max(frames)
-
-        # Add these to list:
-        for key, item in sequences.items():
-
-            paths.append(key)
-            filestoremove = [x for x in item.keys() if x != "startframe" and x != 'endframe']
-
-            for file in filestoremove:
-                del paths[paths.index(file)]
-
-        # remove files to list
-
-        paths.sort()
-
-        return paths
+        return sequences.combined(paths)
 
 
 """
@@ -1,11 +1,41 @@
 from PyQt5.QtCore import *
-from PyQt5.QtWidgets import QSlider
+from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtWidgets import QSlider, QLabel
 
 class myVideoSlider(QSlider):
     ClickedValue = pyqtSignal(int)
 
     def __init__(self, father):
         super().__init__(Qt.Horizontal, father)
+        # Cached scrub strip (see frankenstein/videoframes.py), shown above the slider on hover and while dragging
+        self.strip = None
+        self.stripFrames = 0
+        self.framePreview = QLabel(self, Qt.ToolTip)
+        self.framePreview.hide()
+        self.setMouseTracking(True)
+
+    def setStrip(self, data, frames):
+        """JPEG bytes of a strip of frames next to each other, None to clear it"""
+        self.strip = QImage.fromData(data, 'JPG') if data else None
+        if self.strip is not None and self.strip.isNull():
+            self.strip = None
+        self.stripFrames = frames if self.strip is not None else 0
+        self.framePreview.hide()
+
+    def hasStrip(self):
+        return self.strip is not None
+
+    def showFrame(self, fraction):
+        """Shows the cached frame at a fraction of the clip above the slider, no seeking"""
+        if self.strip is None:
+            return
+        width = self.strip.width() // self.stripFrames
+        index = min(self.stripFrames - 1, max(0, int(fraction * self.stripFrames)))
+        self.framePreview.setPixmap(QPixmap.fromImage(self.strip.copy(index * width, 0, width, self.strip.height())))
+        self.framePreview.adjustSize()
+        x = round(fraction * self.width()) - self.framePreview.width() // 2
+        self.framePreview.move(self.mapToGlobal(QPoint(x, -self.framePreview.height() - 4)))
+        self.framePreview.show()
 
     def mousePressEvent(self, QMouseEvent):     #单击事件
         super().mousePressEvent(QMouseEvent)
@@ -13,3 +43,19 @@ class myVideoSlider(QSlider):
         # self.setValue(int(value)/9)
         value = round(value/self.width()*self.maximum())  # 根据鼠标点击的位置和slider的长度算出百分比
         self.ClickedValue.emit(value)
+
+    def mouseMoveEvent(self, QMouseEvent):      # hover and drag show the cached frame under the mouse
+        super().mouseMoveEvent(QMouseEvent)
+        if self.isSliderDown():
+            self.showFrame(self.value() / max(1, self.maximum()))
+        else:
+            self.showFrame(min(1.0, max(0.0, QMouseEvent.localPos().x() / max(1, self.width()))))
+
+    def mouseReleaseEvent(self, QMouseEvent):
+        super().mouseReleaseEvent(QMouseEvent)
+        self.framePreview.hide()
+
+    def leaveEvent(self, QEvent):
+        super().leaveEvent(QEvent)
+        if not self.isSliderDown():
+            self.framePreview.hide()
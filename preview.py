@@ -0,0 +1,283 @@
+"""
+Preview decoding for the image viewer.
+
+Images are decoded off the GUI thread at the size the viewer shows them:
+
+    - JPEG is downscaled while decoding through QImageReader.setScaledSize
+    - multi-page TIFFs use the smallest page (reduced resolution subfile) that is still big enough
+    - everything else is decoded and scaled down in the worker thread
+
+A cached thumbnail (see thumbnails.py) is used instead of decoding when there is
+one. Sound files get a picture of their waveform instead, drawn from the peaks
+in the waveform cache (see frankenstein/waveform.py) or computed and stored
+there the first time. Video clips show their poster frame from the video frame
+cache (see frankenstein/videoframes.py) and keep the scrub strip next to it for
+hovering. Recent previews are kept in a small in-memory LRU and the viewer prefetches
+the rows around the selected one, so arrow key browsing doesn't wait on the NAS.
+Previews are INTERACTIVE reads of the I/O scheduler (see frankenstein/iosched.py),
+scans and background reads make room while they run. A prefetch that is still
+queued when its row gets selected moves to the front.
+"""
+import os
+import subprocess
+import threading
+from collections import OrderedDict
+
+from PySide2.QtCore import QObject, QRunnable, QThreadPool, Signal, Qt
+from PySide2.QtGui import QColor, QImage, QImageReader, QPainter
+
+from frankenstein import iosched, schema, videoframes, waveform
+from frankenstein.blom import count, get_logger, span, timer
+from thumbnails import ThumbnailCache, THUMBNAIL_PATH, THUMBNAIL_SIZE, encode_thumbnail
+
+l = get_logger('frankenstein.preview')
+
+PREVIEW_SIZE = 500
+DEFAULT_CACHE_ENTRIES = 32
+DEFAULT_THREADS = 4
+
+# Requests for the selected row go before prefetches
+PRIORITY_SELECTED = 1
+PRIORITY_PREFETCH = 0
+
+
+@span('preview.decode')
+def decode_preview(path, size=PREVIEW_SIZE) -> QImage:
+    """Decodes path no bigger than size x size, decoding as few pixels as the format allows"""
+    reader = QImageReader(path)
+    reader.setAutoTransform(True)
+
+    if reader.imageCount() > 1 and reader.format().data() in (b'tif', b'tiff'):
+        # Pick the smallest page that still covers the preview
+        best, best_area = None, None
+        for index in range(reader.imageCount()):
+            if not reader.jumpToImage(index):
+                break
+            page = reader.size()
+            area = page.width() * page.height()
+            if page.width() >= size or page.height() >= size:
+                if best_area is None or area < best_area:
+                    best, best_area = index, area
+        reader = QImageReader(path)
+        reader.setAutoTransform(True)
+        if best:
+            reader.jumpToImage(best)
+
+    full = reader.size()
+    if full.isValid() and (full.width() > size or full.height() > size):
+        # JPEG scales while decoding (DCT downscaling), other formats scale after
+        reader.setScaledSize(full.scaled(size, size, Qt.KeepAspectRatio))
+    image = reader.read()
+    if image.isNull():
+        l.warning(f'Could not decode {path}: {reader.errorString()}')
+    return image
+
+
+def draw_waveform(peaks, width=PREVIEW_SIZE, height=PREVIEW_SIZE // 4) -> QImage:
+    """Image of the min/max peaks of a sound, one vertical line per pixel"""
+    image = QImage(width, height, QImage.Format_RGB32)
+    image.fill(QColor(30, 30, 30))
+    mins, maxs = peaks.columns(width)
+    middle = (height - 1) / 2
+    painter = QPainter(image)
+    painter.setPen(QColor(60, 60, 60))
+    painter.drawLine(0, int(middle), width - 1, int(middle))
+    painter.setPen(QColor(120, 200, 120))
+    for x, (low, high) in enumerate(zip(mins.tolist(), maxs.tolist())):
+        painter.drawLine(x, int(middle - high * middle), x, int(middle - low * middle))
+    painter.end()
+    return image
+
+
+class _Signals(QObject):
+    # path, preview, thumbnail to store (b'' for none), size, mtime, (strip, frames) of clips or None
+    decoded = Signal(str, QImage, bytes, object, object, object)
+
+
+class _DecodeJob(QRunnable):
+    def __init__(self, loader, path):
+        QRunnable.__init__(self)
+        self.loader = loader
+        self.path = path
+
+    def run(self):
+        timer_decode = timer()
+        path = self.path
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.loader._signals.decoded.emit(path, QImage(), b'', None, None, None)
+            return
+        # Never waits, but the bytes count against the bandwidth of its watched folder
+        with iosched.slot(self.loader.root_of(path), iosched.INTERACTIVE, st.st_size):
+            self._decode(path, st, timer_decode)
+
+    def _decode(self, path, st, timer_decode):
+        ext = schema.extension(path)
+        if ext in self.loader.sound_extensions:
+            image = self._waveform(path, st)
+            l.debug(f'Drew waveform of {path} in {timer_decode}')
+            self.loader._signals.decoded.emit(path, image, b'', st.st_size, st.st_mtime, None)
+            return
+        if ext in self.loader.video_extensions:
+            image, strip = self._video_frames(path, st)
+            l.debug(f'Read video frames of {path} in {timer_decode}')
+            self.loader._signals.decoded.emit(path, image, b'', st.st_size, st.st_mtime, strip)
+            return
+        thumbnail = self.loader._thread_cache().get(path, st.st_size, st.st_mtime)
+        if thumbnail is not None and self.loader.size <= THUMBNAIL_SIZE:
+            image = QImage.fromData(thumbnail, 'JPG')
+            new_thumbnail = b''
+            count('preview.thumbnail_hits')
+        else:
+            image = decode_preview(path, max(self.loader.size, THUMBNAIL_SIZE))
+            new_thumbnail = encode_thumbnail(image) if not image.isNull() else b''
+        l.debug(f'Decoded preview of {path} in {timer_decode}')
+        self.loader._signals.decoded.emit(path, image, new_thumbnail, st.st_size, st.st_mtime, None)
+
+    def _waveform(self, path, st):
+        cache = self.loader._thread_waveforms()
+        peaks = cache.get(path, st.st_size, st.st_mtime)
+        if peaks is None:
+            count('preview.waveform_misses')
+            try:
+                peaks = waveform.compute(path)
+            except (OSError, ValueError):
+                l.warning(f'Could not read {path}', exc_info=True)
+                return QImage()
+            cache.put(path, st.st_size, st.st_mtime, peaks)
+        else:
+            count('preview.waveform_hits')
+        if not peaks:
+            return QImage()
+        return draw_waveform(peaks, self.loader.size, self.loader.size // 4)
+
+    def _video_frames(self, path, st):
+        cache = self.loader._thread_video_frames()
+        frames = cache.get(path, st.st_size, st.st_mtime)
+        if frames is None and videoframes.ffmpeg() is not None:
+            count('preview.video_frames_misses')
+            try:
+                frames = videoframes.extract(path)
+            except (OSError, subprocess.SubprocessError):
+                l.warning(f'Could not read {path}', exc_info=True)
+                return QImage(), None
+            cache.put(path, st.st_size, st.st_mtime, frames)
+        elif frames is not None:
+            count('preview.video_frames_hits')
+        if not frames:
+            return QImage(), None
+        return QImage.fromData(frames.poster, 'JPG'), (QImage.fromData(frames.strip, 'JPG'), frames.frames)
+
+
+class PreviewLoader(QObject):
+    """
+    Decodes previews on a thread pool and keeps the most recent ones.
+
+    ready(path, image) is emitted on the GUI thread for every decoded preview,
+    failed decodes give a null QImage. The scrub strip of a clip is kept with its
+    poster, see strip. roots are the watched folders, previews are read as part
+    of theirs.
+    """
+    ready = Signal(str, QImage)
+
+    def __init__(self, cache_path=THUMBNAIL_PATH, size=PREVIEW_SIZE, entries=DEFAULT_CACHE_ENTRIES,
+                 threads=DEFAULT_THREADS, waveform_path=waveform.WAVEFORM_PATH,
+                 video_frames_path=videoframes.VIDEOFRAMES_PATH, parent=None):
+        QObject.__init__(self, parent)
+        self.cache_path = cache_path
+        self.waveform_path = waveform_path
+        self.sound_extensions = set(waveform.extensions())
+        self.video_frames_path = video_frames_path
+        self.video_extensions = set(videoframes.EXTENSIONS)
+        self.size = size
+        self.entries = entries
+        self.roots = []
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(threads)
+        self._images = OrderedDict()
+        self._strips = {}
+        # path: _DecodeJob queued or decoding, and its priority
+        self._running = {}
+        self._local = threading.local()
+        self._thumbnails = ThumbnailCache(cache_path)
+        self._signals = _Signals()
+        self._signals.decoded.connect(self._decoded)
+
+    def _thread_cache(self):
+        """Every worker thread reads the thumbnail cache through its own connection"""
+        cache = getattr(self._local, 'cache', None)
+        if cache is None:
+            cache = self._local.cache = ThumbnailCache(self.cache_path)
+        return cache
+
+    def _thread_waveforms(self):
+        cache = getattr(self._local, 'waveforms', None)
+        if cache is None:
+            cache = self._local.waveforms = waveform.WaveformCache(self.waveform_path)
+        return cache
+
+    def _thread_video_frames(self):
+        cache = getattr(self._local, 'video_frames', None)
+        if cache is None:
+            cache = self._local.video_frames = videoframes.VideoFrameCache(self.video_frames_path)
+        return cache
+
+    def root_of(self, path):
+        """The watched folder path is in, the innermost one when they are nested, None outside of them"""
+        found = None
+        for root in self.roots:
+            inside = path.startswith(os.path.join(root, '')) or path == root
+            if inside and (found is None or len(root) > len(found)):
+                found = root
+        return found
+
+    def strip(self, path):
+        """(strip QImage, frames) of a clip whose preview is in memory, otherwise None"""
+        return self._strips.get(path)
+
+    def cached(self, path):
+        """The preview of path when it's in memory, otherwise None"""
+        image = self._images.get(path)
+        if image is not None:
+            self._images.move_to_end(path)
+        count('preview.memory_hits' if image is not None else 'preview.memory_misses')
+        return image
+
+    def request(self, path, priority=PRIORITY_SELECTED):
+        """Starts decoding path unless it's already in memory or being decoded"""
+        if path in self._images:
+            return
+        if path in self._running:
+            job, queued_priority = self._running[path]
+            # A prefetch that hasn't started yet goes before the other prefetches
+            if priority > queued_priority and self.pool.tryTake(job):
+                self._running[path] = job, priority
+                self.pool.start(job, priority)
+                count('preview.reprioritized')
+            return
+        job = _DecodeJob(self, path)
+        job.setAutoDelete(False)
+        self._running[path] = job, priority
+        self.pool.start(job, priority)
+
+    def prefetch(self, paths):
+        for path in paths:
+            self.request(path, PRIORITY_PREFETCH)
+
+    def _decoded(self, path, image, thumbnail, size, mtime, strip):
+        self._running.pop(path, None)
+        if thumbnail:
+            self._thumbnails.put(path, size, mtime, thumbnail)
+        if not image.isNull():
+            self._images[path] = image
+            self._images.move_to_end(path)
+            if strip is not None:
+                self._strips[path] = strip
+            while len(self._images) > self.entries:
+                self._strips.pop(self._images.popitem(last=False)[0], None)
+        self.ready.emit(path, image)
+
+    def shutdown(self):
+        self.pool.clear()
+        self.pool.waitForDone()
@@ -0,0 +1,339 @@
+"""
+Background scan pipeline.
+
+Every watched folder is walked by its own ScanJob thread (the producer) that hands
+batches of changes to a single ScanWriter thread, which owns the only writing
+connection to the database. The GUI keeps browsing on its own connection and
+gets progress through signals. ScanManager runs a few roots at the same time
+and queues the rest. Directories reported by the file system watcher are
+rescanned on their own by an UpdateJob through the same writer.
+"""
+import queue
+import threading
+import time
+
+from PySide2.QtCore import QObject, QThread, Signal
+
+from frankenstein import scanner
+from frankenstein import schema
+from frankenstein.blom import get_logger, span
+from frankenstein.walker import DEFAULT_WORKERS
+
+l = get_logger('frankenstein.scanthread')
+
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_PARALLEL_ROOTS = 4
+
+# Seconds between two progress signals of the same job
+PROGRESS_INTERVAL = 0.25
+
+
+class _RootDone:
+    def __init__(self, root, cancelled):
+        self.root = root
+        self.cancelled = cancelled
+
+
+class ScanWriter(QThread):
+    """
+    Applies batches from scanner.scan_changes, one transaction per batch.
+
+    After a batch of a root failed the rest of its batches are dropped until
+    its job is done, the job is cancelled through writeFailed.
+    """
+    # root, ScanStats of everything written for it, cancelled
+    rootWritten = Signal(str, object, bool)
+    # root, error
+    writeFailed = Signal(str, str)
+
+    def __init__(self, db_path, parent=None):
+        QThread.__init__(self, parent)
+        self.db_path = db_path
+        self.queue = queue.Queue(maxsize=64)
+        self._stats = {}
+        # Roots a batch failed for, until their _RootDone
+        self._failed = set()
+
+    def put(self, item):
+        """Blocks when the writer is behind so producers can't run away"""
+        self.queue.put(item)
+
+    def stop(self):
+        self.queue.put(None)
+
+    def run(self):
+        db = schema.connect(self.db_path)
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if isinstance(item, _RootDone):
+                stats = self._stats.pop(item.root, scanner.ScanStats(0, 0, 0, 0, 0))
+                failed = item.root in self._failed
+                self._failed.discard(item.root)
+                self.rootWritten.emit(item.root, stats, item.cancelled or failed)
+                continue
+            if item.root in self._failed:
+                l.debug(f'Dropping batch for {item.root} after a failed one')
+                continue
+            try:
+                written = scanner.apply_batch(db, item)
+            except Exception as e:
+                l.exception(f'Writing batch for {item.root} failed')
+                self._failed.add(item.root)
+                self.writeFailed.emit(item.root, str(e))
+                continue
+            stats = self._stats.get(item.root, scanner.ScanStats(0, 0, 0, 0, 0))
+            self._stats[item.root] = scanner.add_stats(stats, written)
+        db.conn.close()
+
+
+class ScanJob(QThread):
+    """Walks one watched folder and feeds the writer"""
+    # root, files found, bytes seen, files per second
+    progress = Signal(str, int, int, float)
+
+    def __init__(self, db_path, root, writer, incremental=True, workers=DEFAULT_WORKERS,
+                 batch_size=DEFAULT_BATCH_SIZE, parent=None):
+        QThread.__init__(self, parent)
+        self.db_path = db_path
+        self.root = root
+        self.writer = writer
+        self.incremental = incremental
+        self.workers = workers
+        self.batch_size = batch_size
+        self._cancel = threading.Event()
+        self._started = 0
+        self._last_emit = 0
+
+    def cancel(self):
+        self._cancel.set()
+
+    def _progress(self, files_found, bytes_seen, force=False):
+        now = time.perf_counter()
+        if force or now - self._last_emit >= PROGRESS_INTERVAL:
+            self._last_emit = now
+            rate = files_found / max(now - self._started, 1e-6)
+            self.progress.emit(self.root, files_found, bytes_seen, rate)
+
+    def run(self):
+        self._started = time.perf_counter()
+        db = schema.connect(self.db_path)
+        found = [0, 0]
+
+        def progress(files_found, bytes_seen):
+            found[:] = files_found, bytes_seen
+            self._progress(files_found, bytes_seen)
+
+        try:
+            with span('scan', root=self.root, incremental=self.incremental):
+                for batch in scanner.scan_changes(db, self.root, self.incremental, self.workers,
+                                                  self.batch_size, progress, self._cancel):
+                    # Long waits here mean the database writes are what's slow
+                    with span('scan.writer_wait'):
+                        self.writer.put(batch)
+        except Exception:
+            l.exception(f'Scanning {self.root} failed')
+        finally:
+            db.conn.close()
+            self._progress(*found, force=True)
+            self.writer.put(_RootDone(self.root, self._cancel.is_set()))
+
+
+class UpdateJob(QThread):
+    """Rescans a few directories of one watched folder, see scanner.scan_directories"""
+
+    def __init__(self, db_path, root, dirs, writer, workers=DEFAULT_WORKERS, parent=None):
+        QThread.__init__(self, parent)
+        self.db_path = db_path
+        self.root = root
+        self.dirs = dirs
+        self.writer = writer
+        self.workers = workers
+
+    def cancel(self):
+        pass
+
+    def run(self):
+        db = schema.connect(self.db_path)
+        try:
+            self.writer.put(scanner.scan_directories(db, self.root, self.dirs, self.workers))
+        except Exception:
+            l.exception(f'Updating {self.root} failed')
+        finally:
+            db.conn.close()
+            self.writer.put(_RootDone(self.root, False))
+
+
+class ScanManager(QObject):
+    """
+    Runs scans of watched folders in the background.
+
+    At most parallel roots are walked at the same time, the rest wait in line.
+    finished is emitted for scans and updated for directory updates, failed
+    instead of either when writing the changes of a root failed.
+    """
+    progress = Signal(str, int, int, float)
+    # root, ScanStats, cancelled
+    finished = Signal(str, object, bool)
+    # root, ScanStats
+    updated = Signal(str, object)
+    # root, error
+    failed = Signal(str, str)
+    idle = Signal()
+
+    def __init__(self, db_path, parallel=DEFAULT_PARALLEL_ROOTS, parent=None):
+        QObject.__init__(self, parent)
+        self.db_path = db_path
+        self.parallel = parallel
+        self.incremental = True
+        self.workers = DEFAULT_WORKERS
+        self.batch_size = DEFAULT_BATCH_SIZE
+        self._waiting = []
+        self._jobs = {}
+        self._writing = set()
+        self._writer = None
+        # Roots queued for a full scan, the others in _waiting only have directory updates
+        self._full = set()
+        # root -> directories waiting for an update
+        self._dirs = {}
+        self._updating = set()
+        # root -> error of the batch that couldn't be written
+        self._errors = {}
+        # Roots a scan wrote only part of, their mtimes can't be trusted by the next one
+        self._partial = set()
+
+    def _ensure_writer(self):
+        if self._writer is None:
+            self._writer = ScanWriter(self.db_path)
+            self._writer.rootWritten.connect(self._root_written)
+            self._writer.writeFailed.connect(self._write_failed)
+            self._writer.start()
+
+    def scan(self, roots):
+        """Queues roots for scanning, roots already queued or running are ignored"""
+        self._ensure_writer()
+        for root in roots:
+            running = root in self._jobs or root in self._writing
+            if root in self._full or (running and root not in self._updating):
+                l.info(f'{root} is already being scanned')
+                continue
+            self._full.add(root)
+            self._queue(root)
+        self._start_next()
+
+    def update(self, root, dirs):
+        """Queues a rescan of only these directories of root, done after any scan of root that's running"""
+        self._ensure_writer()
+        self._dirs.setdefault(root, set()).update(dirs)
+        self._queue(root)
+        self._start_next()
+
+    def _queue(self, root):
+        """Puts root in line when it has work waiting and isn't queued or running already"""
+        if root in self._waiting or root in self._jobs or root in self._writing:
+            return
+        if root in self._full or root in self._dirs:
+            self._waiting.append(root)
+
+    def _start_next(self):
+        while self._waiting and len(self._jobs) < self.parallel:
+            root = self._waiting.pop(0)
+            if root in self._full:
+                self._full.discard(root)
+                incremental = self.incremental and root not in self._partial
+                self._partial.discard(root)
+                job = ScanJob(self.db_path, root, self._writer, incremental, self.workers, self.batch_size)
+                job.progress.connect(self.progress)
+            else:
+                job = UpdateJob(self.db_path, root, sorted(self._dirs.pop(root, ())), self._writer, self.workers)
+                self._updating.add(root)
+            job.finished.connect(lambda root=root: self._job_finished(root))
+            self._jobs[root] = job
+            self._writing.add(root)
+            l.info(f'Starting background scan of {root}')
+            job.start()
+
+    def _job_finished(self, root):
+        job = self._jobs.pop(root, None)
+        if job is not None:
+            job.deleteLater()
+        self._queue(root)
+        self._start_next()
+
+    def _write_failed(self, root, error):
+        # The rest of its changes are dropped anyway
+        job = self._jobs.get(root)
+        if job is not None:
+            job.cancel()
+        self._errors.setdefault(root, error)
+
+    def _root_written(self, root, stats, cancelled):
+        self._writing.discard(root)
+        error = self._errors.pop(root, None)
+        if error is not None:
+            if root not in self._updating:
+                self._partial.add(root)
+            self._updating.discard(root)
+            l.error(f'Writing {root} failed after {stats}: {error}')
+            self.failed.emit(root, error)
+        elif root in self._updating:
+            self._updating.discard(root)
+            l.info(f'Update of {root} done: {stats}')
+            self.updated.emit(root, stats)
+        else:
+            l.info(f'Background scan of {root} done: {stats}{" (cancelled)" if cancelled else ""}')
+            self.finished.emit(root, stats, cancelled)
+        # Changes that came in while the root was busy
+        self._queue(root)
+        self._start_next()
+        if not self.is_scanning():
+            self.idle.emit()
+
+    def focus(self, root):
+        """Moves root to the front of the line, it's the watched folder the user is looking at"""
+        if root in self._waiting:
+            self._waiting.remove(root)
+            self._waiting.insert(0, root)
+
+    def is_scanning(self, root=None):
+        if root is None:
+            return bool(self._waiting or self._jobs or self._writing)
+        return root in self._waiting or root in self._jobs or root in self._writing
+
+    def pending(self):
+        """Number of roots waiting or being scanned"""
+        return len(self._waiting) + len(self._writing)
+
+    def cancel(self, root=None):
+        """Cancels the scan of root, or every scan when root is None"""
+        if root is None:
+            waiting, self._waiting = self._waiting, []
+            jobs = list(self._jobs.values())
+            full, self._full = self._full, set()
+            self._dirs = {}
+        else:
+            waiting = [root] if root in self._waiting else []
+            self._waiting = [x for x in self._waiting if x != root]
+            jobs = [self._jobs[root]] if root in self._jobs else []
+            full = {root} & self._full
+            self._full.discard(root)
+            self._dirs.pop(root, None)
+        # Only queued full scans report back, pending directory updates are dropped
+        waiting = [x for x in waiting if x in full]
+        for job in jobs:
+            job.cancel()
+        for queued in waiting:
+            self.finished.emit(queued, scanner.ScanStats(0, 0, 0, 0, 0), True)
+        if not self.is_scanning():
+            self.idle.emit()
+
+    def shutdown(self):
+        """Cancels everything and waits for the threads, call before quitting"""
+        self.cancel()
+        for job in list(self._jobs.values()):
+            job.wait()
+        if self._writer is not None:
+            self._writer.stop()
+            self._writer.wait()
+            self._writer = None
@@ -0,0 +1,95 @@
+"""
+Steps that read file contents after a scan, run in the background.
+
+A stage is a name and an update(db, root, cancel=, progress=) function like
+imagemeta.update, which only handles files that are new or changed since it
+last ran. After a watched folder is scanned every stage runs for it in turn,
+one job at a time so they don't compete for the NAS.
+
+    stages = StageManager(DATABASE_PATH, [('Image headers', imagemeta.update)])
+    stages.run(root)
+"""
+import threading
+
+from PySide2.QtCore import QObject, QThread, Signal
+
+from frankenstein import schema
+from frankenstein.blom import get_logger, timer
+
+l = get_logger('frankenstein.stagethread')
+
+
+class StageJob(QThread):
+    """Runs one stage for one watched folder"""
+    # stage, root, files done, files to do
+    progress = Signal(str, str, int, int)
+
+    def __init__(self, db_path, name, update, root, parent=None):
+        QThread.__init__(self, parent)
+        self.db_path = db_path
+        self.name = name
+        self.update = update
+        self.root = root
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def run(self):
+        timer_stage = timer()
+        db = schema.connect(self.db_path)
+        try:
+            done = self.update(db, self.root, cancel=self._cancel,
+                               progress=lambda done, total: self.progress.emit(self.name, self.root, done, total))
+            l.info(f'{self.name} of {self.root}: {done} files in {timer_stage}')
+        except Exception:
+            l.exception(f'{self.name} of {self.root} failed')
+        finally:
+            db.conn.close()
+
+
+class StageManager(QObject):
+    """Runs every stage for the watched folders it's given, one job at a time"""
+    progress = Signal(str, str, int, int)
+    # stage, root
+    finished = Signal(str, str)
+
+    def __init__(self, db_path, stages, parent=None):
+        QObject.__init__(self, parent)
+        self.db_path = db_path
+        self.stages = list(stages)
+        self._waiting = []
+        self._job = None
+
+    def run(self, root):
+        """Queues every stage for root, stages already waiting for it aren't queued twice"""
+        for name, update in self.stages:
+            if (name, root) not in [(x[0], x[2]) for x in self._waiting]:
+                self._waiting.append((name, update, root))
+        self._start_next()
+
+    def focus(self, root):
+        """Runs the stages waiting for root first, in their order"""
+        self._waiting.sort(key=lambda x: x[2] != root)
+
+    def _start_next(self):
+        if self._job is not None or not self._waiting:
+            return
+        name, update, root = self._waiting.pop(0)
+        self._job = StageJob(self.db_path, name, update, root)
+        self._job.progress.connect(self.progress)
+        self._job.finished.connect(self._job_finished)
+        self._job.start()
+
+    def _job_finished(self):
+        name, root = self._job.name, self._job.root
+        self._job.deleteLater()
+        self._job = None
+        self.finished.emit(name, root)
+        self._start_next()
+
+    def shutdown(self):
+        self._waiting = []
+        if self._job is not None:
+            self._job.cancel()
+            self._job.wait()
@@ -0,0 +1,112 @@
+"""
+Stats panel with the span latencies and counters recorded by blom.
+
+Refreshes itself while it's open. Export trace writes a Chrome trace file
+(open it in chrome://tracing or ui.perfetto.dev) to see where a scan spent
+its time, Export JSON the counters, histograms and span tree.
+"""
+from PySide2.QtCore import QTimer, Qt
+from PySide2.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QTableWidget, QTableWidgetItem, QPushButton, \
+    QCheckBox, QFileDialog, QHeaderView, QLabel, QAbstractItemView
+
+from frankenstein import blom
+
+l = blom.get_logger('frankenstein.statspanel')
+
+# Milliseconds between refreshes while the panel is shown
+REFRESH_INTERVAL = 1000
+
+_HISTOGRAM_COLUMNS = [('count', 'Count'), ('total_ms', 'Total ms'), ('mean_ms', 'Mean ms'), ('p50_ms', 'p50 ms'),
+                      ('p95_ms', 'p95 ms'), ('p99_ms', 'p99 ms'), ('max_ms', 'Max ms')]
+
+
+def _item(value):
+    item = QTableWidgetItem()
+    # Numbers as data so the columns sort by value
+    item.setData(Qt.DisplayRole, value)
+    return item
+
+
+class StatsPanel(QDialog):
+    def __init__(self, parent=None):
+        QDialog.__init__(self, parent)
+        self.setWindowTitle('Stats')
+        self.resize(760, 520)
+
+        self.record = QCheckBox('Record')
+        self.record.setChecked(blom.enabled())
+        self.record.toggled.connect(blom.enable)
+        self.refresh_button = QPushButton('Refresh')
+        self.refresh_button.clicked.connect(self.refresh)
+        self.reset_button = QPushButton('Reset')
+        self.reset_button.clicked.connect(self.reset)
+        self.trace_button = QPushButton('Export trace...')
+        self.trace_button.clicked.connect(self.export_trace)
+        self.json_button = QPushButton('Export JSON...')
+        self.json_button.clicked.connect(self.export_json)
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.record)
+        buttons.addStretch()
+        for button in (self.refresh_button, self.reset_button, self.trace_button, self.json_button):
+            buttons.addWidget(button)
+
+        self.histograms = QTableWidget(0, len(_HISTOGRAM_COLUMNS) + 1)
+        self.histograms.setHorizontalHeaderLabels(['Span'] + [title for key, title in _HISTOGRAM_COLUMNS])
+        self.histograms.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.histograms.verticalHeader().hide()
+        self.histograms.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.counters = QTableWidget(0, 2)
+        self.counters.setHorizontalHeaderLabels(['Counter', 'Value'])
+        self.counters.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.counters.verticalHeader().hide()
+        self.counters.setEditTriggers(QAbstractItemView.NoEditTriggers)
+
+        layout = QVBoxLayout(self)
+        layout.addLayout(buttons)
+        layout.addWidget(QLabel('Latencies'))
+        layout.addWidget(self.histograms, 3)
+        layout.addWidget(QLabel('Counters'))
+        layout.addWidget(self.counters, 1)
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(REFRESH_INTERVAL)
+        self.timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.timer.start()
+        QDialog.showEvent(self, event)
+
+    def hideEvent(self, event):
+        self.timer.stop()
+        QDialog.hideEvent(self, event)
+
+    def _fill(self, table, rows):
+        table.setSortingEnabled(False)
+        table.setRowCount(len(rows))
+        for row, values in enumerate(rows):
+            for column, value in enumerate(values):
+                table.setItem(row, column, _item(value))
+        table.setSortingEnabled(True)
+
+    def refresh(self):
+        self._fill(self.histograms, [[name] + [summary[key] for key, title in _HISTOGRAM_COLUMNS]
+                                     for name, summary in blom.histograms().items()])
+        self._fill(self.counters, sorted(blom.counters().items()))
+
+    def reset(self):
+        blom.reset()
+        self.refresh()
+
+    def export_trace(self):
+        path, _ = QFileDialog.getSaveFileName(self, 'Export trace', 'trace.json', 'Trace (*.json)')
+        if path:
+            blom.export_chrome_trace(path)
+            l.info(f'Wrote trace to {path}')
+
+    def export_json(self):
+        path, _ = QFileDialog.getSaveFileName(self, 'Export stats', 'stats.json', 'JSON (*.json)')
+        if path:
+            blom.export_json(path)
+            l.info(f'Wrote stats to {path}')
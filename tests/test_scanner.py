@@ -0,0 +1,147 @@
+import os
+import shutil
+
+import pytest
+
+from frankenstein import scanner, schema, search, tree
+
+
+def _write(path, size=1):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+
+
+@pytest.fixture
+def library(tmp_path):
+    top = str(tmp_path / 'library')
+    for path, size in (('brick_wall.png', 10), ('notes.txt', 3),
+                       ('textures/oak_floor.exr', 100), ('textures/rust.tif', 50),
+                       ('textures/stone/moss.jpg', 20), ('textures/stone/moss_normal.jpg', 21),
+                       ('sound/rain.wav', 40), ('sound/loops/drums.wav', 70)):
+        _write(os.path.join(top, path), size)
+    return top
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = schema.connect(str(tmp_path / 'index.db'))
+    yield db
+    db.conn.close()
+
+
+def _on_disk(top):
+    """{path below top: size} of every file"""
+    return {os.path.relpath(os.path.join(folder, name), top): os.path.getsize(os.path.join(folder, name))
+            for folder, dirs, names in os.walk(top) for name in names}
+
+
+def _indexed(db, top):
+    return {os.path.relpath(os.path.join(folder, name), top): size for folder, name, size in db.execute(
+        f'SELECT d.path, f.name, f.size FROM {schema.FILES} f JOIN {schema.DIRECTORIES} d ON d.id = f.dir_id')}
+
+
+def _totals(db):
+    dirs = db.execute(f'SELECT path, files, bytes FROM {schema.DIRECTORIES} ORDER BY path').fetchall()
+    exts = db.execute(f'SELECT d.path, e.ext, e.files, e.bytes FROM {schema.DIRECTORY_EXTS} e '
+                      f'JOIN {schema.DIRECTORIES} d ON d.id = e.dir_id ORDER BY d.path, e.ext').fetchall()
+    return dirs, exts
+
+
+def _check(db, top):
+    """The index matches the disk, search has every file and the totals are the ones counted from scratch"""
+    assert _indexed(db, top) == _on_disk(top)
+    assert sorted(db.execute(f'SELECT rowid, name FROM {schema.FILES_FTS}').fetchall()) == \
+           sorted(db.execute(f'SELECT id, name FROM {schema.FILES}').fetchall())
+    top_folder = tree.top(db, top)
+    assert (top_folder.files, top_folder.bytes) == (len(_on_disk(top)), sum(_on_disk(top).values()))
+    rolled_up = _totals(db)
+    tree.rebuild(db)
+    assert _totals(db) == rolled_up
+
+
+def test_full_scan(db, library):
+    stats = scanner.scan_root(db, library, incremental=False)
+    assert (stats.inserted, stats.updated, stats.deleted, stats.dirs_listed) == (8, 0, 0, 5)
+    _check(db, library)
+    assert [x.path for x in search.search(db, 'moss')] == [os.path.join(library, 'textures/stone/moss.jpg'),
+                                                           os.path.join(library, 'textures/stone/moss_normal.jpg')]
+
+
+def test_rescan_writes_only_the_difference(db, library):
+    scanner.scan_root(db, library)
+    _write(os.path.join(library, 'textures/wood.png'), 5)
+    _write(os.path.join(library, 'models/chair.obj'), 300)
+    os.remove(os.path.join(library, 'notes.txt'))
+    # Replaced, which changes the mtime of its directory like most tools that save do
+    os.remove(os.path.join(library, 'textures/rust.tif'))
+    _write(os.path.join(library, 'textures/rust.tif'), 55)
+    shutil.rmtree(os.path.join(library, 'sound'))
+
+    stats = scanner.scan_root(db, library)
+    assert (stats.inserted, stats.updated, stats.deleted) == (2, 1, 3)
+    _check(db, library)
+    assert not db.execute(f'SELECT path FROM {schema.DIRECTORIES} WHERE path LIKE ?', ['%sound%']).fetchall()
+    assert not search.search(db, 'drums')
+    assert search.search(db, 'chair')
+
+
+def test_unchanged_directories_are_skipped(db, library):
+    scanner.scan_root(db, library)
+    assert scanner.scan_root(db, library) == scanner.ScanStats(0, 0, 0, 0, 5)
+
+    # Editing in place leaves the mtime of the directory alone, only a full scan sees it
+    path = os.path.join(library, 'textures/stone/moss.jpg')
+    folder_mtime = os.stat(os.path.dirname(path)).st_mtime_ns
+    _write(path, 25)
+    os.utime(os.path.dirname(path), ns=(folder_mtime, folder_mtime))
+    assert scanner.scan_root(db, library).updated == 0
+    assert scanner.scan_root(db, library, incremental=False).updated == 1
+    _check(db, library)
+
+
+def _unlistable(monkeypatch, path):
+    scandir = os.scandir
+
+    def failing(folder='.'):
+        if os.path.normpath(folder) == os.path.normpath(path):
+            raise PermissionError(13, 'Permission denied', folder)
+        return scandir(folder)
+
+    monkeypatch.setattr(os, 'scandir', failing)
+
+
+def test_unlistable_directory_keeps_what_is_indexed(db, library, monkeypatch):
+    scanner.scan_root(db, library)
+    before = _indexed(db, library)
+    textures = os.path.join(library, 'textures')
+    _write(os.path.join(textures, 'new.png'))
+    _unlistable(monkeypatch, textures)
+
+    stats = scanner.scan_root(db, library)
+    assert stats.deleted == 0
+    assert _indexed(db, library) == before
+
+
+def test_update_of_directories(db, library):
+    scanner.scan_root(db, library)
+    stone = os.path.join(library, 'textures/stone')
+    _write(os.path.join(stone, 'lichen.jpg'), 9)
+    shutil.rmtree(os.path.join(library, 'sound/loops'))
+
+    batch = scanner.scan_directories(db, library, [stone, os.path.join(library, 'sound')])
+    stats = scanner.apply_batch(db, batch)
+    assert (stats.inserted, stats.deleted) == (1, 1)
+    _check(db, library)
+
+
+def test_update_of_unlistable_start_keeps_its_subtree(db, library, monkeypatch):
+    scanner.scan_root(db, library)
+    before = _indexed(db, library)
+    textures = os.path.join(library, 'textures')
+    _unlistable(monkeypatch, textures)
+
+    batch = scanner.scan_directories(db, library, [textures])
+    assert batch.gone_dirs == []
+    assert scanner.apply_batch(db, batch).deleted == 0
+    assert _indexed(db, library) == before
@@ -0,0 +1,83 @@
+import os
+import shutil
+
+import pytest
+
+from frankenstein import scanner, schema, search, snapshot
+
+
+def _write(path, size=1):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+
+
+@pytest.fixture
+def library(tmp_path):
+    top = str(tmp_path / 'library')
+    for path, size in (('brick_wall.png', 10), ('notes.txt', 3),
+                       ('textures/oak_floor.exr', 100), ('textures/rust.tif', 50),
+                       ('textures/stone/moss.jpg', 20), ('textures/stone/moss_normal.jpg', 21),
+                       ('sound/rain.wav', 40), ('sound/loops/drums.wav', 70)):
+        _write(os.path.join(top, path), size)
+    return top
+
+
+def _scanned(path, top):
+    db = schema.connect(path)
+    scanner.scan_root(db, top, incremental=False)
+    return db
+
+
+def _contents(db):
+    """Every directory with its totals, every file and the folder totals by extension"""
+    dirs = db.execute(f'SELECT path, mtime, files, bytes FROM {schema.DIRECTORIES} ORDER BY path').fetchall()
+    files = db.execute(f'SELECT d.path, f.name, f.ext, f.size, f.mtime FROM {schema.FILES} f '
+                       f'JOIN {schema.DIRECTORIES} d ON d.id = f.dir_id ORDER BY d.path, f.name').fetchall()
+    exts = db.execute(f'SELECT d.path, e.ext, e.files, e.bytes FROM {schema.DIRECTORY_EXTS} e '
+                      f'JOIN {schema.DIRECTORIES} d ON d.id = e.dir_id ORDER BY d.path, e.ext').fetchall()
+    return dirs, files, exts
+
+
+def test_full_and_delta_import_match_a_scan(tmp_path, library):
+    server = _scanned(str(tmp_path / 'server.db'), library)
+    full = str(tmp_path / 'full.snap')
+    snapshot.export(server, full)
+
+    _write(os.path.join(library, 'textures/wood.png'), 5)
+    _write(os.path.join(library, 'models/chair.obj'), 300)
+    _write(os.path.join(library, 'textures/stone/moss.jpg'), 25)
+    os.remove(os.path.join(library, 'notes.txt'))
+    shutil.rmtree(os.path.join(library, 'sound'))
+    scanner.scan_root(server, library, incremental=False)
+    today, delta = str(tmp_path / 'today.snap'), str(tmp_path / 'today.delta')
+    snapshot.export(server, today)
+    with snapshot.Snapshot(full) as base, snapshot.Snapshot(today) as new:
+        # The files of sound/ aren't in it, the importer drops the directories the delta doesn't have
+        assert snapshot.export_delta(base, new, delta) == 4
+
+    workstation = schema.connect(str(tmp_path / 'workstation.db'))
+    snapshot.apply(workstation, full)
+    stats = snapshot.apply(workstation, delta)
+    assert (stats.inserted, stats.updated, stats.deleted) == (2, 1, 3)
+
+    direct = _scanned(str(tmp_path / 'direct.db'), library)
+    assert _contents(workstation) == _contents(direct)
+    assert sorted(workstation.execute(f'SELECT rowid, name FROM {schema.FILES_FTS}').fetchall()) == \
+           sorted(workstation.execute(f'SELECT id, name FROM {schema.FILES}').fetchall())
+    assert not search.search(workstation, 'drums')
+    assert search.search(workstation, 'chair')
+
+
+def test_delta_needs_its_base(tmp_path, library):
+    server = _scanned(str(tmp_path / 'server.db'), library)
+    full, today, delta = (str(tmp_path / x) for x in ('full.snap', 'today.snap', 'today.delta'))
+    snapshot.export(server, full)
+    _write(os.path.join(library, 'textures/wood.png'), 5)
+    scanner.scan_root(server, library)
+    snapshot.export(server, today)
+    with snapshot.Snapshot(full) as base, snapshot.Snapshot(today) as new:
+        snapshot.export_delta(base, new, delta)
+
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.apply(schema.connect(str(tmp_path / 'workstation.db')), delta)
@@ -0,0 +1,365 @@
+"""
+Persistent thumbnail cache.
+
+Thumbnails are small JPEGs stored as blobs in their own SQLite file
+(thumbnails.db) so the index stays small. Entries are keyed on path and only
+valid for the size and mtime they were made from. The cache has a size cap and
+evicts the least recently used thumbnails when it grows past it.
+
+Thumbnails are made by a pool of worker processes after a watched folder has
+been scanned (ThumbnailManager), decoding every image at reduced size with
+QImageReader. The image viewer reads them back in milliseconds. The perceptual
+hash of every image (see frankenstein/similar.py) is made from the same decoded
+pixels and stored in the index, images that had a thumbnail before there were
+hashes are hashed from the cached thumbnail.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import sqlite_utils as sql
+from PySide2.QtCore import QObject, QThread, Signal, QBuffer, QByteArray, QIODevice, Qt
+from PySide2.QtGui import QImage, QImageReader
+
+from frankenstein import iosched
+from frankenstein import query
+from frankenstein import schema
+from frankenstein import similar
+from frankenstein.blom import get_logger, timer
+
+l = get_logger('frankenstein.thumbnails')
+
+THUMBNAIL_PATH = 'thumbnails.db'
+THUMBNAIL_TABLE = 'thumbnails'
+
+# Longest side in pixels and JPEG quality
+THUMBNAIL_SIZE = 512
+THUMBNAIL_QUALITY = 85
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+DEFAULT_PROCESSES = max(1, (os.cpu_count() or 2) - 1)
+
+# Formats QImageReader can decode out of the box
+THUMBNAIL_EXTENSIONS = {'png', 'jpg', 'jpeg', 'bmp', 'gif', 'tif', 'tiff', 'tga', 'webp', 'ppm', 'pgm'}
+
+# Thumbnails written per transaction while generating
+WRITE_BATCH = 200
+
+
+def encode_thumbnail(image: QImage, size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY) -> bytes:
+    """Scales a decoded image down to a thumbnail and returns it as JPEG bytes"""
+    if image.width() > size or image.height() > size:
+        image = image.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.WriteOnly)
+    image.save(buffer, 'JPG', quality)
+    buffer.close()
+    return data.data()
+
+
+def image_hash(image: QImage) -> int:
+    """Perceptual hash of a decoded image"""
+    small = image.scaled(similar.HASH_SIZE, similar.HASH_SIZE, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+    small = small.convertToFormat(QImage.Format_Grayscale8)
+    # Rows are padded to 4 bytes, 32 pixels need none
+    pixels = np.frombuffer(small.constBits(), np.uint8, count=small.bytesPerLine() * similar.HASH_SIZE)
+    return similar.phash(pixels.reshape(similar.HASH_SIZE, -1)[:, :similar.HASH_SIZE])
+
+
+def _read(path, size):
+    """Decodes path no bigger than size x size, a null image when it can't be read"""
+    reader = QImageReader(path)
+    full = reader.size()
+    if full.isValid() and (full.width() > size or full.height() > size):
+        reader.setScaledSize(full.scaled(size, size, Qt.KeepAspectRatio))
+    return reader.read()
+
+
+def render_thumbnail(path, size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY):
+    """
+    Decodes path at reduced size and returns JPEG bytes, b'' when it can't be read.
+
+    Runs in the worker processes. Formats that support it (like JPEG) are
+    downscaled while decoding instead of decoding every pixel first.
+    """
+    image = _read(path, size)
+    if image.isNull():
+        return b''
+    return encode_thumbnail(image, size, quality)
+
+
+def _render(item):
+    """
+    Thumbnail JPEG and hash of a (path, size, mtime, file id, thumbnail) item.
+
+    An item with the JPEG of its thumbnail is only hashed and comes back
+    without data, b'' is an image that can't be read.
+    """
+    path, size, mtime, file_id, thumbnail = item
+    try:
+        if thumbnail is not None:
+            image = QImage.fromData(thumbnail, 'JPG')
+            return item, None, None if image.isNull() else image_hash(image)
+        image = _read(path, THUMBNAIL_SIZE)
+        if image.isNull():
+            return item, b'', None
+        return item, encode_thumbnail(image), image_hash(image)
+    except Exception:
+        return item, b'' if thumbnail is None else None, None
+
+
+class ThumbnailCache:
+    """
+    SQLite blob store of thumbnails with a size cap and LRU eviction.
+
+    Images that couldn't be decoded are stored with empty data so they aren't tried again.
+    """
+
+    def __init__(self, path=THUMBNAIL_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.db = sql.Database(path)
+        self.db.conn.execute('PRAGMA busy_timeout = 10000')
+        self.max_bytes = max_bytes
+        table = self.db[THUMBNAIL_TABLE]
+        if not table.exists():
+            self.db.enable_wal()
+            table.create({'path': str, 'size': int, 'mtime': float, 'bytes': int, 'accessed': float,
+                          'data': bytes}, pk='path', if_not_exists=True)
+            table.create_index(['accessed'], if_not_exists=True)
+        self.total_bytes = self.db.execute(f'SELECT total(bytes) FROM {THUMBNAIL_TABLE}').fetchone()[0]
+
+    def get(self, path, size, mtime):
+        """JPEG bytes of the thumbnail or None when there is no valid one"""
+        row = self.db.execute(f'SELECT size, mtime, data FROM {THUMBNAIL_TABLE} WHERE path = ?', [path]).fetchone()
+        if row is None or (row[0], row[1]) != (size, mtime) or not row[2]:
+            return None
+        with self.db.conn:
+            self.db.conn.execute(f'UPDATE {THUMBNAIL_TABLE} SET accessed = ? WHERE path = ?', (time.time(), path))
+        return row[2]
+
+    def peek(self, path, size, mtime):
+        """JPEG bytes like get, without counting it as used"""
+        row = self.db.execute(f'SELECT data FROM {THUMBNAIL_TABLE} WHERE path = ? AND size IS ? AND mtime IS ?',
+                              [path, size, mtime]).fetchone()
+        return row[0] if row is not None and row[0] else None
+
+    def put_many(self, rows):
+        """Stores (path, size, mtime, data) rows in one transaction"""
+        now = time.time()
+        with self.db.conn:
+            for path, size, mtime, data in rows:
+                old = self.db.conn.execute(f'SELECT bytes FROM {THUMBNAIL_TABLE} WHERE path = ?', [path]).fetchone()
+                self.db.conn.execute(f'INSERT OR REPLACE INTO {THUMBNAIL_TABLE} (path, size, mtime, bytes, accessed, '
+                                     f'data) VALUES (?, ?, ?, ?, ?, ?)', (path, size, mtime, len(data), now, data))
+                self.total_bytes += len(data) - (old[0] if old else 0)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def put(self, path, size, mtime, data):
+        self.put_many([(path, size, mtime, data)])
+
+    def missing(self, items) -> list:
+        """The (path, size, mtime) items without a thumbnail for that size and mtime"""
+        result = []
+        for item in items:
+            row = self.db.execute(f'SELECT size, mtime FROM {THUMBNAIL_TABLE} WHERE path = ?', [item[0]]).fetchone()
+            if row is None or (row[0], row[1]) != (item[1], item[2]):
+                result.append(item)
+        return result
+
+    def evict(self, target=None):
+        """Deletes the least recently used thumbnails until the cache is below target bytes"""
+        if target is None:
+            target = self.max_bytes * 0.9
+        evicted = 0
+        with self.db.conn:
+            # Other connections write to the cache as well
+            self.total_bytes = self.db.conn.execute(f'SELECT total(bytes) FROM {THUMBNAIL_TABLE}').fetchone()[0]
+            while self.total_bytes > target:
+                rows = self.db.conn.execute(f'SELECT path, bytes FROM {THUMBNAIL_TABLE} '
+                                            f'ORDER BY accessed LIMIT 1000').fetchall()
+                if not rows:
+                    self.total_bytes = 0
+                    break
+                delete = []
+                for path, size in rows:
+                    if self.total_bytes <= target:
+                        break
+                    delete.append((path,))
+                    self.total_bytes -= size
+                self.db.conn.executemany(f'DELETE FROM {THUMBNAIL_TABLE} WHERE path = ?', delete)
+                evicted += len(delete)
+        l.info(f'Evicted {evicted} thumbnails')
+
+    def close(self):
+        self.db.conn.close()
+
+
+def generate(cache, items, processes=DEFAULT_PROCESSES, cancel=None, progress=None, hashed=None, root=None) -> int:
+    """
+    Makes thumbnails for (path, size, mtime, file id, cached) items with a pool of worker processes.
+
+    Items with cached set already have a thumbnail and are only hashed from
+    it. hashed(rows) gets the (file id, size, mtime, hash) of every batch.
+    progress(done, total) is called as thumbnails are written and generation
+    stops when cancel (a threading.Event) is set. Images are read through slots
+    of the I/O scheduler as files of the watched folder root. Returns the number
+    of items done.
+    """
+    total = len(items)
+    if not total:
+        return 0
+    done = 0
+    rows = []
+    hashes = []
+    pending = set()
+    items = iter(items)
+    # Qt isn't safe to fork, start clean processes
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+        try:
+            while True:
+                while len(pending) < processes * 4:
+                    item = next(items, None)
+                    if item is None:
+                        break
+                    path, size, mtime, file_id, cached = item
+                    # Read here, the workers don't open the cache
+                    thumbnail = cache.peek(path, size, mtime) if cached else None
+                    if cached and thumbnail is None:
+                        total -= 1
+                        continue
+                    # Hashing a cached thumbnail doesn't touch the NAS
+                    request = iosched.acquire(root, iosched.BACKGROUND, size or 0, cancel) if not cached else None
+                    if request is None and not cached:
+                        break
+                    future = pool.submit(_render, (path, size, mtime, file_id, thumbnail))
+                    future.add_done_callback(lambda future, request=request: iosched.release(request))
+                    pending.add(future)
+                if not pending or (cancel is not None and cancel.is_set()):
+                    break
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    (path, size, mtime, file_id, thumbnail), data, value = future.result()
+                    if data is not None:
+                        rows.append((path, size, mtime, data))
+                    if value is not None:
+                        hashes.append((file_id, size, mtime, value))
+                    done += 1
+                if len(rows) >= WRITE_BATCH or len(hashes) >= WRITE_BATCH:
+                    cache.put_many(rows)
+                    if hashed is not None:
+                        hashed(hashes)
+                    rows, hashes = [], []
+                    if progress is not None:
+                        progress(done, total)
+        finally:
+            for future in pending:
+                future.cancel()
+    cache.put_many(rows)
+    if hashed is not None and hashes:
+        hashed(hashes)
+    if progress is not None:
+        progress(done, total)
+    return done
+
+
+def root_images(db, root) -> list:
+    """(path, size, mtime, file id, hash) of every image in a watched folder a thumbnail can be made for"""
+    join = os.path.join
+    files = query.FileQuery(root, extensions=THUMBNAIL_EXTENSIONS)
+    return [(join(folder, name), size, mtime, file_id, value) for folder, name, size, mtime, file_id, value in
+            files.rows(db, columns='d.path, f.name, f.size, f.mtime, f.id, f.phash')]
+
+
+class ThumbnailJob(QThread):
+    """Makes the missing thumbnails and image hashes of one watched folder"""
+    # root, thumbnails done, thumbnails to do
+    progress = Signal(str, int, int)
+
+    def __init__(self, db_path, cache_path, root, processes=DEFAULT_PROCESSES, max_bytes=DEFAULT_MAX_BYTES,
+                 parent=None):
+        QThread.__init__(self, parent)
+        self.db_path = db_path
+        self.cache_path = cache_path
+        self.root = root
+        self.processes = processes
+        self.max_bytes = max_bytes
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def run(self):
+        timer_thumbnails = timer()
+        db = schema.connect(self.db_path)
+        cache = ThumbnailCache(self.cache_path, self.max_bytes)
+        try:
+            images = root_images(db, self.root)
+            missing = cache.missing(images)
+            unhashed = set(x[0] for x in images if x[4] is None).difference(x[0] for x in missing)
+            items = [(path, size, mtime, file_id, False) for path, size, mtime, file_id, value in missing]
+            items += [(path, size, mtime, file_id, True) for path, size, mtime, file_id, value in images
+                      if path in unhashed]
+            l.info(f'Making {len(missing)} thumbnails and hashing {len(unhashed)} images for {self.root}')
+            done = generate(cache, items, self.processes, self._cancel,
+                            lambda done, total: self.progress.emit(self.root, done, total),
+                            lambda rows: similar.store(db, rows), self.root)
+            l.info(f'Made thumbnails and hashes of {done} images for {self.root} in {timer_thumbnails}')
+        except Exception:
+            l.exception(f'Making thumbnails for {self.root} failed')
+        finally:
+            cache.close()
+            db.conn.close()
+
+
+class ThumbnailManager(QObject):
+    """Runs ThumbnailJobs one watched folder at a time"""
+    progress = Signal(str, int, int)
+    finished = Signal(str)
+
+    def __init__(self, db_path, cache_path=THUMBNAIL_PATH, parent=None):
+        QObject.__init__(self, parent)
+        self.db_path = db_path
+        self.cache_path = cache_path
+        self.processes = DEFAULT_PROCESSES
+        self.max_bytes = DEFAULT_MAX_BYTES
+        self._waiting = []
+        self._job = None
+
+    def generate(self, root):
+        if root in self._waiting or (self._job is not None and self._job.root == root):
+            return
+        self._waiting.append(root)
+        self._start_next()
+
+    def focus(self, root):
+        """Makes the thumbnails of root next"""
+        if root in self._waiting:
+            self._waiting.remove(root)
+            self._waiting.insert(0, root)
+
+    def _start_next(self):
+        if self._job is not None or not self._waiting:
+            return
+        root = self._waiting.pop(0)
+        self._job = ThumbnailJob(self.db_path, self.cache_path, root, self.processes, self.max_bytes)
+        self._job.progress.connect(self.progress)
+        self._job.finished.connect(self._job_finished)
+        self._job.start()
+
+    def _job_finished(self):
+        root = self._job.root
+        self._job.deleteLater()
+        self._job = None
+        self.finished.emit(root)
+        self._start_next()
+
+    def shutdown(self):
+        self._waiting = []
+        if self._job is not None:
+            self._job.cancel()
+            self._job.wait()
@@ -4,6 +4,7 @@ from PyQt5.QtGui import *
 from PyQt5.QtCore import *
 from PyQt5.QtMultimediaWidgets import QVideoWidget
 
+import os
 import sys
 from PyQt5.QtMultimediaWidgets import QVideoWidget
 from PyQt5.QtCore import *
@@ -12,6 +13,7 @@ from PyQt5.QtWidgets import QSlider
 
 from myVideoWidget import myVideoWidget
 from GUI import Ui_MainWindow
+from frankenstein.videoframes import VideoFrameCache, VIDEOFRAMES_PATH
 
 class myMainWindow(Ui_MainWindow, QMainWindow):
     def __init__(self):
@@ -21,6 +23,7 @@ class myMainWindow(Ui_MainWindow, QMainWindow):
         self.videoFullScreen = False   # 判断当前widget是否全屏
         self.videoFullScreenWidget = myVideoWidget()   # 创建一个全屏的widget
         self.player = QMediaPlayer()
+        self.videoFrames = VideoFrameCache(VIDEOFRAMES_PATH)  # poster frames and scrub strips made after scans
         self.player.setVideoOutput(self.wgt_video)  # 视频播放输出的widget，就是上面定义的
         self.btn_open.clicked.connect(self.openVideoFile)   # 打开视频文件按钮
         self.btn_play.clicked.connect(self.playVideo)       # play
@@ -62,7 +65,9 @@ class myMainWindow(Ui_MainWindow, QMainWindow):
 
     def moveSlider(self, position):
         self.sld_video_pressed = True
-        if self.player.duration() > 0:  # 开始播放后才允许进行跳转
+        if self.sld_video.hasStrip():  # cached frames are shown while dragging, the stream seeks on release
+            self.lab_video.setText("%.2f%%" % position)
+        elif self.player.duration() > 0:  # 开始播放后才允许进行跳转
             video_position = int((position / 100) * self.player.duration())
             self.player.setPosition(video_position)
             self.lab_video.setText("%.2f%%" % position)
@@ -73,6 +78,8 @@ class myMainWindow(Ui_MainWindow, QMainWindow):
 
     def releaseSlider(self):
         self.sld_video_pressed = False
+        if self.sld_video.hasStrip() and self.player.duration() > 0:
+            self.player.setPosition(int((self.sld_video.value() / 100) * self.player.duration()))
 
     def changeSlide(self, position):
         if not self.sld_video_pressed:  # 进度条被鼠标点击时不更新
@@ -81,10 +88,25 @@ class myMainWindow(Ui_MainWindow, QMainWindow):
             self.lab_video.setText("%.2f%%" % ((position/self.vidoeLength)*100))
 
     def openVideoFile(self):
-        self.player.setMedia(QMediaContent(QFileDialog.getOpenFileUrl()[0]))  # 选取视频文件
+        url = QFileDialog.getOpenFileUrl()[0]
+        self.loadStrip(url.toLocalFile())
+        self.player.setMedia(QMediaContent(url))  # 选取视频文件
         self.player.play()  # 播放视频
         print(self.player.availableMetaData())
 
+    def loadStrip(self, path):
+        frames = None
+        if path:
+            try:
+                st = os.stat(path)
+                frames = self.videoFrames.get(path, st.st_size, st.st_mtime)
+            except OSError:
+                pass
+        if frames:
+            self.sld_video.setStrip(frames.strip, frames.frames)
+        else:
+            self.sld_video.setStrip(None, 0)
+
     def playVideo(self):
         self.player.play()
 
@@ -0,0 +1,252 @@
+"""
+Live updates of the index.
+
+FolderWatcher is a thread that watches every indexed directory of the watched
+folders with inotify (see fswatch.py). Events are collected per watched folder
+and only handed on once things have been quiet for DEBOUNCE seconds (or after
+MAX_DELAY during a steady stream of changes), so copying a folder of textures
+ends up as one update. Watched folders on network mounts, or on systems without
+inotify, are polled with an incremental scan every POLL_INTERVAL seconds instead.
+
+WatchManager feeds the changed directories to ScanManager.update, which rescans
+only those, and emits changed when something in the index actually changed.
+"""
+import errno
+import os
+import queue
+import threading
+import time
+
+from PySide2.QtCore import QObject, QThread, Signal
+
+from frankenstein import fswatch
+from frankenstein import schema
+from frankenstein.blom import get_logger, timer
+
+l = get_logger('frankenstein.watchthread')
+
+# Seconds without events before the changes of a watched folder are written
+DEBOUNCE = 1.0
+# Longest a change waits while events keep coming in
+MAX_DELAY = 5.0
+# Seconds between incremental scans of watched folders that can't use inotify
+POLL_INTERVAL = 300
+# More changed directories than this and the whole watched folder is scanned instead
+MAX_UPDATE_DIRS = 2000
+
+
+class FolderWatcher(QThread):
+    """Watches the directories of watched folders and reports the changed ones"""
+    # root, list of changed directories
+    changed = Signal(str, object)
+    # root that needs an incremental scan
+    poll = Signal(str)
+
+    def __init__(self, db_path, parent=None):
+        QThread.__init__(self, parent)
+        self.db_path = db_path
+        self.poll_interval = POLL_INTERVAL
+        self._commands = queue.Queue()
+        self._stop = threading.Event()
+        self._notify = None
+        self._watches = {}
+        self._roots = {}
+        self._polled = {}
+        self._pending = {}
+
+    def watch(self, root):
+        """Starts watching root, watching it again adds the directories indexed since"""
+        self._commands.put(('watch', root))
+
+    def unwatch(self, root):
+        self._commands.put(('unwatch', root))
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        try:
+            self._notify = fswatch.Inotify()
+        except OSError:
+            self._notify = None
+        db = schema.connect(self.db_path)
+        try:
+            while not self._stop.is_set():
+                self._run_commands(db)
+                if self._notify is not None and self._watches:
+                    self._handle(self._notify.read(timeout=0.2))
+                else:
+                    self._stop.wait(0.2)
+                self._flush()
+        except Exception:
+            l.exception('Watching folders failed')
+        finally:
+            db.conn.close()
+            if self._notify is not None:
+                self._notify.close()
+
+    def _run_commands(self, db):
+        while True:
+            try:
+                command, root = self._commands.get_nowait()
+            except queue.Empty:
+                return
+            if command == 'watch':
+                self._watch(db, root)
+            else:
+                self._unwatch(root)
+                self._polled.pop(root, None)
+                self._pending.pop(root, None)
+
+    def _watch(self, db, root):
+        if root in self._polled:
+            return
+        if self._notify is None or not fswatch.can_watch(root):
+            l.info(f'Polling {root} every {self.poll_interval} seconds')
+            self._polled[root] = time.monotonic() + self.poll_interval
+            return
+        timer_watch = timer()
+        rid = schema.root_id(db, root)
+        paths = [os.path.normpath(root)]
+        if rid is not None:
+            paths += [path for path, in db.execute(f'SELECT path FROM {schema.DIRECTORIES} WHERE root_id = ?', [rid])]
+        try:
+            for path in paths:
+                self._add(root, path)
+        except OSError:
+            # Out of inotify watches (fs.inotify.max_user_watches)
+            l.warning(f'Could not watch every directory of {root}, polling it instead')
+            self._unwatch(root)
+            self._polled[root] = time.monotonic() + self.poll_interval
+            return
+        l.info(f'Watching {len(self._roots[root])} directories of {root}, took {timer_watch}')
+
+    def _add(self, root, path):
+        """Watches one directory, directories that are gone already are ignored"""
+        watched = self._roots.setdefault(root, {})
+        if path in watched:
+            return
+        try:
+            wd = self._notify.add_watch(path)
+        except OSError as e:
+            if e.errno in (errno.ENOSPC, errno.ENOMEM):
+                raise
+            return
+        watched[path] = wd
+        self._watches[wd] = (root, path)
+
+    def _add_tree(self, root, top):
+        """Watches a directory that just appeared and everything below it"""
+        try:
+            for folder, dirs, files in os.walk(top):
+                self._add(root, folder)
+        except OSError:
+            l.warning(f'Ran out of inotify watches in {root}, polling it instead')
+            self._unwatch(root)
+            self._polled[root] = time.monotonic() + self.poll_interval
+
+    def _forget(self, root, top):
+        """Drops the watches of a directory that moved away and everything below it"""
+        watched = self._roots.get(root, {})
+        for path in [x for x in watched if x == top or x.startswith(top + os.sep)]:
+            wd = watched.pop(path)
+            self._watches.pop(wd, None)
+            self._notify.rm_watch(wd)
+
+    def _unwatch(self, root):
+        for path, wd in self._roots.pop(root, {}).items():
+            self._watches.pop(wd, None)
+            self._notify.rm_watch(wd)
+
+    def _handle(self, events):
+        now = time.monotonic()
+        for wd, mask, cookie, name in events:
+            if mask & fswatch.IN_Q_OVERFLOW:
+                # Events were lost, only a scan can tell what changed
+                l.warning('Too many file system events, scanning watched folders')
+                for root in self._roots:
+                    self.poll.emit(root)
+                continue
+            watch = self._watches.get(wd)
+            if watch is None:
+                continue
+            root, path = watch
+            if mask & fswatch.IN_IGNORED:
+                self._watches.pop(wd, None)
+                self._roots.get(root, {}).pop(path, None)
+                continue
+            if mask & (fswatch.IN_DELETE_SELF | fswatch.IN_MOVE_SELF):
+                # The parent gets its own event, nothing to add here
+                continue
+            if mask & fswatch.IN_ISDIR:
+                child = os.path.join(path, name)
+                if mask & (fswatch.IN_CREATE | fswatch.IN_MOVED_TO):
+                    self._add_tree(root, child)
+                elif mask & fswatch.IN_MOVED_FROM:
+                    self._forget(root, child)
+            pending = self._pending.get(root)
+            if pending is None:
+                pending = self._pending[root] = [set(), now, now]
+            pending[0].add(path)
+            pending[2] = now
+
+    def _flush(self):
+        now = time.monotonic()
+        for root, (dirs, first, last) in list(self._pending.items()):
+            if now - last >= DEBOUNCE or now - first >= MAX_DELAY:
+                del self._pending[root]
+                if len(dirs) > MAX_UPDATE_DIRS:
+                    self.poll.emit(root)
+                else:
+                    self.changed.emit(root, sorted(dirs))
+        for root, due in list(self._polled.items()):
+            if now >= due:
+                self._polled[root] = now + self.poll_interval
+                self.poll.emit(root)
+
+
+class WatchManager(QObject):
+    """
+    Keeps the index of watched folders current while the app is open.
+
+    changed(root, stats) is emitted after an update that added, changed or removed files.
+    """
+    changed = Signal(str, object)
+
+    def __init__(self, db_path, scans, parent=None):
+        QObject.__init__(self, parent)
+        self.scans = scans
+        self.watcher = FolderWatcher(db_path)
+        self.watcher.changed.connect(self._changed)
+        self.watcher.poll.connect(self._poll)
+        scans.updated.connect(self._updated)
+        scans.finished.connect(self._scanned)
+        self.watcher.start()
+
+    def watch(self, roots):
+        for root in roots:
+            self.watcher.watch(root)
+
+    def unwatch(self, root):
+        self.watcher.unwatch(root)
+
+    def _changed(self, root, dirs):
+        l.info(f'{len(dirs)} directories changed in {root}')
+        self.scans.update(root, dirs)
+
+    def _poll(self, root):
+        if not self.scans.is_scanning(root):
+            self.scans.scan([root])
+
+    def _updated(self, root, stats):
+        if stats.inserted or stats.updated or stats.deleted:
+            self.changed.emit(root, stats)
+
+    def _scanned(self, root, stats, cancelled):
+        # Directories the scan added need watches as well
+        if not cancelled:
+            self.watcher.watch(root)
+
+    def shutdown(self):
+        self.watcher.stop()
+        self.watcher.wait()